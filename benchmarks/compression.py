@@ -0,0 +1,88 @@
+"""
+Сравнение хранения без сжатия и со сжатием (compress_storage.py)
+
+    python benchmarks/compression.py                  # 20000 сообщений
+    python benchmarks/compression.py --messages 500000
+
+База строится сценарием parse из run.py, копия сжимается командой
+compress_storage.py compress, обе базы проходят VACUUM. Затем на обеих
+запускаются сценарии чтения, и выводятся размер базы и скорость чтения.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from run import REPO_DIR, format_value, run_scenario, scenario_env
+
+READ_SCENARIOS = ('export_jsonl', 'export_chat', 'export_search', 'export_stats')
+
+
+def column_bytes(db_path: str) -> tuple:
+    connection = sqlite3.connect(db_path)
+    try:
+        return connection.execute('''
+            SELECT SUM(length(CAST(message_text AS BLOB))), SUM(length(CAST(raw_data AS BLOB)))
+            FROM message_records
+        ''').fetchone()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Размер базы и скорость чтения со сжатием и без")
+    parser.add_argument('--messages', type=int, default=20000, help="сообщений в синтетическом чате")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="показывать stderr сценариев")
+    args = parser.parse_args()
+    args.write_behind = True
+
+    workdir = tempfile.mkdtemp(prefix='userbot-bench-compression-')
+    plain_db = os.path.join(workdir, 'plain.db')
+    compressed_db = os.path.join(workdir, 'compressed.db')
+    results = {}
+    try:
+        print("⏳ parse...", file=sys.stderr, flush=True)
+        run_scenario('parse', args, plain_db, workdir)
+        shutil.copy(plain_db, compressed_db)
+
+        connection = sqlite3.connect(plain_db)
+        connection.execute('VACUUM')
+        connection.close()
+
+        print("⏳ compress...", file=sys.stderr, flush=True)
+        subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, 'compress_storage.py'), 'compress', '--vacuum'],
+            env=scenario_env(compressed_db, workdir, False), cwd=workdir, check=True,
+            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL
+        )
+
+        for name, db_path in (('plain', plain_db), ('compressed', compressed_db)):
+            text_bytes, raw_bytes = column_bytes(db_path)
+            results[name] = {
+                'db_size_mb': os.path.getsize(db_path) / 1024 / 1024,
+                'text_mb': text_bytes / 1024 / 1024,
+                'raw_mb': raw_bytes / 1024 / 1024,
+            }
+            for scenario in READ_SCENARIOS:
+                print(f"⏳ {name}: {scenario}...", file=sys.stderr, flush=True)
+                results[name][scenario] = run_scenario(scenario, args, db_path, workdir)['seconds']
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    plain, compressed = results['plain'], results['compressed']
+    print(f"{'':<16} {'без сжатия':>12} {'со сжатием':>12} {'изменение':>10}")
+    for key, label in (('db_size_mb', 'база МБ'), ('text_mb', 'message_text МБ'), ('raw_mb', 'raw_data МБ')):
+        change = (compressed[key] - plain[key]) / plain[key] * 100 if plain[key] else 0
+        print(f"{label:<16} {format_value(plain[key], 2):>12} {format_value(compressed[key], 2):>12} {change:>+9.1f}%")
+    for scenario in READ_SCENARIOS:
+        change = (compressed[scenario] - plain[scenario]) / plain[scenario] * 100 if plain[scenario] else 0
+        print(f"{scenario + ' с':<16} {format_value(plain[scenario], 3):>12} "
+              f"{format_value(compressed[scenario], 3):>12} {change:>+9.1f}%")
+
+
+if __name__ == '__main__':
+    main()
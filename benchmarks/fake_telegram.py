@@ -0,0 +1,241 @@
+"""
+Заменители Telethon для бенчмарков без аккаунта Telegram
+
+Сообщения генерируются детерминированно по (seed, chat_id, message_id) и
+не хранятся в памяти, поэтому чат может содержать миллионы сообщений.
+Сущности, медиа и заголовки ответов - настоящие типы telethon.tl.types,
+чтобы код userbot проходил те же ветки, что и с живым клиентом.
+"""
+import random
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    Channel,
+    MessageActionChatAddUser,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageMediaWebPage,
+    MessageReplies,
+    MessageReplyHeader,
+    User,
+    WebPageEmpty,
+)
+
+# Словарь для текста сообщений: типичная переписка чата поддержки
+WORDS = (
+    'привет здравствуйте подскажите пожалуйста заказ доставка оплата возврат '
+    'не работает приложение ошибка карта курьер сегодня завтра спасибо '
+    'оператор ответьте уже неделю жду деньги списали дважды номер заказа '
+    'можно ли оформить скидка промокод адрес изменить отменить статус '
+    'order payment refund delivery app crash login password support thanks '
+    'когда почему как где что помогите срочно'
+).split()
+EMOJI = ('🙂', '😡', '👍', '🙏', '❗', '🤔', '🔥')
+
+# Доли сообщений разных видов
+REPLY_RATIO = 0.3
+MEDIA_RATIO = 0.15
+SERVICE_RATIO = 0.01
+EDITED_RATIO = 0.05
+# Доля сообщений истории, к которым Telegram прикладывает отправителя
+ATTACHED_SENDER_RATIO = 0.9
+
+START_DATE = datetime(2023, 1, 1, tzinfo=timezone.utc)
+# Секунд между соседними сообщениями чата
+MESSAGE_SPACING = 37
+
+
+def make_user(user_id: int) -> User:
+    return User(
+        id=user_id,
+        access_hash=user_id * 7919,
+        first_name=f"Имя{user_id}",
+        last_name=f"Фамилия{user_id}" if user_id % 3 else None,
+        username=f"user{user_id}" if user_id % 2 else None,
+    )
+
+
+def make_channel(chat_id: int, title: str = None) -> Channel:
+    return Channel(
+        id=chat_id,
+        title=title or f"Бенчмарк чат {chat_id}",
+        photo=None,
+        date=START_DATE,
+        access_hash=chat_id * 104729,
+        megagroup=True,
+        participants_count=5000,
+    )
+
+
+def make_text(rng: random.Random) -> str:
+    """Текст с длиной, похожей на живой чат: много коротких сообщений, редкие длинные"""
+    length = max(1, min(300, int(rng.lognormvariate(2.0, 0.9))))
+    words = [rng.choice(WORDS) for _ in range(length)]
+    if rng.random() < 0.2:
+        words.append(rng.choice(EMOJI))
+    if rng.random() < 0.05:
+        words.append(f"https://example.com/order/{rng.randint(1000, 99999)}")
+    return ' '.join(words).capitalize()
+
+
+class FakeMessage:
+    """Сообщение с атрибутами, которые читает userbot"""
+
+    def __init__(self, chat, message_id: int, seed: int = 0, users: int = 1000, text_suffix: str = '',
+                 spacing: float = MESSAGE_SPACING):
+        rng = random.Random(hash((seed, chat.id, message_id)))
+        self.id = message_id
+        self.chat_id = chat.id
+        self.date = START_DATE + timedelta(seconds=message_id * spacing)
+        self.sender_id = rng.randint(1, users)
+        self._sender = make_user(self.sender_id)
+        self.sender = self._sender if rng.random() < ATTACHED_SENDER_RATIO else None
+
+        self.out = False
+        self.action = None
+        if rng.random() < SERVICE_RATIO:
+            self.action = MessageActionChatAddUser(users=[self.sender_id])
+
+        self.text = make_text(rng) + text_suffix
+        self.raw_text = self.text
+
+        self.media = None
+        if rng.random() < MEDIA_RATIO:
+            self.media = rng.choice((
+                MessageMediaPhoto(),
+                MessageMediaDocument(),
+                MessageMediaWebPage(webpage=WebPageEmpty(id=message_id)),
+            ))
+            if rng.random() < 0.5:
+                self.text = self.raw_text = ''
+
+        self.reply_to = None
+        if message_id > 1 and rng.random() < REPLY_RATIO:
+            target = max(1, message_id - int(rng.expovariate(1 / 20)) - 1)
+            self.reply_to = MessageReplyHeader(reply_to_msg_id=target)
+
+        self.edit_date = None
+        if rng.random() < EDITED_RATIO:
+            self.edit_date = self.date + timedelta(minutes=rng.randint(1, 120))
+
+        self.views = rng.randint(0, 5000)
+        self.forwards = rng.randint(0, 20)
+        self.replies = MessageReplies(replies=rng.randint(0, 10), replies_pts=0)
+
+    async def get_sender(self):
+        return self._sender
+
+
+class FakeClient:
+    """
+    Клиент с методами, которые использует userbot
+
+    chats: {chat_id: число сообщений}; сообщения чата имеют ID 1..N.
+    spacing: секунд между соседними сообщениями (больше - история на больше месяцев).
+    """
+
+    def __init__(self, chats: dict, seed: int = 0, users: int = 1000, spacing: float = MESSAGE_SPACING):
+        self.chats = {chat_id: make_channel(chat_id) for chat_id in chats}
+        self.sizes = dict(chats)
+        self.seed = seed
+        self.users = users
+        self.spacing = spacing
+        self.requests = 0
+
+    def message(self, chat, message_id: int, **kwargs) -> FakeMessage:
+        return FakeMessage(chat, message_id, self.seed, self.users, spacing=self.spacing, **kwargs)
+
+    async def get_me(self):
+        return make_user(10 ** 9)
+
+    async def get_entity(self, identifier):
+        self.requests += 1
+        if isinstance(identifier, str):
+            identifier = identifier.lstrip('@')
+            if identifier.lstrip('-').isdigit():
+                identifier = int(identifier)
+        if identifier not in self.chats:
+            raise ValueError(f"Cannot find any entity corresponding to {identifier!r}")
+        return self.chats[identifier]
+
+    async def get_messages(self, chat, limit=100, offset_id=0, reverse=False, offset_date=None, ids=None, **kwargs):
+        """Страница истории, как messages.getHistory: по убыванию ID или (reverse) по возрастанию"""
+        self.requests += 1
+        size = self.sizes[chat.id]
+        if ids is not None:
+            # Как messages.getMessages: несуществующие сообщения - None
+            return [self.message(chat, message_id) if 0 < message_id <= size else None for message_id in ids]
+        if reverse:
+            ids = range(offset_id + 1, min(size, offset_id + limit) + 1)
+        else:
+            top = size if not offset_id else min(size, offset_id - 1)
+            ids = range(top, max(0, top - limit), -1)
+        return [self.message(chat, message_id) for message_id in ids]
+
+
+class VirtualClock:
+    """Часы без реального ожидания: sleep только сдвигает время"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += max(0.0, seconds)
+
+
+class FloodingClient(FakeClient):
+    """
+    Клиент, который, как Telegram, отвечает FloodWaitError на слишком частые запросы
+
+    Если за последние window секунд пришло больше tolerated_rate * window
+    запросов, get_messages поднимает FloodWaitError(flood_seconds).
+    Время берется из clock (обычно VirtualClock).
+    """
+
+    def __init__(self, chats: dict, clock, tolerated_rate: float = 5.0,
+                 window: float = 10.0, flood_seconds: int = 10, **kwargs):
+        super().__init__(chats, **kwargs)
+        self.clock = clock
+        self.tolerated_rate = tolerated_rate
+        self.window = window
+        self.flood_seconds = flood_seconds
+        self.flood_waits = 0
+        self._recent = deque()
+
+    def _check_flood(self):
+        now = self.clock()
+        self._recent.append(now)
+        while self._recent and self._recent[0] <= now - self.window:
+            self._recent.popleft()
+        if len(self._recent) > self.tolerated_rate * self.window:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def get_messages(self, chat, *args, **kwargs):
+        self._check_flood()
+        return await super().get_messages(chat, *args, **kwargs)
+
+
+class FakeEvent:
+    """Событие NewMessage/MessageEdited для обработчиков userbot"""
+
+    def __init__(self, message: FakeMessage, chat, is_private: bool = False):
+        self.message = message
+        self.chat_id = chat.id
+        self.is_private = is_private
+        self._chat = chat
+        self.responses = []
+
+    async def get_chat(self):
+        return self._chat
+
+    async def get_sender(self):
+        return await self.message.get_sender()
+
+    async def respond(self, text, **kwargs):
+        self.responses.append(text)
@@ -0,0 +1,458 @@
+"""
+Бенчмарки записи и экспорта без аккаунта Telegram
+
+Каждый сценарий запускается в отдельном процессе (чтобы пиковая память
+относилась только к нему) на синтетических сообщениях из fake_telegram.py:
+
+    python benchmarks/run.py                          # все сценарии, 20000 сообщений
+    python benchmarks/run.py --messages 1000000 --write-behind
+    python benchmarks/run.py --scenarios parse,export_json
+    python benchmarks/run.py --save-baseline          # сохранить результат как базовый
+    python benchmarks/run.py --fail-on-regression     # код возврата 1 при ухудшении
+
+Для каждого сценария выводятся сообщений в секунду, p50/p99 задержки
+на сообщение, пиковая память процесса и размер базы, а если есть базовый
+результат (benchmarks/baseline.json) - изменение относительно него.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+BENCH_CHAT_ID = 1000
+
+# Сценарии записи: каждый строит свою базу с нуля
+INGEST_SCENARIOS = ('process_message', 'parse', 'handlers', 'parse_partitioned', 'parse_compressed')
+# Сценарии экспорта: читают базу, построенную сценарием parse
+EXPORT_SCENARIOS = (
+    'export_json', 'export_jsonl', 'export_csv', 'export_chat',
+    'export_stats', 'export_search', 'export_parquet', 'export_chats_all',
+    'export_delta', 'export_threads', 'export_chunks',
+)
+# Проверки без базы: поведение компонентов на заменителях Telegram
+CHECK_SCENARIOS = ('rate_limiter',)
+SCENARIOS = INGEST_SCENARIOS + EXPORT_SCENARIOS + CHECK_SCENARIOS
+
+# Дополнительные настройки userbot для сценария
+SCENARIO_ENV = {
+    'parse_partitioned': {'DATABASE_PARTITIONED': 'true'},
+}
+# parse_partitioned: история растягивается на столько месяцев (больше MAX_ATTACHED разделов)
+PARTITIONED_MONTHS = 24
+# parse_compressed: сообщений отдельного чата для обучения словарей до замера
+COMPRESSION_SAMPLE = 2000
+
+# Сценарий rate_limiter: запросов к истории и терпимая Telegram скорость, запр/с
+RATE_LIMITER_REQUESTS = 3000
+TOLERATED_RATE = 5.0
+
+# Метрики, по которым ищутся ухудшения: (ключ, больше - лучше)
+COMPARED_METRICS = (
+    ('msgs_per_sec', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('peak_rss_mb', False),
+    ('db_size_mb', False),
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux - килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def database_size_mb(db_path: str) -> float:
+    from partitions import list_partitions
+
+    files = [db_path] + list(list_partitions(db_path).values())
+    size = sum(
+        os.path.getsize(path)
+        for base in files
+        for path in (base, base + '-wal')
+        if os.path.exists(path)
+    )
+    return size / 1024 / 1024
+
+
+def make_result(messages: int, seconds: float, latencies=None, db_path=None) -> dict:
+    latencies = latencies or []
+    return {
+        'messages': messages,
+        'seconds': round(seconds, 3),
+        'msgs_per_sec': round(messages / seconds, 1) if seconds else None,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'db_size_mb': round(database_size_mb(db_path), 2) if db_path else None,
+    }
+
+
+# --- Сценарии (выполняются в дочернем процессе) ---
+
+async def start_userbot(userbot, fake_client):
+    userbot.client = fake_client
+    await userbot.db.connect()
+    await userbot.chat_registry.load()
+    await userbot.entity_cache.load()
+    if userbot.writer:
+        await userbot.writer.start()
+
+
+async def stop_userbot(userbot):
+    if userbot.writer:
+        await userbot.writer.stop()
+    await userbot.chat_registry.stop()
+    await userbot.entity_cache.stop()
+    await userbot.db.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    await userbot.db.close()
+
+
+async def run_ingest(scenario: str, messages: int, db_path: str, seed: int) -> dict:
+    import userbot
+    from fake_telegram import MESSAGE_SPACING, FakeClient, FakeEvent
+
+    chats = {BENCH_CHAT_ID: messages}
+    spacing = MESSAGE_SPACING
+    if scenario == 'parse_partitioned':
+        # Каждая страница истории - в своем месяце, запись идет по многим разделам
+        spacing = PARTITIONED_MONTHS * 30 * 86400 / messages
+    elif scenario == 'parse_compressed':
+        chats[BENCH_CHAT_ID + 1] = COMPRESSION_SAMPLE
+    fake = FakeClient(chats, seed=seed, spacing=spacing)
+    chat = fake.chats[BENCH_CHAT_ID]
+    await start_userbot(userbot, fake)
+    latencies = []
+
+    if scenario == 'parse_compressed':
+        # Сжатие включается на уже записанных сообщениях, замеряется запись после него
+        if not await userbot.parse_chat_history(BENCH_CHAT_ID + 1):
+            raise RuntimeError("parse_chat_history завершился с ошибкой")
+        if userbot.writer:
+            await userbot.writer.flush()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await userbot.db.compress_storage(COMPRESSION_SAMPLE)
+
+    started = time.perf_counter()
+    if scenario == 'process_message':
+        for message_id in range(1, messages + 1):
+            message = fake.message(chat, message_id)
+            t = time.perf_counter()
+            await userbot.process_message(message, chat)
+            latencies.append(time.perf_counter() - t)
+
+    elif scenario in ('parse', 'parse_partitioned', 'parse_compressed'):
+        # Задержка на сообщение - время process_message внутри parse_chat_history
+        original = userbot.process_message
+
+        async def timed_process_message(*args, **kwargs):
+            t = time.perf_counter()
+            result = await original(*args, **kwargs)
+            latencies.append(time.perf_counter() - t)
+            return result
+
+        userbot.process_message = timed_process_message
+        if not await userbot.parse_chat_history(BENCH_CHAT_ID):
+            raise RuntimeError("parse_chat_history завершился с ошибкой")
+
+    elif scenario == 'handlers':
+        # Поток новых сообщений, каждое двадцатое потом редактируется
+        for message_id in range(1, messages + 1):
+            event = FakeEvent(fake.message(chat, message_id), chat)
+            t = time.perf_counter()
+            await userbot.handler(event)
+            latencies.append(time.perf_counter() - t)
+            if message_id % 20 == 0:
+                edited = fake.message(chat, message_id, text_suffix=' (изменено)')
+                edited.edit_date = edited.date
+                t = time.perf_counter()
+                await userbot.handler_edited(FakeEvent(edited, chat))
+                latencies.append(time.perf_counter() - t)
+
+    if userbot.writer:
+        await userbot.writer.flush()
+    seconds = time.perf_counter() - started
+    await stop_userbot(userbot)
+    return make_result(messages, seconds, latencies, db_path)
+
+
+async def run_export(scenario: str, db_path: str, workdir: str) -> dict:
+    import export_data
+    from database import MessageDatabase
+
+    db = MessageDatabase(db_path)
+    await db.connect()
+    messages = await db.get_messages_count()
+    await db.close()
+
+    output = os.path.join(workdir, scenario)
+    commands = {
+        'export_json': lambda: export_data.export_to_json(db_path, output + '.json'),
+        'export_jsonl': lambda: export_data.export_to_json(db_path, output + '.jsonl', json_lines=True),
+        'export_csv': lambda: export_data.export_to_csv(db_path, output + '.csv'),
+        'export_chat': lambda: export_data.export_chat_messages(BENCH_CHAT_ID, output + '.json', db_path=db_path),
+        'export_stats': export_data.get_statistics,
+        'export_search': lambda: export_data.search_messages('возврат деньги', limit=50, db_path=db_path),
+        'export_chats_all': lambda: export_data.export_all_chats(output, db_path=db_path),
+        'export_delta': lambda: export_data.export_delta(output, db_path=db_path),
+        'export_threads': lambda: export_data.export_threads(BENCH_CHAT_ID, output + '.jsonl', db_path=db_path),
+    }
+    if scenario == 'export_parquet':
+        from parquet_export import export_to_parquet
+        commands[scenario] = lambda: export_to_parquet(db_path, output, full=True)
+    elif scenario == 'export_chunks':
+        from chunk_export import export_chunks
+        commands[scenario] = lambda: export_chunks(output, max_tokens=2000, db_path=db_path)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await commands[scenario]()
+    seconds = time.perf_counter() - started
+    return make_result(messages, seconds, db_path=db_path)
+
+
+async def run_rate_limiter() -> dict:
+    """
+    AdaptiveRateLimiter против клиента, отвечающего FloodWait
+
+    Время виртуальное, поэтому сценарий идет доли секунды. Проверяется, что
+    после FloodWait скорость падает, а потом восстанавливается почти до
+    терпимой Telegram; иначе RuntimeError. Сообщений в секунду - средний темп
+    запросов в виртуальном времени.
+    """
+    from fake_telegram import FloodingClient, VirtualClock
+    from rate_limiter import AdaptiveRateLimiter
+
+    clock = VirtualClock()
+    fake = FloodingClient({BENCH_CHAT_ID: 10 ** 6}, clock, tolerated_rate=TOLERATED_RATE)
+    chat = fake.chats[BENCH_CHAT_ID]
+    limiter = AdaptiveRateLimiter(rate=1.0, max_rate=TOLERATED_RATE * 4, clock=clock, sleep=clock.sleep)
+
+    rate_before_flood = rate_after_flood = None
+    half_started = half_requests = None
+    offset_id = 0
+    for request in range(RATE_LIMITER_REQUESTS):
+        if request == RATE_LIMITER_REQUESTS // 2:
+            half_started, half_requests = clock(), limiter.requests
+        rate = limiter.rate
+        page = await limiter.call(fake.get_messages, chat, limit=10, offset_id=offset_id, reverse=True)
+        offset_id = page[-1].id
+        if rate_after_flood is None and limiter.flood_waits:
+            rate_before_flood, rate_after_flood = rate, limiter.rate
+
+    if rate_after_flood is None:
+        raise RuntimeError("FloodWait не было: проверка лимитера ничего не показала")
+    if rate_after_flood >= rate_before_flood:
+        raise RuntimeError(
+            f"скорость не снизилась после FloodWait: {rate_before_flood:.2f} -> {rate_after_flood:.2f}"
+        )
+    # Темп второй половины прогона - после восстановления
+    recovered = (limiter.requests - half_requests) / (clock() - half_started)
+    if recovered < TOLERATED_RATE * 0.7:
+        raise RuntimeError(
+            f"скорость не восстановилась: {recovered:.2f} запр/с при допустимых {TOLERATED_RATE}"
+        )
+
+    result = make_result(RATE_LIMITER_REQUESTS, clock())
+    result.update({
+        'flood_waits': limiter.flood_waits,
+        'rate_before_flood': round(rate_before_flood, 2),
+        'rate_after_flood': round(rate_after_flood, 2),
+        'recovered_rate': round(recovered, 2),
+    })
+    return result
+
+
+def worker(args):
+    """Один сценарий в текущем процессе; результат пишется в JSON-файл"""
+    if args.scenario in INGEST_SCENARIOS:
+        result = asyncio.run(run_ingest(args.scenario, args.messages, args.db, args.seed))
+    elif args.scenario == 'rate_limiter':
+        result = asyncio.run(run_rate_limiter())
+    else:
+        result = asyncio.run(run_export(args.scenario, args.db, args.workdir))
+    with open(args.result, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+# --- Запуск сценариев и сравнение (родительский процесс) ---
+
+def scenario_env(db_path: str, workdir: str, write_behind: bool) -> dict:
+    """Настройки userbot для бенчмарка: без лимита запросов и подробных логов"""
+    env = dict(os.environ)
+    env.update({
+        'API_ID': '1',
+        'API_HASH': 'benchmark',
+        'STRING_SESSION': '',
+        'SESSION_NAME': os.path.join(workdir, 'benchmark'),
+        'DATABASE_PATH': db_path,
+        'LOG_FILE': os.path.join(workdir, 'benchmark.log'),
+        'LOG_LEVEL': env.get('BENCH_LOG_LEVEL', 'WARNING'),
+        'WRITE_BEHIND_ENABLED': 'true' if write_behind else 'false',
+        'PARSE_REQUESTS_PER_SECOND': '1000000',
+        'PARSE_REQUESTS_MAX_PER_SECOND': '1000000',
+        'PARSE_REQUESTS_BURST': '1000000',
+        'PYTHONPATH': os.pathsep.join([REPO_DIR, BENCH_DIR]),
+    })
+    return env
+
+
+def run_scenario(scenario: str, args, db_path: str, workdir: str) -> dict:
+    result_path = os.path.join(workdir, f'{scenario}.result.json')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--worker', scenario,
+        '--db', db_path, '--workdir', workdir, '--result', result_path,
+        '--messages', str(args.messages), '--seed', str(args.seed),
+    ]
+    env = scenario_env(db_path, workdir, args.write_behind)
+    env.update(SCENARIO_ENV.get(scenario, {}))
+    output = None if args.verbose else subprocess.DEVNULL
+    subprocess.run(command, env=env, cwd=workdir, check=True, stdout=output, stderr=output)
+    with open(result_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Ухудшения относительно базового результата больше threshold (доля)"""
+    regressions = []
+    for scenario, result in results.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            new, old = result.get(metric), base.get(metric)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            result.setdefault('change', {})[metric] = round(change * 100, 1)
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(f"{scenario}.{metric}: {old} -> {new} ({change * 100:+.1f}%)")
+    return regressions
+
+
+def format_value(value, digits=1):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+def print_table(results: dict):
+    print(f"{'сценарий':<16} {'сообщ.':>9} {'сообщ/с':>10} {'p50 мс':>8} {'p99 мс':>8} "
+          f"{'RSS МБ':>8} {'база МБ':>8}  изменение")
+    for scenario, r in results.items():
+        change = ', '.join(f"{k} {v:+.1f}%" for k, v in r.get('change', {}).items())
+        print(
+            f"{scenario:<16} {r['messages']:>9} {format_value(r['msgs_per_sec']):>10} "
+            f"{format_value(r['p50_ms'], 3):>8} {format_value(r['p99_ms'], 3):>8} "
+            f"{format_value(r['peak_rss_mb']):>8} {format_value(r['db_size_mb'], 2):>8}  {change}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки userbot на синтетических сообщениях")
+    parser.add_argument('--messages', type=int, default=20000, help="сообщений в синтетическом чате")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="сценарии через запятую: " + ', '.join(SCENARIOS))
+    parser.add_argument('--write-behind', action='store_true', help="включить пакетную запись")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="файл базового результата")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результат как базовый")
+    parser.add_argument('--threshold', type=float, default=10.0, help="допустимое ухудшение, %%")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--output', help="сохранить результат в JSON-файл")
+    parser.add_argument('--keep', action='store_true', help="не удалять рабочий каталог")
+    parser.add_argument('--verbose', action='store_true', help="показывать stderr сценариев")
+    # Внутренние параметры дочернего процесса
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.scenario = args.worker
+        worker(args)
+        return
+
+    requested = {name.strip() for name in args.scenarios.split(',') if name.strip()}
+    unknown = requested - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    # Экспорту нужна база, построенная парсингом
+    if requested & set(EXPORT_SCENARIOS):
+        requested.add('parse')
+    scenarios = [name for name in SCENARIOS if name in requested]
+
+    workdir = tempfile.mkdtemp(prefix='userbot-bench-')
+    export_db = os.path.join(workdir, 'parse.db')
+    results = {}
+    try:
+        for scenario in scenarios:
+            if scenario == 'export_parquet':
+                try:
+                    import pyarrow  # noqa: F401
+                except ImportError:
+                    print("⚠️ export_parquet пропущен: pyarrow не установлен", file=sys.stderr)
+                    continue
+            db_path = export_db if scenario in EXPORT_SCENARIOS + ('parse',) else \
+                os.path.join(workdir, f'{scenario}.db')
+            print(f"⏳ {scenario}...", file=sys.stderr, flush=True)
+            results[scenario] = run_scenario(scenario, args, db_path, workdir)
+    finally:
+        if args.keep:
+            print(f"Рабочий каталог: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get('results', {}), args.threshold / 100)
+
+    print_table(results)
+
+    report = {
+        'messages': args.messages,
+        'write_behind': args.write_behind,
+        'seed': args.seed,
+        'python': sys.version.split()[0],
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Базовый результат сохранен: {args.baseline}")
+
+    if regressions:
+        print(f"\n⚠️ Ухудшения больше {args.threshold:.0f}%:")
+        for line in regressions:
+            print(f"  • {line}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
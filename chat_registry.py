@@ -0,0 +1,104 @@
+"""
+Реестр чатов в памяти процесса
+
+Метаданные чата (название, тип, число участников, access_hash) меняются
+редко, поэтому в базу они пишутся только при изменении. Время последней
+активности копится в памяти и сбрасывается одним пакетом по таймеру.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Tuple
+
+from database import MessageDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRegistry:
+    def __init__(self, db: MessageDatabase, flush_interval: float = 30.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        # chat_id -> (chat_title, chat_type, participants_count, access_hash, username)
+        self._known: Dict[int, Tuple] = {}
+        # chat_id -> время последнего сообщения, еще не записанное в базу
+        self._activity: Dict[int, str] = {}
+        self._task = None
+        self.stats = {'metadata_writes': 0, 'activity_flushes': 0}
+
+    @staticmethod
+    def _fingerprint(chat_data: Dict) -> Tuple:
+        metadata = chat_data.get('metadata') or {}
+        return (
+            chat_data.get('chat_title'),
+            chat_data.get('chat_type'),
+            chat_data.get('participants_count'),
+            metadata.get('access_hash'),
+            metadata.get('username'),
+        )
+
+    async def load(self):
+        """Загрузка известных чатов из базы"""
+        for chat in await self.db.get_chats():
+            try:
+                metadata = json.loads(chat.get('metadata') or '{}')
+            except ValueError:
+                metadata = {}
+            self._known[chat['chat_id']] = self._fingerprint({**chat, 'metadata': metadata})
+        logger.debug(f"Загружено чатов в реестр: {len(self._known)}")
+
+    async def start(self):
+        """Запуск таймера сброса времени активности"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка таймера и финальный сброс"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_activity()
+
+    async def update(self, chat_data: Dict):
+        """Учет сообщения из чата: запись метаданных только если они изменились"""
+        chat_id = chat_data.get('chat_id')
+        self._activity[chat_id] = datetime.now().isoformat()
+
+        fingerprint = self._fingerprint(chat_data)
+        known = self._known.get(chat_id)
+        if known is not None:
+            # Неизвестное число участников (None) не считается изменением
+            if fingerprint[2] is None:
+                fingerprint = fingerprint[:2] + (known[2],) + fingerprint[3:]
+            if fingerprint == known:
+                return
+
+        # Неудачная запись не запоминается - следующее сообщение чата повторит ее
+        if not await self.db.save_chat(chat_data):
+            return
+        self._known[chat_id] = fingerprint
+        self.stats['metadata_writes'] += 1
+
+    async def flush_activity(self):
+        """Запись накопленного времени активности одним пакетом"""
+        if not self._activity:
+            return
+        pending, self._activity = self._activity, {}
+        try:
+            await self.db.update_chats_activity(list(pending.items()))
+            self.stats['activity_flushes'] += 1
+        except Exception as e:
+            logger.error(f"Ошибка при записи активности чатов: {e}")
+            # Не теряем отметки: более свежие значения имеют приоритет
+            for chat_id, last_activity in pending.items():
+                self._activity.setdefault(chat_id, last_activity)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_activity()
@@ -0,0 +1,489 @@
+"""
+Экспорт переписки фрагментами для обработки LLM
+
+Сообщения каждого чата группируются в разговоры - по паузам между
+сообщениями (group=time) или по веткам ответов из индекса message_threads
+(group=thread) - и упаковываются во фрагменты не больше заданного бюджета
+токенов или символов. Каждая строка JSON Lines - готовый запрос для пакетной
+обработки: текст фрагмента и ссылки на исходные сообщения.
+
+    python export_data.py chunks llm_chunks --max-tokens=3000 --overlap=3
+
+Экспорт инкрементальный. Водяной знак в _manifest.json - порядок записи, как
+у export_delta: максимальные id в message_records и message_edits каждого
+сегмента. Следующий запуск находит сообщения, записанные или исправленные
+после него, с любыми message_id (новые, история от /parse, пропуски,
+заполненные повтором), и выгружает затронутые ими разговоры заново целиком
+в свой файл chunks_<seq>_<время>.jsonl. У таких фрагментов rechunked = true:
+они заменяют прежние фрагменты с теми же сообщениями. Разговор, который еще
+может продолжиться (есть сообщения моложе паузы gap_minutes), откладывается
+до следующего запуска.
+
+Токены считаются tiktoken (cl100k_base), если он установлен, иначе
+оцениваются по длине текста (CHARS_PER_TOKEN символа на токен).
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import DATABASE_PATH
+from database import MessageDatabase
+from export_data import iter_rows, segment_ranges
+
+MANIFEST_FILE = '_manifest.json'
+
+# Символов на токен для оценки без tiktoken (русский текст - около 3)
+CHARS_PER_TOKEN = 3
+
+DEFAULT_MAX_TOKENS = 2000
+DEFAULT_GAP_MINUTES = 30
+
+GROUP_MODES = ('time', 'thread')
+
+CHUNK_COLUMNS = '''
+    message_id, chat_id, chat_title, user_id, username, first_name, last_name,
+    message_text, date, reply_to_message_id, media_type
+'''
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста: tiktoken, если установлен, иначе оценка по длине"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """Дата сообщения с часовым поясом (даты без пояса - местное время)"""
+    if not value:
+        return None
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return date if date.tzinfo else date.astimezone()
+
+
+def format_line(message: Dict) -> Optional[str]:
+    """Сообщение -> строка текста фрагмента; None - пустое служебное сообщение"""
+    text = (message['message_text'] or '').strip()
+    if not text:
+        if not message['media_type']:
+            return None
+        text = f"[{message['media_type']}]"
+    if message['username']:
+        author = f"@{message['username']}"
+    else:
+        author = f"{message['first_name'] or ''} {message['last_name'] or ''}".strip()
+        author = author or (f"id{message['user_id']}" if message['user_id'] else '—')
+    date = (message['date'] or '')[:16].replace('T', ' ')
+    reply = f" → #{message['reply_to_message_id']}" if message['reply_to_message_id'] else ''
+    return f"#{message['message_id']} [{date}] {author}{reply}: {text}"
+
+
+class ChunkWriter:
+    """
+    Упаковка сообщений одного разговора во фрагменты
+
+    Сообщение не делится между фрагментами; сообщение больше бюджета
+    обрезается. С overlap > 0 новый фрагмент разговора начинается с
+    последних overlap сообщений предыдущего (если они помещаются в половину
+    бюджета), чтобы модель видела контекст.
+    """
+
+    def __init__(self, f, chat_id: int, group: str, budget: int, unit: str, overlap: int):
+        self.f = f
+        self.chat_id = chat_id
+        self.group = group
+        self.budget = budget
+        self.unit = unit
+        self.overlap = overlap
+        self.chunks = 0
+        self.messages = 0
+        self.truncated = 0
+        self.chat_title = None
+        self._group_id = None
+        self._part = 0
+        self._items: List[tuple] = []
+        self._size = 0
+        self._overlapped = 0
+        self._rechunked = False
+
+    def measure(self, line: str) -> int:
+        return count_tokens(line) if self.unit == 'tokens' else len(line)
+
+    def start_group(self, group_id: int, rechunked: bool = False):
+        self.end_group()
+        self._group_id = group_id
+        self._part = 0
+        self._rechunked = rechunked
+
+    def add(self, message: Dict):
+        line = format_line(message)
+        if line is None:
+            return
+        self.chat_title = message['chat_title'] or self.chat_title
+        size = self.measure(line) + 1
+        if size > self.budget:
+            line = self._truncate(line)
+            size = self.measure(line) + 1
+            self.truncated += 1
+        if self._items and self._size + size > self.budget:
+            tail = self._items[-self.overlap:] if self.overlap else []
+            self._flush()
+            while tail and sum(item[2] for item in tail) > min(self.budget // 2, self.budget - size):
+                tail = tail[1:]
+            self._items = list(tail)
+            self._size = sum(item[2] for item in tail)
+            self._overlapped = len(tail)
+        self._items.append((message, line, size))
+        self._size += size
+        self.messages += 1
+
+    def end_group(self):
+        self._flush()
+        self._items, self._size, self._overlapped = [], 0, 0
+
+    def _truncate(self, line: str) -> str:
+        # Бюджет в токенах: сначала грубо по символам, потом точнее
+        limit = self.budget - 1 if self.unit == 'chars' else (self.budget - 1) * CHARS_PER_TOKEN
+        line = line[:limit - 1] + '…'
+        while self.measure(line) + 1 > self.budget and len(line) > 1:
+            line = line[:len(line) * 9 // 10 - 1] + '…'
+        return line
+
+    def _flush(self):
+        if len(self._items) <= self._overlapped:
+            return
+        messages = [item[0] for item in self._items]
+        first, last = messages[0], messages[-1]
+        self.f.write(json.dumps({
+            'chunk_id': f"{self.chat_id}:{first['message_id']}-{last['message_id']}",
+            'chat_id': self.chat_id,
+            'chat_title': self.chat_title,
+            'group': self.group,
+            'group_id': self._group_id,
+            'part': self._part,
+            'first_message_id': first['message_id'],
+            'last_message_id': last['message_id'],
+            'start_date': first['date'],
+            'end_date': last['date'],
+            'message_count': len(messages),
+            'overlap': self._overlapped,
+            'rechunked': self._rechunked,
+            self.unit: self._size,
+            'message_ids': [message['message_id'] for message in messages],
+            'text': '\n'.join(item[1] for item in self._items),
+        }, ensure_ascii=False) + '\n')
+        self.chunks += 1
+        self._part += 1
+
+
+def load_manifest(output_dir: str) -> Dict:
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'settings': None, 'watermark': None, 'chats': {}, 'runs': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir: str, manifest: Dict):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+async def changed_messages(db: MessageDatabase, ranges: List[tuple],
+                           chat_ids: Set[int]) -> Tuple[Dict[int, Set[int]], Dict[int, Set[int]]]:
+    """
+    Сообщения, записанные и исправленные в диапазонах segment_ranges
+
+    Возвращает ({chat_id: {message_id}} новых, {chat_id: {message_id}} исправленных);
+    учитываются только чаты из chat_ids (уже выгружавшиеся).
+    """
+    inserted: Dict[int, Set[int]] = {}
+    edited: Dict[int, Set[int]] = {}
+    for schema, since, until in ranges:
+        for table, key, changed in (('message_records', 'message_row_id', inserted),
+                                    ('message_edits', 'edit_id', edited)):
+            cursor = await db.connection.execute(f'''
+                SELECT chat_id, message_id FROM {schema}.{table} WHERE id > ? AND id <= ?
+            ''', (since[key], until[key]))
+            async for chat_id, message_id in iter_rows(cursor):
+                if chat_id in chat_ids:
+                    changed.setdefault(chat_id, set()).add(message_id)
+    return inserted, edited
+
+
+async def find_conversations(db: MessageDatabase, chat_id: int, seeds: List[int],
+                             gap: timedelta) -> List[Tuple[int, int]]:
+    """
+    Диапазоны message_id разговоров (group=time), в которые попали seeds
+
+    Разговоры делятся паузами больше gap, как в write_range; соседние
+    затронутые разговоры объединяются. Читаются только message_id и даты
+    от начала разговора первого seed до конца разговора последнего.
+    seeds - по возрастанию.
+    """
+    # Начало разговора первого seed: назад до паузы
+    cursor = await db.connection.execute('''
+        SELECT message_id, date FROM messages
+        WHERE chat_id = ? AND message_id <= ?
+        ORDER BY message_id DESC
+    ''', (chat_id, seeds[0]))
+    start, later = seeds[0], None
+    async for message_id, date in iter_rows(cursor):
+        date = parse_date(date)
+        if later is not None and date is not None and later - date > gap:
+            break
+        start, later = message_id, date or later
+
+    cursor = await db.connection.execute('''
+        SELECT message_id, date FROM messages
+        WHERE chat_id = ? AND message_id >= ?
+        ORDER BY message_id
+    ''', (chat_id, start))
+    ranges: List[Tuple[int, int]] = []
+    index = 0
+    begin = end = previous_date = None
+    touched = previous_touched = False
+
+    def close():
+        if not touched:
+            return
+        if previous_touched and ranges:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((begin, end))
+
+    async for message_id, date in iter_rows(cursor):
+        date = parse_date(date)
+        if begin is not None and date is not None and previous_date is not None and date - previous_date > gap:
+            close()
+            if index >= len(seeds):
+                return ranges
+            begin, previous_touched, touched = message_id, touched, False
+        if begin is None:
+            begin = message_id
+        while index < len(seeds) and seeds[index] <= message_id:
+            touched = True
+            index += 1
+        end = message_id
+        previous_date = date or previous_date
+    close()
+    return ranges
+
+
+async def find_threads(db: MessageDatabase, chat_id: int, seeds: List[int]) -> List[int]:
+    """Корни веток (group=thread), в которые входят seeds"""
+    cursor = await db.connection.execute('''
+        SELECT DISTINCT root_id FROM main.message_threads
+        WHERE chat_id = ? AND message_id IN (SELECT value FROM json_each(?))
+    ''', (chat_id, json.dumps(seeds)))
+    return [row[0] for row in await cursor.fetchall()]
+
+
+async def write_range(db: MessageDatabase, writer: ChunkWriter, group_by: str, gap: timedelta,
+                      cutoff: datetime, after_id: int = 0, before_id: Optional[int] = None,
+                      root_ids: Optional[List[int]] = None, fresh: Optional[Set[int]] = None) -> List[int]:
+    """
+    Фрагменты разговоров чата с after_id < message_id < before_id (или веток root_ids)
+
+    Разговор с сообщениями моложе cutoff еще может продолжиться: он не
+    выгружается, а его message_id возвращаются, чтобы следующий запуск
+    выгрузил разговор заново. fresh - при повторной выгрузке чата сообщения,
+    которые еще не выгружались: разговор с другими сообщениями уже выгружался,
+    и его фрагменты помечаются rechunked.
+    """
+    chat_id = writer.chat_id
+    upper = before_id if before_id is not None else sys.maxsize
+    if group_by == 'thread':
+        if root_ids is not None:
+            thread_filter, params = 'root_id IN (SELECT value FROM json_each(?))', (json.dumps(root_ids),)
+        else:
+            thread_filter, params = 'message_id > ? AND message_id < ?', (after_id, upper)
+        cursor = await db.connection.execute(f'''
+            SELECT thread_root_id, {CHUNK_COLUMNS}
+            FROM (
+                SELECT message_id AS thread_message_id, root_id AS thread_root_id
+                FROM main.message_threads
+                WHERE chat_id = ? AND {thread_filter}
+            ) t
+            JOIN messages m ON m.chat_id = ? AND m.message_id = t.thread_message_id
+            ORDER BY thread_root_id, thread_message_id
+        ''', (chat_id, *params, chat_id))
+    else:
+        cursor = await db.connection.execute(f'''
+            SELECT NULL AS thread_root_id, {CHUNK_COLUMNS}
+            FROM messages
+            WHERE chat_id = ? AND message_id > ? AND message_id < ?
+            ORDER BY message_id
+        ''', (chat_id, after_id, upper))
+    columns = [description[0] for description in cursor.description]
+
+    held: List[int] = []
+    group: List[Dict] = []
+    group_key = previous_date = None
+    group_open = False
+
+    def close_group():
+        if not group:
+            return
+        if group_open:
+            held.extend(message['message_id'] for message in group)
+            return
+        rechunked = fresh is not None and any(message['message_id'] not in fresh for message in group)
+        writer.start_group(group_key, rechunked)
+        for message in group:
+            writer.add(message)
+        writer.end_group()
+
+    async for row in iter_rows(cursor):
+        message = dict(zip(columns, row))
+        date = parse_date(message['date'])
+        if group_by == 'thread':
+            starts_group = message['thread_root_id'] != group_key
+            key = message['thread_root_id']
+        else:
+            starts_group = not group or (
+                date is not None and previous_date is not None and date - previous_date > gap
+            )
+            key = message['message_id']
+        if starts_group:
+            close_group()
+            group, group_key, group_open = [], key, False
+        group.append(message)
+        group_open = group_open or (date is not None and date > cutoff)
+        previous_date = date or previous_date
+    close_group()
+    return held
+
+
+async def export_chunks(output_dir: str = 'llm_chunks', group_by: str = 'time',
+                        max_tokens: Optional[int] = None, max_chars: Optional[int] = None,
+                        overlap: int = 0, gap_minutes: int = DEFAULT_GAP_MINUTES,
+                        chat_id: Optional[int] = None, db_path: str = DATABASE_PATH) -> Optional[str]:
+    """
+    Инкрементальный экспорт фрагментов переписки в JSON Lines
+
+    group_by: time - разговоры по паузам больше gap_minutes, thread - ветки ответов
+    max_tokens / max_chars: бюджет фрагмента (по умолчанию DEFAULT_MAX_TOKENS токенов)
+    overlap: сколько последних сообщений фрагмента повторять в начале следующего
+    chat_id: только один чат
+    """
+    if group_by not in GROUP_MODES:
+        print(f"❌ Группировка {group_by}: нужна одна из {', '.join(GROUP_MODES)}")
+        return None
+    unit, budget = ('chars', max_chars) if max_chars else ('tokens', max_tokens or DEFAULT_MAX_TOKENS)
+    settings = {'group': group_by, 'unit': unit, 'budget': budget,
+                'overlap': overlap, 'gap_minutes': gap_minutes, 'chat_id': chat_id}
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    # Границы фрагментов зависят от настроек: смешивать их в одном каталоге нельзя
+    if manifest['settings'] is not None and (manifest['settings'] != settings or not manifest.get('watermark')):
+        print(f"❌ Каталог {output_dir} создан с другими настройками: {manifest['settings']}. "
+              "Укажите новый каталог или те же настройки")
+        return None
+
+    db = MessageDatabase(db_path)
+    await db.connect()
+
+    try:
+        db.require_all_partitions()
+        gap = timedelta(minutes=gap_minutes)
+        cutoff = datetime.now().astimezone() - gap
+
+        # Одна читающая транзакция: все запросы видят один снимок базы
+        await db.connection.execute('BEGIN')
+        since = manifest['watermark'] or {'message_row_id': 0, 'edit_id': 0}
+        ranges, until = await segment_ranges(db, since)
+        if chat_id is not None:
+            chat_ids = [chat_id]
+        else:
+            cursor = await db.connection.execute('SELECT chat_id FROM chat_stats ORDER BY chat_id')
+            chat_ids = [row[0] for row in await cursor.fetchall()]
+
+        chats = dict(manifest['chats'])
+        # Чаты, уже выгружавшиеся: заново - только разговоры с новыми, исправленными
+        # и отложенными сообщениями
+        inserted, edited = await changed_messages(db, ranges, {int(key) for key in chats}) if chats else ({}, {})
+        for key, state in chats.items():
+            inserted.setdefault(int(key), set()).update(state['pending'])
+
+        created_at = datetime.now()
+        seq = len(manifest['runs']) + 1
+        file_name = f"chunks_{seq:06d}_{created_at.strftime('%Y%m%dT%H%M%S')}.jsonl"
+        path = os.path.join(output_dir, file_name)
+        totals = {'chunks': 0, 'messages': 0, 'truncated': 0}
+
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for index, current_chat in enumerate(chat_ids, 1):
+                writer = ChunkWriter(f, current_chat, group_by, budget, unit, overlap)
+                key = str(current_chat)
+                if key not in chats:
+                    # Первая выгрузка чата: вся история
+                    held = await write_range(db, writer, group_by, gap, cutoff)
+                else:
+                    fresh = inserted.get(current_chat, set())
+                    seeds = sorted(fresh | edited.get(current_chat, set()))
+                    held = []
+                    if seeds and group_by == 'thread':
+                        roots = await find_threads(db, current_chat, seeds)
+                        held = await write_range(db, writer, group_by, gap, cutoff,
+                                                 root_ids=roots, fresh=fresh)
+                    elif seeds:
+                        for low, high in await find_conversations(db, current_chat, seeds, gap):
+                            held += await write_range(db, writer, group_by, gap, cutoff,
+                                                      low - 1, high + 1, fresh=fresh)
+                chats[key] = {'pending': held}
+                for name in totals:
+                    totals[name] += getattr(writer, name)
+                print(f"\r⏳ Чатов: {index}/{len(chat_ids)}, фрагментов: {totals['chunks']}",
+                      end='', file=sys.stderr, flush=True)
+        if chat_ids:
+            print(file=sys.stderr)
+
+        await db.connection.execute('COMMIT')
+
+        if not totals['chunks']:
+            os.remove(path + '.tmp')
+            print("✅ Новых фрагментов нет")
+            return None
+        os.replace(path + '.tmp', path)
+
+        manifest['settings'] = settings
+        manifest['watermark'] = until
+        manifest['chats'] = chats
+        manifest['runs'].append({
+            'seq': seq,
+            'file': file_name,
+            'created_at': created_at.isoformat(),
+            'from': since,
+            'to': until,
+            'chunks': totals['chunks'],
+            'messages': totals['messages'],
+        })
+        save_manifest(output_dir, manifest)
+
+        print(f"✅ Фрагментов: {totals['chunks']} ({totals['messages']} сообщений) -> {path}")
+        if totals['truncated']:
+            print(f"⚠️ Сообщений длиннее бюджета (обрезаны): {totals['truncated']}")
+        return path
+
+    finally:
+        if db.connection.in_transaction:
+            await db.connection.execute('ROLLBACK')
+        await db.close()
@@ -0,0 +1,110 @@
+"""
+Сжатие хранения message_text и raw_data
+
+    python compress_storage.py status             - размер базы и доля сжатых сообщений
+    python compress_storage.py compress [--vacuum] - обучить словари и сжать все сообщения
+    python compress_storage.py train              - обучить новые словари (затем compress)
+    python compress_storage.py decompress [--vacuum] - вернуть хранение без сжатия
+
+После compress новые сообщения сжимаются автоматически. Представление
+messages, экспорт и поиск распаковывают текст прозрачно; внешним клиентам
+SQLite нужна функция msg_decode (см. storage_codec.py), поэтому для них
+базу можно вернуть в исходный вид командой decompress.
+
+Команды перепаковывают все сообщения, включая помесячные разделы (они
+получают словари основной базы): userbot лучше остановить. Место на диске
+освобождается только после VACUUM (--vacuum).
+"""
+import asyncio
+import os
+import sys
+
+from config import DATABASE_PATH
+from database import MessageDatabase
+from partitions import list_partitions
+
+
+async def print_status(db: MessageDatabase):
+    cursor = await db.connection.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(typeof(message_text) = 'blob'), 0),
+               COALESCE(SUM(typeof(raw_data) = 'blob'), 0),
+               COALESCE(SUM(length(CAST(message_text AS BLOB))), 0),
+               COALESCE(SUM(length(CAST(raw_data AS BLOB))), 0)
+        FROM message_records
+    ''')
+    total, texts, raws, text_bytes, raw_bytes = await cursor.fetchone()
+    cursor = await db.connection.execute(
+        'SELECT kind, COUNT(*), SUM(length(dictionary)) FROM compression_dicts GROUP BY kind'
+    )
+    dictionaries = await cursor.fetchall()
+
+    print(f"📦 База: {db.db_path} ({os.path.getsize(db.db_path) / 1024 / 1024:.1f} МБ)")
+    print(f"   Сообщений: {total}")
+    print(f"   Сжато message_text: {texts}, raw_data: {raws}")
+    print(f"   Объем message_text: {text_bytes / 1024 / 1024:.1f} МБ, raw_data: {raw_bytes / 1024 / 1024:.1f} МБ")
+    if dictionaries:
+        for kind, count, size in dictionaries:
+            print(f"   Словари {kind}: {count} ({size / 1024:.1f} КБ)")
+    else:
+        print("   Сжатие выключено")
+
+
+async def recode_partition(db: MessageDatabase, path: str, compress: bool) -> int:
+    """Сжатие (словарями основной базы) или распаковка одного раздела"""
+    print(f"📦 Раздел {path}")
+    partition = MessageDatabase(path, readers=0, partitioned=False)
+    await partition.connect()
+    try:
+        if compress:
+            await db.share_dictionaries(partition)
+            changed = await partition.compress_storage()
+        else:
+            changed = await partition.decompress_storage()
+        if '--vacuum' in sys.argv:
+            await vacuum(partition)
+        return changed
+    finally:
+        await partition.close()
+
+
+async def vacuum(db: MessageDatabase):
+    before = os.path.getsize(db.db_path)
+    print("🧹 VACUUM...")
+    await db.connection.execute('VACUUM')
+    after = os.path.getsize(db.db_path)
+    print(f"   {before / 1024 / 1024:.1f} МБ -> {after / 1024 / 1024:.1f} МБ")
+
+
+async def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command not in ('status', 'train', 'compress', 'decompress'):
+        print(__doc__)
+        return
+
+    db = MessageDatabase(DATABASE_PATH)
+    await db.connect()
+    try:
+        if command == 'train':
+            sizes = await db.train_compression_dictionaries()
+            print(f"✅ Обучены словари: {sizes}. Сжать сообщения ими: python compress_storage.py compress")
+        elif command == 'compress':
+            changed = await db.compress_storage()
+            for path in list_partitions(DATABASE_PATH).values():
+                changed += await recode_partition(db, path, compress=True)
+            print(f"✅ Сжатие включено, перепаковано сообщений: {changed}")
+        elif command == 'decompress':
+            changed = await db.decompress_storage()
+            for path in list_partitions(DATABASE_PATH).values():
+                changed += await recode_partition(db, path, compress=False)
+            print(f"✅ Сжатие выключено, распаковано сообщений: {changed}")
+
+        if command != 'status' and '--vacuum' in sys.argv:
+            await vacuum(db)
+        await print_status(db)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -14,10 +14,92 @@ STRING_SESSION = os.getenv('STRING_SESSION', '')
 # Для Bothost.ru используйте /app/data/messages.db
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'messages.db')
 
+# Режим журнала и настройки SQLite.
+# WAL позволяет экспорту и статистике читать базу, пока userbot пишет в нее
+DATABASE_WAL = os.getenv('DATABASE_WAL', 'true').lower() in ('1', 'true', 'yes')
+# NORMAL в режиме WAL не теряет целостность базы и заметно быстрее FULL
+DATABASE_SYNCHRONOUS = os.getenv('DATABASE_SYNCHRONOUS', 'NORMAL').upper()
+# Размер кэша страниц на соединение, КБ
+DATABASE_CACHE_SIZE_KB = int(os.getenv('DATABASE_CACHE_SIZE_KB', '65536'))
+# Сколько байт файла базы читать через mmap (0 - отключить)
+DATABASE_MMAP_SIZE = int(os.getenv('DATABASE_MMAP_SIZE', '268435456'))
+# Сколько ждать освобождения блокировки перед ошибкой, мс
+DATABASE_BUSY_TIMEOUT_MS = int(os.getenv('DATABASE_BUSY_TIMEOUT_MS', '5000'))
+# Соединений только для чтения (поиск, статистика); 0 - читать через соединение записи
+DATABASE_READERS = int(os.getenv('DATABASE_READERS', '2'))
+
+# Помесячные файлы сообщений рядом с основной базой (messages.2024-05.db, см. partitions.py)
+DATABASE_PARTITIONED = os.getenv('DATABASE_PARTITIONED', 'false').lower() in ('1', 'true', 'yes')
+# Сколько месяцев (включая текущий) держать подключенными; 0 - хранить все
+DATABASE_RETENTION_MONTHS = int(os.getenv('DATABASE_RETENTION_MONTHS', '0'))
+# Что делать со старыми разделами: archive - перенести в DATABASE_ARCHIVE_DIR, drop - удалить
+DATABASE_RETENTION_ACTION = os.getenv('DATABASE_RETENTION_ACTION', 'archive').lower()
+DATABASE_ARCHIVE_DIR = os.getenv('DATABASE_ARCHIVE_DIR', 'archive')
+
 # Logging settings
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 # Для Bothost.ru используйте /app/data/userbot.log
 LOG_FILE = os.getenv('LOG_FILE', 'userbot.log')
+# Ротация файла лога по размеру: размер файла, МБ, и сколько старых файлов хранить
+LOG_MAX_SIZE_MB = float(os.getenv('LOG_MAX_SIZE_MB', '10'))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+# Формат файла лога: text или json (по объекту на строку, для сборщиков логов)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Сколько записей о входящих сообщениях в секунду писать (остальные пропускаются); 0 - все
+LOG_EVENTS_PER_SECOND = float(os.getenv('LOG_EVENTS_PER_SECOND', '10'))
+
+# Пакетная запись сообщений (write-behind)
+# Сообщения копятся в очереди и записываются пачками одной транзакцией
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', '10000'))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '500'))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '1.0'))
+
+# Как часто (в секундах) записывать время последней активности чатов
+CHAT_ACTIVITY_FLUSH_INTERVAL = float(os.getenv('CHAT_ACTIVITY_FLUSH_INTERVAL', '30'))
+
+# Кэш отправителей: размер и сохранение в базу между перезапусками
+ENTITY_CACHE_SIZE = int(os.getenv('ENTITY_CACHE_SIZE', '50000'))
+ENTITY_CACHE_PERSIST = os.getenv('ENTITY_CACHE_PERSIST', 'true').lower() in ('1', 'true', 'yes')
+
+# Параллельный парсинг нескольких чатов
+PARSE_CONCURRENCY = int(os.getenv('PARSE_CONCURRENCY', '3'))
+# Общий лимит запросов к Telegram для всех задач парсинга (запросов в секунду).
+# Скорость подстраивается автоматически: растет, пока нет FloodWait, и падает при нем
+PARSE_REQUESTS_PER_SECOND = float(os.getenv('PARSE_REQUESTS_PER_SECOND', '1.0'))
+PARSE_REQUESTS_MIN_PER_SECOND = float(os.getenv('PARSE_REQUESTS_MIN_PER_SECOND', '0.05'))
+PARSE_REQUESTS_MAX_PER_SECOND = float(os.getenv('PARSE_REQUESTS_MAX_PER_SECOND', '10.0'))
+PARSE_REQUESTS_BURST = int(os.getenv('PARSE_REQUESTS_BURST', '5'))
+# Каталог файлов для /parse_list: команда читает файлы только из него
+# Для Bothost.ru используйте /app/data/chat_lists
+PARSE_LIST_DIR = os.getenv('PARSE_LIST_DIR', 'chat_lists')
+# Как часто (в секундах) обновлять сообщение с ходом парсинга
+PARSE_PROGRESS_INTERVAL = float(os.getenv('PARSE_PROGRESS_INTERVAL', '15'))
+
+# Загрузка медиа в хранилище по хешу содержимого (см. media_store.py)
+MEDIA_DOWNLOAD_ENABLED = os.getenv('MEDIA_DOWNLOAD_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+# Для Bothost.ru используйте /app/data/media
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '2'))
+MEDIA_QUEUE_SIZE = int(os.getenv('MEDIA_QUEUE_SIZE', '1000'))
+# Виды медиа для загрузки: photo, video, document, audio, voice, sticker, gif
+MEDIA_TYPES = [t.strip() for t in os.getenv('MEDIA_TYPES', 'photo,document,video,audio,voice').split(',') if t.strip()]
+# Файлы больше не загружаются, МБ; свой лимит для видов: photo:10,video:50
+MEDIA_MAX_SIZE_MB = float(os.getenv('MEDIA_MAX_SIZE_MB', '20'))
+MEDIA_TYPE_MAX_SIZE_MB = os.getenv('MEDIA_TYPE_MAX_SIZE_MB', '')
+# Файлы от этого размера (МБ) загружаются не больше MEDIA_LARGE_CONCURRENCY одновременно
+MEDIA_LARGE_SIZE_MB = float(os.getenv('MEDIA_LARGE_SIZE_MB', '10'))
+MEDIA_LARGE_CONCURRENCY = int(os.getenv('MEDIA_LARGE_CONCURRENCY', '1'))
+
+# Сжатие message_text и raw_data (включается командой python compress_storage.py compress):
+# значения короче этого размера в байтах хранятся как есть
+STORAGE_COMPRESSION_MIN_LENGTH = int(os.getenv('STORAGE_COMPRESSION_MIN_LENGTH', '16'))
+# Сколько последних сообщений брать для обучения словарей сжатия
+STORAGE_COMPRESSION_SAMPLE = int(os.getenv('STORAGE_COMPRESSION_SAMPLE', '20000'))
+
+# HTTP-эндпоинт метрик в формате Prometheus (GET /metrics); 0 - выключен (по умолчанию)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
 
 # Создаем директорию для данных, если путь содержит директорию
 if '/' in DATABASE_PATH:
@@ -1,22 +1,227 @@
 import aiosqlite
+import asyncio
 import json
+import os
+import sqlite3
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, List, Dict
-from config import DATABASE_PATH
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple, AsyncIterator
+from config import (
+    DATABASE_PATH,
+    DATABASE_WAL,
+    DATABASE_SYNCHRONOUS,
+    DATABASE_CACHE_SIZE_KB,
+    DATABASE_MMAP_SIZE,
+    DATABASE_BUSY_TIMEOUT_MS,
+    DATABASE_READERS,
+    DATABASE_PARTITIONED,
+    DATABASE_RETENTION_MONTHS,
+    DATABASE_RETENTION_ACTION,
+    DATABASE_ARCHIVE_DIR,
+    STORAGE_COMPRESSION_MIN_LENGTH,
+    STORAGE_COMPRESSION_SAMPLE
+)
+from metrics import registry
+from partitions import (
+    MAX_ATTACHED,
+    archive_database_file,
+    current_month,
+    id_base,
+    list_partitions,
+    month_of,
+    partition_path,
+    remove_database_file,
+    schema_name,
+    shift_month
+)
+from storage_codec import (
+    RAW,
+    TEXT,
+    StorageCodec,
+    compact_json,
+    train_raw_dictionary,
+    train_text_dictionary
+)
+
+# Размер пакета строк для миграций, чтобы не держать долгую блокировку записи
+MIGRATION_BATCH_SIZE = 5000
+
+# Текущая версия схемы (PRAGMA user_version); увеличивается с каждой миграцией
+SCHEMA_VERSION = 5
+
+# Сколько раз повторять запись, если база занята другим процессом
+WRITE_RETRIES = 5
+
+DB_WRITE_SECONDS = registry.histogram(
+    'userbot_db_write_seconds', 'Длительность транзакции записи сообщений в базу'
+)
+DB_MESSAGES_WRITTEN = registry.counter(
+    'userbot_db_messages_written_total', 'Сообщений записано в базу'
+)
+DB_WRITE_RETRIES = registry.counter(
+    'userbot_db_write_retries_total', 'Повторов записи из-за занятой базы'
+)
+
+
+def is_locked_error(error: Exception) -> bool:
+    """База занята другим соединением (ошибку можно переждать)"""
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def fts_query(text: str) -> str:
+    """
+    Запрос пользователя -> выражение FTS5
+    
+    Каждое слово берется в кавычки, поэтому символы вроде @, -, : ищутся
+    как текст, а не разбираются как синтаксис FTS5. Слово со звездочкой
+    на конце ищется по префиксу.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
 
 
 class MessageDatabase:
-    def __init__(self, db_path: str = DATABASE_PATH):
+    def __init__(self, db_path: str = DATABASE_PATH, readers: int = DATABASE_READERS,
+                 wal: bool = DATABASE_WAL, read_only: bool = False,
+                 partitioned: bool = DATABASE_PARTITIONED):
+        """
+        Args:
+            db_path: путь к файлу базы
+            readers: размер пула соединений только для чтения
+            wal: включить журнал WAL (чтение не блокирует запись)
+            read_only: открыть базу только для чтения (без создания таблиц и миграций)
+            partitioned: сообщения в помесячных файлах рядом с базой (см. partitions.py)
+        """
         self.db_path = db_path
+        self.read_only = read_only
+        self.partitioned = partitioned and db_path != ':memory:'
+        self.wal = wal and db_path != ':memory:' and not read_only
+        # Все записи идут через одно соединение
         self.connection: Optional[aiosqlite.Connection] = None
+        # Транзакции записи на общем соединении выполняются по очереди (см. _write_transaction)
+        self._write_lock = asyncio.Lock()
+        # user_id -> (username, first_name, last_name), уже записанные в users
+        self._known_users: Dict[int, Tuple] = {}
+        # Читающие соединения имеют смысл только в WAL: иначе чтение блокирует запись
+        self.max_readers = readers if self.wal else 0
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: List[aiosqlite.Connection] = []
+        # Открытые и открывающиеся читатели: место занимается до await открытия
+        self._reader_slots = 0
+        # Словари сжатия message_text и raw_data (пусто - база хранит текст как есть)
+        self.codec = StorageCodec(STORAGE_COMPRESSION_MIN_LENGTH, reload=self._read_dictionaries_sync)
+        # id(соединения) -> (версия списка разделов, подключенные месяцы)
+        self._attached: Dict[int, Tuple[int, List[str]]] = {}
+        # Растет при создании и архивировании разделов: читатели переподключают разделы
+        self._partitions_version = 0
+        # (версия, {месяц: путь}) - список разделов без чтения каталога на каждую запись
+        self._partitions_cache: Optional[Tuple[int, Dict[str, str]]] = None
+        self._attach_limit_reported = False
 
     async def connect(self):
         """Подключение к базе данных"""
+        if self.read_only:
+            await self._connect_read_only()
+            return
+        
         self.connection = await aiosqlite.connect(self.db_path)
+        if self.wal:
+            await self.connection.execute('PRAGMA journal_mode = WAL')
+            await self.connection.execute(f'PRAGMA synchronous = {DATABASE_SYNCHRONOUS}')
+        await self._apply_pragmas(self.connection)
         await self.create_tables()
+        if self.partitioned:
+            await self.apply_retention()
+            await self._attach_partitions(self.connection)
+
+    async def _apply_pragmas(self, connection: aiosqlite.Connection):
+        """Настройки, которые действуют в пределах одного соединения"""
+        await connection.execute(f'PRAGMA busy_timeout = {int(DATABASE_BUSY_TIMEOUT_MS)}')
+        await connection.execute(f'PRAGMA cache_size = -{int(DATABASE_CACHE_SIZE_KB)}')
+        await connection.execute(f'PRAGMA mmap_size = {int(DATABASE_MMAP_SIZE)}')
+        # Распаковка сжатых значений в представлениях и триггерах
+        await connection.create_function('msg_decode', 1, self.codec.decode, deterministic=True)
+
+    async def _open_read_only(self) -> aiosqlite.Connection:
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        connection = await aiosqlite.connect(uri, uri=True)
+        await self._apply_pragmas(connection)
+        return connection
+
+    async def _connect_read_only(self):
+        """Соединение только для чтения; схема должна быть уже обновлена"""
+        self.connection = await self._open_read_only()
+        version = await self._get_schema_version()
+        if version < SCHEMA_VERSION:
+            await self.connection.close()
+            raise RuntimeError(
+                f"Схема базы {self.db_path} устарела (версия {version}, нужна {SCHEMA_VERSION}): "
+                "откройте базу в обычном режиме, чтобы выполнить миграции"
+            )
+        await self._load_dictionaries()
+        if self.partitioned:
+            await self._attach_partitions(self.connection, read_only=True)
+
+    async def _open_reader(self) -> aiosqlite.Connection:
+        connection = await self._open_read_only()
+        if self.partitioned:
+            try:
+                await self._attach_partitions(connection, read_only=True)
+            except BaseException:
+                await connection.close()
+                raise
+        self._all_readers.append(connection)
+        return connection
+
+    @asynccontextmanager
+    async def reader(self):
+        """
+        Соединение для чтения из пула
+        
+        В режиме WAL читатели видят последнее зафиксированное состояние и
+        работают одновременно с записью. Без WAL (или при readers=0)
+        возвращается соединение записи.
+        """
+        if not self.max_readers:
+            # Соединение записи: чтение ждет конца чужой транзакции и не
+            # переподключает разделы посреди нее
+            async with self._write_lock:
+                yield self.connection
+            return
+        
+        if self._readers is None:
+            self._readers = asyncio.Queue()
+        if self._readers.empty() and self._reader_slots < self.max_readers:
+            self._reader_slots += 1
+            try:
+                connection = await self._open_reader()
+            except BaseException:
+                self._reader_slots -= 1
+                raise
+        else:
+            connection = await self._readers.get()
+        try:
+            if self.partitioned and self._attached.get(id(connection), (None,))[0] != self._partitions_version:
+                await self._attach_partitions(connection, read_only=True)
+            yield connection
+        finally:
+            self._readers.put_nowait(connection)
 
     async def close(self):
         """Закрытие соединения с базой данных"""
+        for connection in self._all_readers:
+            await connection.close()
+        self._all_readers = []
+        self._reader_slots = 0
+        self._readers = None
+        self._attached = {}
         if self.connection:
             await self.connection.close()
 
@@ -24,18 +229,14 @@ class MessageDatabase:
         """Создание таблиц в базе данных"""
         cursor = await self.connection.cursor()
         
-        # Таблица для сообщений
+        # Таблица для сообщений. Название чата и имя автора хранятся один раз
+        # в chats и users, а привычный плоский вид дает представление messages
         await cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
+            CREATE TABLE IF NOT EXISTS message_records (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 message_id INTEGER NOT NULL,
                 chat_id INTEGER NOT NULL,
-                chat_title TEXT,
-                chat_type TEXT,
                 user_id INTEGER,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
                 message_text TEXT,
                 date TIMESTAMP,
                 is_reply INTEGER DEFAULT 0,
@@ -43,6 +244,42 @@ class MessageDatabase:
                 has_media INTEGER DEFAULT 0,
                 media_type TEXT,
                 raw_data TEXT,
+                edit_date TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Авторы сообщений: текущее имя и история его изменений
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_names (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                changed_at TIMESTAMP
+            )
+        ''')
+        
+        # История правок: прежний текст сообщения и время правки
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_edits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                old_text TEXT,
+                edit_date TIMESTAMP,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
@@ -61,96 +298,1721 @@ class MessageDatabase:
             )
         ''')
         
+        # Контрольные точки парсинга истории: диапазон загруженных message_id
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS parse_state (
+                chat_id INTEGER PRIMARY KEY,
+                min_message_id INTEGER,
+                max_message_id INTEGER,
+                backfill_complete INTEGER DEFAULT 0,
+                updated_at TIMESTAMP
+            )
+        ''')
+        
+        # Сообщения, которые не удалось сохранить при парсинге: контрольная точка
+        # parse_state проходит мимо них, а следующий запуск загружает их заново
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS parse_failures (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        ''')
+        
+        # Задачи парсинга (/parse): продолжаются после перезапуска userbot
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS parse_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_identifier TEXT NOT NULL,
+                limit_count INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                reply_chat_id INTEGER,
+                reply_message_id INTEGER,
+                parsed INTEGER DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        
+        # Кэш отправителей (пользователей и каналов) между перезапусками
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS entity_cache (
+                entity_id INTEGER PRIMARY KEY,
+                kind TEXT,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                title TEXT,
+                access_hash INTEGER,
+                updated_at TIMESTAMP
+            )
+        ''')
+        
+        # Счетчики по чатам, которые поддерживают триггеры: статистика
+        # не пересчитывается по всей таблице сообщений
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_stats (
+                chat_id INTEGER PRIMARY KEY,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                user_count INTEGER NOT NULL DEFAULT 0,
+                first_date TIMESTAMP,
+                last_date TIMESTAMP
+            )
+        ''')
+        
+        # Авторы, писавшие в чат (для подсчета уникальных авторов)
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_users (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        # Общие счетчики базы (число авторов в users)
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS db_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # Словари сжатия message_text и raw_data (см. storage_codec.py)
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS compression_dicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                dictionary BLOB NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Загруженные медиа (см. media_store.py): файл хранится один раз по хешу
+        # содержимого, а media связывает с ним сообщения
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER,
+                mime_type TEXT,
+                path TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                media_type TEXT,
+                file_key TEXT,
+                sha256 TEXT REFERENCES media_blobs(sha256),
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        ''')
+        
+        await cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_media_file_key
+            ON media(file_key)
+        ''')
+        
+        # Индекс веток ответов: корень и глубина каждого сообщения. Ведется при
+        # записи (см. THREAD_INSERT_SQL) и всегда хранится в основной базе,
+        # поэтому ветка собирается и из сообщений разных разделов
+        await cursor.execute('''
+            CREATE TABLE IF NOT EXISTS message_threads (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                parent_id INTEGER,
+                root_id INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            ) WITHOUT ROWID
+        ''')
+        
+        await cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_threads_root
+            ON message_threads(chat_id, root_id, message_id)
+        ''')
+        
+        # Ответы, ждавшие записанное сообщение как временный корень (см.
+        # THREAD_INSERT_SQL), переходят в его ветку. Если сообщение само
+        # корень (глубина 0), ответы уже указывают на него
+        await cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_message_threads_reroot
+            AFTER INSERT ON message_threads
+            WHEN new.depth > 0
+            BEGIN
+                UPDATE message_threads
+                SET root_id = new.root_id, depth = depth + new.depth
+                WHERE chat_id = new.chat_id AND root_id = new.message_id;
+            END
+        ''')
+        
         # Индексы для быстрого поиска
+        # (уникальный индекс по chat_id, message_id служит и индексом по chat_id)
+        await cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_message_records_chat_message
+            ON message_records(chat_id, message_id)
+        ''')
+        
         await cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_chat_id 
-            ON messages(chat_id)
+            CREATE INDEX IF NOT EXISTS idx_message_records_date
+            ON message_records(date)
         ''')
         
         await cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_date 
-            ON messages(date)
+            CREATE INDEX IF NOT EXISTS idx_message_records_user_id
+            ON message_records(user_id)
         ''')
         
         await cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_user_id 
-            ON messages(user_id)
+            CREATE INDEX IF NOT EXISTS idx_user_names_user
+            ON user_names(user_id)
+        ''')
+        
+        await cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_message_edits_message
+            ON message_edits(chat_id, message_id)
         ''')
         
         await self.connection.commit()
+        
+        await self._load_dictionaries()
+        await self.migrate()
 
-    async def save_message(self, message_data: Dict):
-        """Сохранение сообщения в базу данных"""
-        cursor = await self.connection.cursor()
+    async def _get_schema_version(self) -> int:
+        cursor = await self.connection.execute('PRAGMA user_version')
+        return (await cursor.fetchone())[0]
+
+    async def _set_schema_version(self, version: int):
+        await self.connection.execute(f'PRAGMA user_version = {int(version)}')
+        await self.connection.commit()
+
+    async def _is_table(self, name: str) -> bool:
+        cursor = await self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        )
+        return await cursor.fetchone() is not None
+
+    async def _column_exists(self, table: str, column: str) -> bool:
+        cursor = await self.connection.execute(f'PRAGMA table_info({table})')
+        return any(row[1] == column for row in await cursor.fetchall())
+
+    async def migrate(self):
+        """Пошаговое обновление схемы существующей базы (версия в PRAGMA user_version)"""
+        version = await self._get_schema_version()
+        # В базах старого формата messages - таблица, а не представление
+        legacy = await self._is_table('messages')
+        
+        if version < 1:
+            if legacy:
+                await self._migrate_unique_messages()
+            await self._set_schema_version(1)
+        
+        if version < 2:
+            if legacy:
+                await self._migrate_normalized_schema()
+            await self._set_schema_version(2)
+        
+        if version < 3:
+            await self._migrate_fulltext_index()
+            await self._set_schema_version(3)
+        
+        if version < 4:
+            await self._migrate_chat_stats()
+            await self._set_schema_version(4)
+        
+        if version < 5:
+            await self._migrate_thread_index()
+            await self._set_schema_version(5)
+        
+        await self._create_views_and_triggers()
+        await self.connection.commit()
+
+    # Объекты схемы, которые читают message_text и raw_data: в сжатой базе
+    # они распаковывают значения функцией msg_decode и пересоздаются при
+    # включении и выключении сжатия
+    DECODING_VIEWS = ('messages', 'message_texts')
+    DECODING_TRIGGERS = (
+        'trg_message_records_edit',
+        'trg_messages_fts_insert',
+        'trg_messages_fts_delete',
+        'trg_messages_fts_update',
+    )
+
+    def _decoded(self, column: str) -> str:
+        """
+        Выражение SQL для чтения message_text или raw_data
+        
+        Без словарей сжатия значения хранятся как есть, и схема не зависит
+        от msg_decode: базу можно читать любым клиентом SQLite.
+        """
+        return f'msg_decode({column})' if self.codec.active else column
+
+    def _messages_view_sql(self, records: str, temp: bool = False) -> str:
+        """Плоский вид сообщений поверх records (таблица или объединение разделов)"""
+        decoded = self._decoded
+        prefix = 'main.' if temp else ''
+        return f'''
+            CREATE {'TEMP ' if temp else ''}VIEW IF NOT EXISTS messages AS
+            SELECT
+                m.id, m.message_id, m.chat_id, c.chat_title, c.chat_type,
+                m.user_id, u.username, u.first_name, u.last_name,
+                {decoded('m.message_text')} AS message_text, m.date, m.is_reply, m.reply_to_message_id,
+                m.has_media, m.media_type, {decoded('m.raw_data')} AS raw_data, m.edit_date, m.created_at
+            FROM {records} m
+            LEFT JOIN {prefix}chats c ON c.chat_id = m.chat_id
+            LEFT JOIN {prefix}users u ON u.user_id = m.user_id
+        '''
+
+    async def _create_views_and_triggers(self):
+        """Представления и триггеры поверх нормализованных таблиц"""
+        decoded = self._decoded
+        
+        # Плоский вид сообщений, как в старой схеме: запросы экспорта работают без изменений
+        await self.connection.execute(self._messages_view_sql('message_records'))
+        
+        # Текст сообщений для полнотекстового индекса сжатой базы
+        await self.connection.execute(f'''
+            CREATE VIEW IF NOT EXISTS message_texts AS
+            SELECT id, {decoded('message_text')} AS message_text FROM message_records
+        ''')
+        
+        # Прежний текст при изменении сохраняется в историю правок
+        # (перепаковка того же текста правкой не считается)
+        await self.connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_message_records_edit
+            AFTER UPDATE OF message_text ON message_records
+            WHEN {decoded('old.message_text')} IS NOT {decoded('new.message_text')}
+            BEGIN
+                INSERT INTO message_edits (chat_id, message_id, old_text, edit_date)
+                VALUES (old.chat_id, old.message_id, {decoded('old.message_text')},
+                        COALESCE(new.edit_date, CURRENT_TIMESTAMP));
+            END
+        ''')
+        
+        # Полнотекстовый индекс следует за message_records
+        await self.connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+            AFTER INSERT ON message_records
+            BEGIN
+                INSERT INTO messages_fts (rowid, message_text)
+                VALUES (new.id, {decoded('new.message_text')});
+            END
+        ''')
+        await self.connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+            AFTER DELETE ON message_records
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message_text)
+                VALUES ('delete', old.id, {decoded('old.message_text')});
+            END
+        ''')
+        await self.connection.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update
+            AFTER UPDATE OF message_text ON message_records
+            WHEN {decoded('old.message_text')} IS NOT {decoded('new.message_text')}
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, message_text)
+                VALUES ('delete', old.id, {decoded('old.message_text')});
+                INSERT INTO messages_fts (rowid, message_text)
+                VALUES (new.id, {decoded('new.message_text')});
+            END
+        ''')
+        
+        # Счетчики чата: новое сообщение, новый автор, удаление
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_stats_insert
+            AFTER INSERT ON message_records
+            BEGIN
+                INSERT INTO chat_stats (chat_id, message_count, first_date, last_date)
+                VALUES (new.chat_id, 1, new.date, new.date)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    message_count = message_count + 1,
+                    first_date = CASE WHEN first_date IS NULL OR excluded.first_date < first_date
+                                      THEN excluded.first_date ELSE first_date END,
+                    last_date = CASE WHEN last_date IS NULL OR excluded.last_date > last_date
+                                     THEN excluded.last_date ELSE last_date END;
+                INSERT OR IGNORE INTO chat_users (chat_id, user_id)
+                SELECT new.chat_id, new.user_id WHERE new.user_id IS NOT NULL;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_stats_user
+            AFTER UPDATE OF user_id ON message_records
+            WHEN new.user_id IS NOT NULL AND old.user_id IS NOT new.user_id
+            BEGIN
+                INSERT OR IGNORE INTO chat_users (chat_id, user_id) VALUES (new.chat_id, new.user_id);
+            END
+        ''')
+        # Даты и авторы при удалении не пересчитываются: удаление - редкая операция
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_stats_delete
+            AFTER DELETE ON message_records
+            BEGIN
+                UPDATE chat_stats SET message_count = message_count - 1 WHERE chat_id = old.chat_id;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chat_users_insert
+            AFTER INSERT ON chat_users
+            BEGIN
+                UPDATE chat_stats SET user_count = user_count + 1 WHERE chat_id = new.chat_id;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_count_insert
+            AFTER INSERT ON users
+            BEGIN
+                INSERT INTO db_counters (name, value) VALUES ('users', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END
+        ''')
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_count_delete
+            AFTER DELETE ON users
+            BEGIN
+                UPDATE db_counters SET value = value - 1 WHERE name = 'users';
+            END
+        ''')
+        
+        # Прежнее имя пользователя сохраняется в историю имен
+        await self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_rename
+            AFTER UPDATE OF username, first_name, last_name ON users
+            WHEN old.username IS NOT new.username
+              OR old.first_name IS NOT new.first_name
+              OR old.last_name IS NOT new.last_name
+            BEGIN
+                INSERT INTO user_names (user_id, username, first_name, last_name, changed_at)
+                VALUES (old.user_id, old.username, old.first_name, old.last_name, new.updated_at);
+            END
+        ''')
+
+    async def _migrate_unique_messages(self):
+        """
+        Миграция 1: уникальность (chat_id, message_id)
+        
+        Выполняется над таблицей messages старого формата.
+        Удаляет дубликаты, накопившиеся от повторного парсинга и правок,
+        оставляя самую свежую копию. Текст копии, отличающийся от следующей,
+        переносится в message_edits. Работает окнами по id с коммитом
+        после каждого окна, чтобы не блокировать запись надолго.
+        """
+        if not await self._column_exists('messages', 'edit_date'):
+            await self.connection.execute('ALTER TABLE messages ADD COLUMN edit_date TIMESTAMP')
+        
+        # Вспомогательный индекс, чтобы поиск дубликатов не сканировал таблицу
+        await self.connection.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_dedup
+            ON messages(chat_id, message_id, id)
+        ''')
+        await self.connection.commit()
+        
+        cursor = await self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+        max_id = (await cursor.fetchone())[0]
+        
+        removed = 0
+        for window_start in range(0, max_id, MIGRATION_BATCH_SIZE):
+            window = (window_start, window_start + MIGRATION_BATCH_SIZE)
+            
+            await self.connection.execute('''
+                INSERT INTO message_edits (chat_id, message_id, old_text, edit_date)
+                SELECT m.chat_id, m.message_id, m.message_text, (
+                    SELECT MIN(n.created_at) FROM messages n
+                    WHERE n.chat_id = m.chat_id AND n.message_id = m.message_id AND n.id > m.id
+                )
+                FROM messages m
+                WHERE m.id > ? AND m.id <= ?
+                  AND EXISTS (
+                    SELECT 1 FROM messages n
+                    WHERE n.chat_id = m.chat_id AND n.message_id = m.message_id AND n.id > m.id
+                  )
+                  AND m.message_text IS NOT (
+                    SELECT n.message_text FROM messages n
+                    WHERE n.chat_id = m.chat_id AND n.message_id = m.message_id AND n.id > m.id
+                    ORDER BY n.id LIMIT 1
+                  )
+            ''', window)
+            
+            cursor = await self.connection.execute('''
+                DELETE FROM messages
+                WHERE id > ? AND id <= ?
+                  AND EXISTS (
+                    SELECT 1 FROM messages n
+                    WHERE n.chat_id = messages.chat_id
+                      AND n.message_id = messages.message_id
+                      AND n.id > messages.id
+                  )
+            ''', window)
+            removed += cursor.rowcount
+            await self.connection.commit()
         
+        if removed:
+            print(f"Миграция: удалено дубликатов сообщений: {removed}")
+        
+        await self.connection.execute('DROP INDEX IF EXISTS idx_messages_dedup')
+        await self.connection.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_message
+            ON messages(chat_id, message_id)
+        ''')
+        
+        await self.connection.commit()
+
+    async def _migrate_normalized_schema(self):
+        """
+        Миграция 2: нормализация таблицы messages
+        
+        Строки старой таблицы переносятся окнами по id в message_records
+        (id сохраняются), имена авторов - в users (смены имени попадают
+        в user_names), недостающие чаты - в chats. После переноса таблица
+        удаляется, а ее место занимает представление messages.
+        """
+        cursor = await self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+        max_id = (await cursor.fetchone())[0]
+        
+        for window_start in range(0, max_id, MIGRATION_BATCH_SIZE):
+            window = (window_start, window_start + MIGRATION_BATCH_SIZE)
+            
+            await self.connection.execute('''
+                INSERT OR IGNORE INTO chats (chat_id, chat_title, chat_type)
+                SELECT chat_id, chat_title, chat_type FROM messages
+                WHERE id > ? AND id <= ?
+                ORDER BY id DESC
+            ''', window)
+            
+            # Строки идут по порядку, поэтому смены имени попадают в историю,
+            # а в users остается последнее имя
+            await self.connection.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name, first_seen, updated_at)
+                SELECT user_id, username, first_name, last_name, created_at, created_at
+                FROM messages
+                WHERE id > ? AND id <= ? AND user_id IS NOT NULL
+                ORDER BY id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    updated_at = excluded.updated_at
+                WHERE users.username IS NOT excluded.username
+                   OR users.first_name IS NOT excluded.first_name
+                   OR users.last_name IS NOT excluded.last_name
+            ''', window)
+            
+            await self.connection.execute('''
+                INSERT OR IGNORE INTO message_records (
+                    id, message_id, chat_id, user_id, message_text, date,
+                    is_reply, reply_to_message_id, has_media, media_type,
+                    raw_data, edit_date, created_at
+                )
+                SELECT
+                    id, message_id, chat_id, user_id, message_text, date,
+                    is_reply, reply_to_message_id, has_media, media_type,
+                    raw_data, edit_date, created_at
+                FROM messages
+                WHERE id > ? AND id <= ?
+            ''', window)
+            await self.connection.commit()
+        
+        await self.connection.execute('DROP TABLE messages')
+        await self.connection.commit()
+        print(f"Миграция: сообщения перенесены в нормализованную схему (до id {max_id})")
+
+    async def _migrate_fulltext_index(self):
+        """
+        Миграция 3: полнотекстовый индекс FTS5 по тексту сообщений
+        
+        Индекс хранит только токены (external content), сам текст берется
+        из message_records. Существующие сообщения индексируются окнами по id
+        с коммитом после каждого окна.
+        """
+        await self.connection.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message_text,
+                content = 'message_records',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+        await self.connection.commit()
+        
+        cursor = await self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM message_records')
+        max_id = (await cursor.fetchone())[0]
+        
+        for window_start in range(0, max_id, MIGRATION_BATCH_SIZE):
+            await self.connection.execute('''
+                INSERT INTO messages_fts (rowid, message_text)
+                SELECT id, message_text FROM message_records
+                WHERE id > ? AND id <= ?
+            ''', (window_start, window_start + MIGRATION_BATCH_SIZE))
+            await self.connection.commit()
+        
+        if max_id:
+            print(f"Миграция: построен полнотекстовый индекс сообщений (до id {max_id})")
+
+    async def _migrate_chat_stats(self):
+        """
+        Миграция 4: счетчики chat_stats, chat_users и db_counters
+        
+        Счетчики заполняются по существующим сообщениям окнами по id,
+        дальше их поддерживают триггеры.
+        """
+        cursor = await self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM message_records')
+        max_id = (await cursor.fetchone())[0]
+        
+        for window_start in range(0, max_id, MIGRATION_BATCH_SIZE):
+            window = (window_start, window_start + MIGRATION_BATCH_SIZE)
+            
+            await self.connection.execute('''
+                INSERT INTO chat_stats (chat_id, message_count, first_date, last_date)
+                SELECT chat_id, COUNT(*), MIN(date), MAX(date)
+                FROM message_records
+                WHERE id > ? AND id <= ?
+                GROUP BY chat_id
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    message_count = message_count + excluded.message_count,
+                    first_date = MIN(COALESCE(first_date, excluded.first_date),
+                                     COALESCE(excluded.first_date, first_date)),
+                    last_date = MAX(COALESCE(last_date, excluded.last_date),
+                                    COALESCE(excluded.last_date, last_date))
+            ''', window)
+            
+            await self.connection.execute('''
+                INSERT OR IGNORE INTO chat_users (chat_id, user_id)
+                SELECT DISTINCT chat_id, user_id FROM message_records
+                WHERE id > ? AND id <= ? AND user_id IS NOT NULL
+            ''', window)
+            await self.connection.commit()
+        
+        await self.connection.execute('''
+            UPDATE chat_stats SET user_count = (
+                SELECT COUNT(*) FROM chat_users WHERE chat_users.chat_id = chat_stats.chat_id
+            )
+        ''')
+        await self.connection.execute('''
+            INSERT OR REPLACE INTO db_counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+        ''')
+        await self.connection.commit()
+
+    async def _migrate_thread_index(self):
+        """
+        Миграция 5: индекс веток ответов message_threads
+        
+        Существующие сообщения (основной базы и разделов) проходят через тот же
+        запрос, что и при записи, пакетами с коммитом после каждого пакета.
+        Порядок сообщений не важен: ответы на еще не пройденные сообщения
+        переносятся в их ветку, когда до них доходит очередь.
+        """
+        sources = [None]
+        if self.partitioned:
+            sources += list(list_partitions(self.db_path).values())
+        
+        total = 0
+        for path in sources:
+            source = self.connection if path is None else await aiosqlite.connect(path)
+            try:
+                last_id = 0
+                while True:
+                    cursor = await source.execute('''
+                        SELECT id, chat_id, message_id, reply_to_message_id
+                        FROM message_records WHERE id > ? ORDER BY id LIMIT ?
+                    ''', (last_id, MIGRATION_BATCH_SIZE))
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    await self.connection.executemany(self.THREAD_INSERT_SQL, [row[1:] for row in rows])
+                    await self.connection.commit()
+                    total += len(rows)
+            finally:
+                if path is not None:
+                    await source.close()
+        
+        if total:
+            print(f"Миграция: построен индекс веток ответов ({total} сообщений)")
+
+    async def _load_dictionaries(self):
+        """Словари сжатия из базы в кодек"""
+        if not await self._is_table('compression_dicts'):
+            return
+        cursor = await self.connection.execute('SELECT id, kind, dictionary FROM compression_dicts')
+        self.codec.load(await cursor.fetchall())
+
+    def _read_dictionaries_sync(self) -> List[tuple]:
+        """Словари сжатия отдельным соединением (вызывается из msg_decode внутри запроса)"""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
         try:
-            await cursor.execute('''
-                INSERT INTO messages (
-                    message_id, chat_id, chat_title, chat_type,
-                    user_id, username, first_name, last_name,
-                    message_text, date, is_reply, reply_to_message_id,
-                    has_media, media_type, raw_data
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                message_data.get('message_id'),
-                message_data.get('chat_id'),
-                message_data.get('chat_title'),
-                message_data.get('chat_type'),
-                message_data.get('user_id'),
-                message_data.get('username'),
-                message_data.get('first_name'),
-                message_data.get('last_name'),
-                message_data.get('message_text'),
-                message_data.get('date'),
-                message_data.get('is_reply', 0),
-                message_data.get('reply_to_message_id'),
-                message_data.get('has_media', 0),
-                message_data.get('media_type'),
-                json.dumps(message_data.get('raw_data', {}))
-            ))
+            return connection.execute('SELECT id, kind, dictionary FROM compression_dicts').fetchall()
+        finally:
+            connection.close()
+
+    async def train_compression_dictionaries(self, sample_size: int = STORAGE_COMPRESSION_SAMPLE) -> Dict[str, int]:
+        """
+        Обучение словарей сжатия на последних сообщениях базы
+        
+        Новые словари используются для новых значений; старые остаются в базе,
+        потому что ими сжаты уже записанные значения. Возвращает размеры словарей.
+        """
+        cursor = await self.connection.execute(
+            'SELECT message_text, raw_data FROM messages ORDER BY id DESC LIMIT ?', (sample_size,)
+        )
+        rows = await cursor.fetchall()
+        if not rows:
+            raise RuntimeError("В базе нет сообщений для обучения словарей сжатия")
+        
+        dictionaries = {
+            TEXT: train_text_dictionary(text for text, _ in rows),
+            RAW: train_raw_dictionary(compact_json(json.loads(raw)) for _, raw in rows if raw),
+        }
+        for kind, dictionary in dictionaries.items():
+            await self.connection.execute(
+                'INSERT INTO compression_dicts (kind, dictionary) VALUES (?, ?)', (kind, dictionary)
+            )
+        await self.connection.commit()
+        await self._load_dictionaries()
+        return {kind: len(dictionary) for kind, dictionary in dictionaries.items()}
+
+    async def _rebuild_views_and_triggers(self):
+        """
+        Пересоздание объектов, читающих message_text, под текущий режим хранения
+        
+        В сжатой базе полнотекстовый индекс берет текст из представления
+        message_texts (иначе snippet() показал бы сжатые байты), поэтому при
+        первом включении сжатия индекс строится заново.
+        """
+        await self.connection.execute('BEGIN IMMEDIATE')
+        for name in self.DECODING_TRIGGERS:
+            await self.connection.execute(f'DROP TRIGGER IF EXISTS main.{name}')
+        for name in self.DECODING_VIEWS:
+            await self.connection.execute(f'DROP VIEW IF EXISTS main.{name}')
+        
+        cursor = await self.connection.execute(
+            "SELECT sql FROM main.sqlite_master WHERE name = 'messages_fts'"
+        )
+        fts_sql = (await cursor.fetchone())[0]
+        if self.codec.active and 'message_texts' not in fts_sql:
+            await self.connection.execute('DROP TABLE main.messages_fts')
+            await self.connection.execute('''
+                CREATE VIRTUAL TABLE messages_fts USING fts5(
+                    message_text,
+                    content = 'message_texts',
+                    content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            ''')
+            await self._create_views_and_triggers()
+            await self.connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            print("Полнотекстовый индекс перестроен по представлению message_texts")
+        else:
+            await self._create_views_and_triggers()
+        await self.connection.commit()
+
+    async def _recode_messages(self) -> int:
+        """
+        Перепаковка message_text и raw_data текущими словарями (или распаковка,
+        если словарей нет) окнами по id; возвращает число измененных строк
+        """
+        changed = 0
+        last_id = -1
+        
+        # Окна по порядку id, а не по диапазонам: в помесячных разделах id
+        # начинаются с большого базового значения
+        while True:
+            cursor = await self.connection.execute('''
+                SELECT id, message_text, raw_data FROM message_records
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, MIGRATION_BATCH_SIZE))
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for row_id, text, raw in rows:
+                new_text, new_raw = self._encode_columns(
+                    self.codec.decode(text), self.codec.decode(raw)
+                )
+                if (new_text, new_raw) != (text, raw):
+                    updates.append((new_text, new_raw, row_id))
             
+            await self.connection.executemany(
+                'UPDATE message_records SET message_text = ?, raw_data = ? WHERE id = ?', updates
+            )
             await self.connection.commit()
-            return cursor.lastrowid
-        except Exception as e:
-            print(f"Ошибка при сохранении сообщения: {e}")
-            await self.connection.rollback()
-            return None
+            changed += len(updates)
+            print(f"Перепаковано {changed} сообщений (до id {last_id})")
+        
+        return changed
 
-    async def save_chat(self, chat_data: Dict):
-        """Сохранение информации о чате"""
-        cursor = await self.connection.cursor()
+    def _encode_columns(self, text: Optional[str], raw: Optional[str]) -> tuple:
+        """Текст и JSON raw_data -> значения для записи в текущем режиме хранения"""
+        if not self.codec.active or raw is None:
+            return self.codec.encode(TEXT, text), raw
+        return self.codec.encode(TEXT, text), self.codec.encode(RAW, compact_json(json.loads(raw)))
+
+    async def compress_storage(self, sample_size: int = STORAGE_COMPRESSION_SAMPLE) -> int:
+        """Включение сжатия: словари (если их еще нет), схема и перепаковка сообщений"""
+        if not self.codec.active:
+            sizes = await self.train_compression_dictionaries(sample_size)
+            print(f"Обучены словари сжатия: {sizes}")
+        await self._rebuild_views_and_triggers()
+        return await self._recode_messages()
+
+    async def decompress_storage(self) -> int:
+        """Выключение сжатия: все значения распаковываются, словари удаляются"""
+        # Новые значения не сжимаются, но словари нужны msg_decode до конца распаковки
+        self.codec.current = {}
+        changed = await self._recode_messages()
         
+        await self.connection.execute('DELETE FROM compression_dicts')
+        await self.connection.commit()
+        self.codec.load([])
+        await self._rebuild_views_and_triggers()
+        return changed
+
+    # Столбцы message_records в порядке объявления (для объединения разделов)
+    MESSAGE_RECORD_COLUMNS = (
+        'id, message_id, chat_id, user_id, message_text, date, is_reply, '
+        'reply_to_message_id, has_media, media_type, raw_data, edit_date, created_at'
+    )
+
+    def segments(self, connection: Optional[aiosqlite.Connection] = None) -> List[str]:
+        """Схемы с сообщениями, видимые соединению: main и подключенные разделы"""
+        connection = connection or self.connection
+        months = self._attached.get(id(connection), (None, []))[1]
+        return ['main'] + [schema_name(month) for month in months]
+
+    def _partitions(self) -> Dict[str, str]:
+        """Файлы разделов (list_partitions); каталог перечитывается, только когда меняется _partitions_version"""
+        if self._partitions_cache is None or self._partitions_cache[0] != self._partitions_version:
+            self._partitions_cache = (self._partitions_version, list_partitions(self.db_path))
+        return self._partitions_cache[1]
+
+    async def _attach_partitions(self, connection: aiosqlite.Connection,
+                                 required: Tuple[str, ...] = (), read_only: bool = False):
+        """
+        Подключение разделов к соединению и временные представления поверх них
+        
+        Подключаются разделы из required (куда идет запись) и самые новые
+        остальные, всего не больше MAX_ATTACHED. Временные представления
+        messages и chat_stats закрывают одноименные объекты основной базы,
+        поэтому запросы экспорта и статистики видят все подключенные разделы.
+        """
+        available = self._partitions()
+        newest = [month for month in reversed(available) if month not in required]
+        months = sorted(list(required) + newest[:MAX_ATTACHED - len(required)])
+        if len(available) > MAX_ATTACHED and not self._attach_limit_reported:
+            self._attach_limit_reported = True
+            print(f"Разделов больше {MAX_ATTACHED}: статистика и поиск подключают их по очереди, "
+                  "а полный экспорт недоступен - настройте DATABASE_RETENTION_MONTHS")
+        
+        state = (self._partitions_version, months)
+        if self._attached.get(id(connection)) == state:
+            return
+        attached = self._attached.get(id(connection), (None, []))[1]
+        
+        # ATTACH и DETACH невозможны внутри транзакции
+        if connection.in_transaction:
+            await connection.commit()
+        await connection.execute('DROP VIEW IF EXISTS temp.messages')
+        await connection.execute('DROP VIEW IF EXISTS temp.chat_stats')
+        for month in attached:
+            if month not in months:
+                await connection.execute(f'DETACH DATABASE {schema_name(month)}')
+        for month in months:
+            if month not in attached:
+                path = available[month]
+                if read_only:
+                    path = f"{Path(path).resolve().as_uri()}?mode=ro"
+                await connection.execute(f'ATTACH DATABASE ? AS {schema_name(month)}', (path,))
+        self._attached[id(connection)] = state
+        
+        if months:
+            await self._create_partition_views(connection)
+
+    def all_partitions_attached(self, connection: Optional[aiosqlite.Connection] = None) -> bool:
+        """Видят ли представления messages и chat_stats соединения все разделы"""
+        if not self.partitioned:
+            return True
+        connection = connection or self.connection
+        attached = self._attached.get(id(connection), (None, []))[1]
+        return set(self._partitions()) <= set(attached)
+
+    def require_all_partitions(self, connection: Optional[aiosqlite.Connection] = None):
+        """
+        Проверка перед запросами ко всей базе через представления messages и chat_stats
+        
+        Если разделов больше MAX_ATTACHED, представления видят только часть
+        месяцев, и экспорт молча потерял бы остальные - вместо этого RuntimeError.
+        """
+        if self.all_partitions_attached(connection):
+            return
+        count = len(self._partitions())
+        raise RuntimeError(
+            f"Разделов {count}, а к соединению SQLite подключается не больше {MAX_ATTACHED}: "
+            "результат был бы неполным. Перенесите старые разделы в архив "
+            "(DATABASE_RETENTION_MONTHS и python partitions.py retention) и выгрузите архивные "
+            "файлы отдельно (DATABASE_PATH=archive/...)"
+        )
+
+    async def _segment_groups(self, connection: aiosqlite.Connection) -> AsyncIterator[List[str]]:
+        """
+        Схемы сегментов (main и разделы) группами, которые подключены одновременно
+        
+        Обычно все разделы уже подключены, и группа одна. Иначе разделы
+        подключаются к соединению по очереди, по MAX_ATTACHED; main входит
+        в первую группу. Результаты групп вызывающий объединяет сам.
+        """
+        if self.all_partitions_attached(connection):
+            yield self.segments(connection)
+            return
+        months = list(self._partitions())
+        read_only = self.read_only or connection is not self.connection
+        for start in range(0, len(months), MAX_ATTACHED):
+            group = tuple(months[start:start + MAX_ATTACHED])
+            await self._attach_partitions(connection, group, read_only=read_only)
+            yield (['main'] if start == 0 else []) + [schema_name(month) for month in group]
+
+    async def _create_partition_views(self, connection: aiosqlite.Connection):
+        segments = self.segments(connection)
+        records = ' UNION ALL '.join(
+            f'SELECT {self.MESSAGE_RECORD_COLUMNS} FROM {schema}.message_records' for schema in segments
+        )
+        await connection.execute(self._messages_view_sql(f'({records})', temp=True))
+        
+        # Счетчики каждого раздела ведут его триггеры; здесь они складываются
+        stats = ' UNION ALL '.join(
+            f'SELECT chat_id, message_count, first_date, last_date FROM {schema}.chat_stats'
+            for schema in segments
+        )
+        users = ' UNION ALL '.join(f'SELECT chat_id, user_id FROM {schema}.chat_users' for schema in segments)
+        await connection.execute(f'''
+            CREATE TEMP VIEW chat_stats AS
+            SELECT s.chat_id, SUM(s.message_count) AS message_count,
+                   COALESCE(u.user_count, 0) AS user_count,
+                   MIN(s.first_date) AS first_date, MAX(s.last_date) AS last_date
+            FROM ({stats}) s
+            LEFT JOIN (
+                SELECT chat_id, COUNT(DISTINCT user_id) AS user_count
+                FROM ({users})
+                GROUP BY chat_id
+            ) u ON u.chat_id = s.chat_id
+            GROUP BY s.chat_id
+        ''')
+
+    async def _ensure_partition(self, month: str):
+        """Файл раздела месяца: создается со схемой основной базы"""
+        if month in self._partitions():
+            return
+        path = partition_path(self.db_path, month)
+        if os.path.exists(path):
+            # Раздел создан другим процессом: список разделов нужно перечитать
+            self._partitions_version += 1
+            return
+        
+        partition = MessageDatabase(path, readers=0, wal=self.wal, partitioned=False)
+        await partition.connect()
         try:
-            await cursor.execute('''
-                INSERT OR REPLACE INTO chats (
+            # id раздела начинаются со своего значения и не пересекаются с другими файлами
+            base = id_base(month)
+            await partition.connection.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('message_records', ?), ('message_edits', ?)",
+                (base, base)
+            )
+            await partition.connection.commit()
+            if self.codec.active:
+                await self.share_dictionaries(partition)
+        finally:
+            await partition.close()
+        
+        self._partitions_version += 1
+        print(f"Создан раздел {month}: {path}")
+        # Начался новый месяц: старые разделы уходят по политике хранения
+        if month == current_month():
+            await self.apply_retention()
+
+    async def share_dictionaries(self, target: 'MessageDatabase'):
+        """Словари сжатия основной базы в разделе (с теми же ID)"""
+        for dictionary_id, (kind, dictionary) in self.codec.dictionaries.items():
+            await target.connection.execute(
+                'INSERT OR IGNORE INTO compression_dicts (id, kind, dictionary) VALUES (?, ?, ?)',
+                (dictionary_id, kind, dictionary)
+            )
+        await target.connection.commit()
+        await target._load_dictionaries()
+        await target._rebuild_views_and_triggers()
+
+    async def _insert_batches(self, rows: List[tuple]) -> List[Tuple[Tuple[str, ...], List[Tuple[str, List[tuple]]]]]:
+        """
+        Строки сообщений -> пакеты записи [(месяцы, [(SQL, строки), ...])]
+        
+        Без разделов пакет один и пишет в основную базу. С разделами строки
+        группируются по месяцу даты сообщения; в пакете не больше
+        MAX_ATTACHED месяцев, чтобы все его разделы можно было подключить.
+        """
+        if not self.partitioned:
+            return [((), [(self.INSERT_MESSAGE_SQL.format(table='message_records'), rows)])]
+        
+        by_month: Dict[str, List[tuple]] = {}
+        for row in rows:
+            by_month.setdefault(month_of(row[4]), []).append(row)
+        for month in by_month:
+            await self._ensure_partition(month)
+        
+        months = sorted(by_month)
+        return [
+            (tuple(chunk), [
+                (self.INSERT_MESSAGE_SQL.format(table=f'{schema_name(month)}.message_records'), by_month[month])
+                for month in chunk
+            ])
+            for chunk in (months[i:i + MAX_ATTACHED] for i in range(0, len(months), MAX_ATTACHED))
+        ]
+
+    async def apply_retention(self, months: int = DATABASE_RETENTION_MONTHS,
+                              action: str = DATABASE_RETENTION_ACTION) -> List[str]:
+        """
+        Архивирование или удаление разделов старше months месяцев
+        
+        Текущий раздел не затрагивается. Архивный раздел самодостаточен: в него
+        копируются чаты и авторы его сообщений, и его можно открыть как
+        обычную базу (DATABASE_PATH=archive/messages.2024-01.db).
+        """
+        if not self.partitioned or months <= 0:
+            return []
+        oldest = shift_month(current_month(), -(months - 1))
+        expired = {month: path for month, path in list_partitions(self.db_path).items() if month < oldest}
+        if not expired:
+            return []
+        
+        # Запись ждет конца архивирования: иначе она подключила бы переносимый раздел
+        async with self._write_lock:
+            # Раздел отключается от соединения записи; читатели переподключат
+            # разделы при следующем запросе
+            attached = self._attached.get(id(self.connection), (None, []))[1]
+            if any(month in expired for month in attached):
+                if self.connection.in_transaction:
+                    await self.connection.commit()
+                await self.connection.execute('DROP VIEW IF EXISTS temp.messages')
+                await self.connection.execute('DROP VIEW IF EXISTS temp.chat_stats')
+                for month in attached:
+                    await self.connection.execute(f'DETACH DATABASE {schema_name(month)}')
+                self._attached.pop(id(self.connection))
+        
+            for month, path in expired.items():
+                if action == 'drop':
+                    remove_database_file(path)
+                    print(f"Раздел {month} удален (хранится {months} мес.)")
+                else:
+                    await self._make_self_contained(path)
+                    target = archive_database_file(path, DATABASE_ARCHIVE_DIR)
+                    print(f"Раздел {month} перенесен в архив: {target}")
+        
+            self._partitions_version += 1
+            if self.connection and id(self.connection) not in self._attached and attached:
+                await self._attach_partitions(self.connection)
+        return list(expired)
+
+    async def _make_self_contained(self, path: str):
+        """Копирование чатов, авторов и веток ответов раздела из основной базы в файл раздела"""
+        partition = await aiosqlite.connect(path)
+        try:
+            await partition.execute('ATTACH DATABASE ? AS source', (self.db_path,))
+            await partition.execute('''
+                INSERT OR IGNORE INTO chats (
                     chat_id, chat_title, chat_type, participants_count,
-                    last_activity, metadata
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                chat_data.get('chat_id'),
-                chat_data.get('chat_title'),
-                chat_data.get('chat_type'),
-                chat_data.get('participants_count'),
-                datetime.now().isoformat(),
-                json.dumps(chat_data.get('metadata', {}))
-            ))
+                    first_seen, last_activity, metadata
+                )
+                SELECT chat_id, chat_title, chat_type, participants_count,
+                       first_seen, last_activity, metadata
+                FROM source.chats
+                WHERE chat_id IN (SELECT chat_id FROM chat_stats)
+            ''')
+            await partition.execute('''
+                INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, first_seen, updated_at)
+                SELECT user_id, username, first_name, last_name, first_seen, updated_at
+                FROM source.users
+                WHERE user_id IN (SELECT user_id FROM chat_users)
+            ''')
+            # Разделы старых версий без этой таблицы построят индекс миграцией при открытии
+            cursor = await partition.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_threads'"
+            )
+            if await cursor.fetchone():
+                await partition.execute('''
+                    INSERT OR IGNORE INTO message_threads (chat_id, message_id, parent_id, root_id, depth)
+                    SELECT t.chat_id, t.message_id, t.parent_id, t.root_id, t.depth
+                    FROM message_records m
+                    JOIN source.message_threads t ON t.chat_id = m.chat_id AND t.message_id = m.message_id
+                ''')
+            await partition.commit()
+            await partition.execute('DETACH DATABASE source')
+            await partition.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            await partition.close()
+
+    async def split_into_partitions(self) -> int:
+        """
+        Перенос сообщений основной базы в разделы по месяцам
+        
+        Сообщения переносятся окнами по id вместе с историей правок и с
+        прежними id; в разделах их индексируют и считают свои триггеры.
+        Если сообщение уже есть в разделе, остается версия раздела.
+        """
+        cursor = await self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM main.message_records')
+        max_id = (await cursor.fetchone())[0]
+        moved = 0
+        
+        for window_start in range(0, max_id, MIGRATION_BATCH_SIZE):
+            cursor = await self.connection.execute(
+                'SELECT id, date FROM main.message_records WHERE id > ? AND id <= ?',
+                (window_start, window_start + MIGRATION_BATCH_SIZE)
+            )
+            ids_by_month: Dict[str, List[int]] = {}
+            for row_id, date in await cursor.fetchall():
+                ids_by_month.setdefault(month_of(date), []).append(row_id)
             
+            for month, ids in sorted(ids_by_month.items()):
+                await self._ensure_partition(month)
+                await self._attach_partitions(self.connection, (month,))
+                schema = schema_name(month)
+                ids_json = json.dumps(ids)
+                
+                await self.connection.execute(f'''
+                    INSERT OR IGNORE INTO {schema}.message_records ({self.MESSAGE_RECORD_COLUMNS})
+                    SELECT {self.MESSAGE_RECORD_COLUMNS} FROM main.message_records
+                    WHERE id IN (SELECT value FROM json_each(?))
+                ''', (ids_json,))
+                await self.connection.execute(f'''
+                    INSERT INTO {schema}.message_edits (chat_id, message_id, old_text, edit_date, created_at)
+                    SELECT e.chat_id, e.message_id, e.old_text, e.edit_date, e.created_at
+                    FROM main.message_edits e
+                    JOIN main.message_records r ON r.chat_id = e.chat_id AND r.message_id = e.message_id
+                    WHERE r.id IN (SELECT value FROM json_each(?))
+                    ORDER BY e.id
+                ''', (ids_json,))
+                await self.connection.execute('''
+                    DELETE FROM main.message_edits WHERE id IN (
+                        SELECT e.id
+                        FROM main.message_edits e
+                        JOIN main.message_records r ON r.chat_id = e.chat_id AND r.message_id = e.message_id
+                        WHERE r.id IN (SELECT value FROM json_each(?))
+                    )
+                ''', (ids_json,))
+                await self.connection.execute(
+                    'DELETE FROM main.message_records WHERE id IN (SELECT value FROM json_each(?))', (ids_json,)
+                )
+                await self.connection.commit()
+                moved += len(ids)
+            print(f"Перенесено в разделы {moved} сообщений (до id {min(window_start + MIGRATION_BATCH_SIZE, max_id)})")
+        
+        # Счетчики сообщений основной базы теперь пусты; авторы и даты в них устарели
+        cursor = await self.connection.execute('SELECT COUNT(*) FROM main.message_records')
+        if not (await cursor.fetchone())[0]:
+            await self.connection.execute('DELETE FROM main.chat_stats')
+            await self.connection.execute('DELETE FROM main.chat_users')
             await self.connection.commit()
+        return moved
+
+    # Повторное сохранение того же сообщения (повторный парсинг, правка)
+    # обновляет существующую строку вместо создания копии
+    INSERT_MESSAGE_SQL = '''
+        INSERT INTO {table} (
+            message_id, chat_id, user_id,
+            message_text, date, is_reply, reply_to_message_id,
+            has_media, media_type, raw_data, edit_date
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, message_id) DO UPDATE SET
+            user_id = COALESCE(excluded.user_id, message_records.user_id),
+            message_text = excluded.message_text,
+            is_reply = excluded.is_reply,
+            reply_to_message_id = excluded.reply_to_message_id,
+            has_media = excluded.has_media,
+            media_type = excluded.media_type,
+            raw_data = excluded.raw_data,
+            edit_date = COALESCE(excluded.edit_date, message_records.edit_date)
+    '''
+
+    # Место сообщения в ветке ответов. Если родитель уже записан, сообщение
+    # получает его корень и глубину + 1. Если нет (при загрузке истории ответы
+    # приходят раньше исходных сообщений), корнем временно считается сам
+    # родитель: триггер trg_message_threads_reroot перенесет ветку, когда он
+    # будет записан. Правка не меняет, на что отвечает сообщение, поэтому
+    # существующая строка не обновляется
+    THREAD_INSERT_SQL = '''
+        INSERT INTO main.message_threads (chat_id, message_id, parent_id, root_id, depth)
+        SELECT ?1, ?2, ?3, COALESCE(p.root_id, ?3, ?2),
+               CASE WHEN ?3 IS NULL THEN 0 ELSE COALESCE(p.depth, 0) + 1 END
+        FROM (SELECT 1)
+        LEFT JOIN main.message_threads p ON p.chat_id = ?1 AND p.message_id = ?3
+        WHERE 1
+        ON CONFLICT(chat_id, message_id) DO NOTHING
+    '''
+
+    # Имя автора обновляется (и попадает в историю) только если изменилось
+    UPSERT_USER_SQL = '''
+        INSERT INTO users (user_id, username, first_name, last_name, first_seen, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            updated_at = excluded.updated_at
+        WHERE users.username IS NOT excluded.username
+           OR users.first_name IS NOT excluded.first_name
+           OR users.last_name IS NOT excluded.last_name
+    '''
+
+    # Сколько авторов помнить в памяти, чтобы не повторять запись неизменных имен
+    KNOWN_USERS_LIMIT = 100000
+
+    def _message_row(self, message_data: Dict) -> tuple:
+        """Преобразование словаря сообщения в строку для INSERT"""
+        if self.codec.active:
+            message_text = self.codec.encode(TEXT, message_data.get('message_text'))
+            raw_data = self.codec.encode(RAW, compact_json(message_data.get('raw_data', {})))
+        else:
+            message_text = message_data.get('message_text')
+            raw_data = json.dumps(message_data.get('raw_data', {}))
+        return (
+            message_data.get('message_id'),
+            message_data.get('chat_id'),
+            message_data.get('user_id'),
+            message_text,
+            message_data.get('date'),
+            message_data.get('is_reply', 0),
+            message_data.get('reply_to_message_id'),
+            message_data.get('has_media', 0),
+            message_data.get('media_type'),
+            raw_data,
+            message_data.get('edit_date')
+        )
+
+    def _changed_user_rows(self, messages: List[Dict]) -> List[tuple]:
+        """Строки для UPSERT_USER_SQL: только авторы, чье имя еще не записано"""
+        rows = {}
+        now = datetime.now().isoformat()
+        for message_data in messages:
+            user_id = message_data.get('user_id')
+            if user_id is None:
+                continue
+            names = (
+                message_data.get('username'),
+                message_data.get('first_name'),
+                message_data.get('last_name'),
+            )
+            # Без имени (автор неизвестен) нечего сохранять
+            if names == (None, None, None) or self._known_users.get(user_id) == names:
+                continue
+            rows[user_id] = (user_id, *names, now, now)
+        return list(rows.values())
+
+    def _remember_users(self, user_rows: List[tuple]):
+        if len(self._known_users) > self.KNOWN_USERS_LIMIT:
+            self._known_users.clear()
+        for row in user_rows:
+            self._known_users[row[0]] = row[1:4]
+
+    async def _retry_locked(self, attempt: int, error: Exception) -> bool:
+        """Пауза перед повтором записи, если база была занята; False - больше не повторять"""
+        if not is_locked_error(error) or attempt >= WRITE_RETRIES:
+            return False
+        DB_WRITE_RETRIES.inc()
+        print(f"База занята, повтор записи ({attempt}/{WRITE_RETRIES}): {error}")
+        await asyncio.sleep(0.1 * 2 ** attempt)
+        return True
+
+    @asynccontextmanager
+    async def _write_transaction(self):
+        """
+        Транзакция на соединении записи
+        
+        Соединение записи одно на все корутины, поэтому их транзакции идут
+        по очереди: иначе rollback одной корутины откатил бы незавершенную
+        транзакцию другой, а commit (в том числе перед ATTACH) - зафиксировал
+        бы ее. При выходе из блока транзакция фиксируется, при исключении -
+        откатывается.
+        """
+        async with self._write_lock:
+            try:
+                yield self.connection
+                await self.connection.commit()
+            except BaseException:
+                await self.connection.rollback()
+                raise
+
+    async def save_message(self, message_data: Dict):
+        """Сохранение сообщения в базу данных"""
+        cursor = await self.connection.cursor()
+        
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                # Одна строка - всегда один пакет (основная база или раздел ее месяца)
+                months, [(insert_sql, rows)] = (await self._insert_batches([self._message_row(message_data)]))[0]
+                with DB_WRITE_SECONDS.time():
+                    async with self._write_transaction():
+                        if self.partitioned:
+                            await self._attach_partitions(self.connection, months)
+                        user_rows = self._changed_user_rows([message_data])
+                        if user_rows:
+                            await cursor.execute(self.UPSERT_USER_SQL, user_rows[0])
+                        await cursor.execute(insert_sql, rows[0])
+                        await self.connection.execute(self.THREAD_INSERT_SQL, (
+                            message_data.get('chat_id'),
+                            message_data.get('message_id'),
+                            message_data.get('reply_to_message_id'),
+                        ))
+                self._remember_users(user_rows)
+                DB_MESSAGES_WRITTEN.inc()
+                return cursor.lastrowid
+            except Exception as e:
+                if await self._retry_locked(attempt, e):
+                    continue
+                print(f"Ошибка при сохранении сообщения: {e}")
+                return None
+
+    async def save_messages(self, messages: List[Dict]) -> int:
+        """
+        Пакетное сохранение сообщений одной транзакцией
+        
+        В отличие от save_message не перехватывает ошибки: при сбое
+        транзакция откатывается и исключение пробрасывается вызывающему,
+        чтобы он мог решить, что делать с пакетом. Если база занята другим
+        процессом, запись повторяется до WRITE_RETRIES раз.
+        """
+        if not messages:
+            return 0
+        
+        user_rows = self._changed_user_rows(messages)
+        message_rows = [self._message_row(message_data) for message_data in messages]
+        thread_rows = [
+            (message_data.get('chat_id'), message_data.get('message_id'), message_data.get('reply_to_message_id'))
+            for message_data in messages
+        ]
+        # Без разделов пакет один; с разделами - по группе месяцев
+        for index, (months, inserts) in enumerate(await self._insert_batches(message_rows)):
+            for attempt in range(1, WRITE_RETRIES + 1):
+                try:
+                    with DB_WRITE_SECONDS.time():
+                        async with self._write_transaction():
+                            if self.partitioned:
+                                await self._attach_partitions(self.connection, months)
+                            if user_rows and index == 0:
+                                await self.connection.executemany(self.UPSERT_USER_SQL, user_rows)
+                            for insert_sql, rows in inserts:
+                                await self.connection.executemany(insert_sql, rows)
+                            if index == 0:
+                                await self.connection.executemany(self.THREAD_INSERT_SQL, thread_rows)
+                    break
+                except Exception as e:
+                    if not await self._retry_locked(attempt, e):
+                        raise
+        
+        self._remember_users(user_rows)
+        DB_MESSAGES_WRITTEN.inc(len(messages))
+        return len(messages)
+
+    async def save_chat(self, chat_data: Dict) -> bool:
+        """Сохранение информации о чате (first_seen при обновлении не меняется); False - запись не удалась"""
+        try:
+            async with self._write_transaction() as connection:
+                await connection.execute('''
+                    INSERT INTO chats (
+                        chat_id, chat_title, chat_type, participants_count,
+                        last_activity, metadata
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                        chat_title = excluded.chat_title,
+                        chat_type = excluded.chat_type,
+                        participants_count = COALESCE(excluded.participants_count, chats.participants_count),
+                        last_activity = excluded.last_activity,
+                        metadata = excluded.metadata
+                ''', (
+                    chat_data.get('chat_id'),
+                    chat_data.get('chat_title'),
+                    chat_data.get('chat_type'),
+                    chat_data.get('participants_count'),
+                    datetime.now().isoformat(),
+                    json.dumps(chat_data.get('metadata', {}))
+                ))
+            return True
         except Exception as e:
             print(f"Ошибка при сохранении чата: {e}")
-            await self.connection.rollback()
+            return False
+
+    async def update_chats_activity(self, activity: List[Tuple[int, str]]):
+        """Пакетное обновление времени последней активности: [(chat_id, last_activity), ...]"""
+        if not activity:
+            return
+        async with self._write_transaction() as connection:
+            await connection.executemany(
+                'UPDATE chats SET last_activity = ? WHERE chat_id = ?',
+                [(last_activity, chat_id) for chat_id, last_activity in activity]
+            )
+
+    async def get_parse_state(self, chat_id: int) -> Optional[Dict]:
+        """Получение контрольной точки парсинга чата"""
+        cursor = await self.connection.execute('''
+            SELECT min_message_id, max_message_id, backfill_complete
+            FROM parse_state WHERE chat_id = ?
+        ''', (chat_id,))
+        row = await cursor.fetchone()
+        if not row:
+            return None
+        return {
+            'min_message_id': row[0],
+            'max_message_id': row[1],
+            'backfill_complete': row[2],
+        }
+
+    async def save_parse_state(self, chat_id: int, min_message_id: Optional[int],
+                               max_message_id: Optional[int], backfill_complete: int = 0):
+        """Сохранение контрольной точки парсинга чата"""
+        async with self._write_transaction() as connection:
+            await connection.execute('''
+                INSERT INTO parse_state (
+                    chat_id, min_message_id, max_message_id, backfill_complete, updated_at
+                ) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    min_message_id = excluded.min_message_id,
+                    max_message_id = excluded.max_message_id,
+                    backfill_complete = excluded.backfill_complete,
+                    updated_at = excluded.updated_at
+            ''', (
+                chat_id,
+                min_message_id,
+                max_message_id,
+                backfill_complete,
+                datetime.now().isoformat()
+            ))
+
+    async def add_parse_failures(self, chat_id: int, message_ids: List[int]):
+        """Запоминание сообщений, которые не удалось сохранить (повтор - следующим запуском)"""
+        now = datetime.now().isoformat()
+        async with self._write_transaction() as connection:
+            await connection.executemany('''
+                INSERT INTO parse_failures (chat_id, message_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id, message_id) DO UPDATE SET
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at
+            ''', [(chat_id, message_id, now) for message_id in message_ids])
+
+    async def get_parse_failures(self, chat_id: int) -> List[int]:
+        """message_id сообщений чата, ожидающих повторной загрузки"""
+        cursor = await self.connection.execute(
+            'SELECT message_id FROM parse_failures WHERE chat_id = ? ORDER BY message_id', (chat_id,)
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+    async def remove_parse_failures(self, chat_id: int, message_ids: List[int]):
+        async with self._write_transaction() as connection:
+            await connection.executemany(
+                'DELETE FROM parse_failures WHERE chat_id = ? AND message_id = ?',
+                [(chat_id, message_id) for message_id in message_ids]
+            )
+
+    async def create_parse_job(self, chat_identifier: str, limit: Optional[int] = None,
+                               reply_to: Optional[Tuple[int, int]] = None) -> int:
+        """Новая задача парсинга; возвращает ее номер"""
+        reply_chat_id, reply_message_id = reply_to or (None, None)
+        async with self._write_transaction() as connection:
+            cursor = await connection.execute('''
+                INSERT INTO parse_jobs (chat_identifier, limit_count, reply_chat_id, reply_message_id)
+                VALUES (?, ?, ?, ?)
+            ''', (chat_identifier, limit, reply_chat_id, reply_message_id))
+        return cursor.lastrowid
+
+    async def update_parse_job(self, job_id: int, **fields):
+        """Обновление состояния задачи парсинга (status, parsed, errors, error, started_at, finished_at)"""
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        async with self._write_transaction() as connection:
+            await connection.execute(
+                f'UPDATE parse_jobs SET {columns} WHERE id = ?', (*fields.values(), job_id)
+            )
+
+    async def get_unfinished_parse_jobs(self) -> List[Dict]:
+        """Задачи, которые были в очереди или выполнялись при остановке userbot"""
+        cursor = await self.connection.execute('''
+            SELECT id, chat_identifier, limit_count, reply_chat_id, reply_message_id, parsed
+            FROM parse_jobs
+            WHERE status IN ('queued', 'running')
+            ORDER BY id
+        ''')
+        return [
+            {
+                'id': row[0],
+                'chat_identifier': row[1],
+                'limit_count': row[2],
+                'reply_to': (row[3], row[4]) if row[4] is not None else None,
+                'parsed': row[5] or 0,
+            }
+            for row in await cursor.fetchall()
+        ]
+
+    async def load_entities(self, limit: int) -> List[Dict]:
+        """Загрузка последних сохраненных сущностей кэша отправителей"""
+        cursor = await self.connection.execute('''
+            SELECT entity_id, kind, username, first_name, last_name, title, access_hash
+            FROM entity_cache
+            ORDER BY updated_at DESC
+            LIMIT ?
+        ''', (limit,))
+        columns = ['id', 'kind', 'username', 'first_name', 'last_name', 'title', 'access_hash']
+        return [dict(zip(columns, row)) for row in await cursor.fetchall()]
+
+    async def save_entities(self, entities: List[Dict]):
+        """Пакетное сохранение сущностей кэша отправителей"""
+        if not entities:
+            return
+        now = datetime.now().isoformat()
+        async with self._write_transaction() as connection:
+            await connection.executemany('''
+                INSERT OR REPLACE INTO entity_cache (
+                    entity_id, kind, username, first_name, last_name,
+                    title, access_hash, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (
+                    entity['id'],
+                    entity.get('kind'),
+                    entity.get('username'),
+                    entity.get('first_name'),
+                    entity.get('last_name'),
+                    entity.get('title'),
+                    entity.get('access_hash'),
+                    now
+                )
+                for entity in entities
+            ])
+
+    async def get_media(self, chat_id: int, message_id: int) -> Optional[Dict]:
+        """Запись о медиа сообщения"""
+        cursor = await self.connection.execute(
+            'SELECT file_key, sha256, status FROM media WHERE chat_id = ? AND message_id = ?',
+            (chat_id, message_id)
+        )
+        row = await cursor.fetchone()
+        return dict(zip(('file_key', 'sha256', 'status'), row)) if row else None
+
+    async def find_media_blob(self, file_key: str) -> Optional[Dict]:
+        """Файл хранилища, уже загруженный для этого ID файла Telegram"""
+        cursor = await self.connection.execute('''
+            SELECT b.sha256, b.size, b.mime_type, b.path
+            FROM media m
+            JOIN media_blobs b ON b.sha256 = m.sha256
+            WHERE m.file_key = ? AND m.status = 'stored'
+            LIMIT 1
+        ''', (file_key,))
+        row = await cursor.fetchone()
+        return dict(zip(('sha256', 'size', 'mime_type', 'path'), row)) if row else None
+
+    async def save_media_blob(self, blob: Dict):
+        """Сохранение файла хранилища (повторная запись того же хеша ничего не меняет)"""
+        async with self._write_transaction() as connection:
+            await connection.execute('''
+                INSERT OR IGNORE INTO media_blobs (sha256, size, mime_type, path)
+                VALUES (?, ?, ?, ?)
+            ''', (blob['sha256'], blob.get('size'), blob.get('mime_type'), blob['path']))
+
+    async def save_media(self, media: Dict):
+        """Связь сообщения с файлом хранилища или причина, по которой файла нет"""
+        try:
+            async with self._write_transaction() as connection:
+                await connection.execute('''
+                    INSERT INTO media (
+                        chat_id, message_id, media_type, file_key, sha256, status, error, updated_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id, message_id) DO UPDATE SET
+                        media_type = excluded.media_type,
+                        file_key = excluded.file_key,
+                        sha256 = excluded.sha256,
+                        status = excluded.status,
+                        error = excluded.error,
+                        updated_at = excluded.updated_at
+                ''', (
+                    media['chat_id'],
+                    media['message_id'],
+                    media.get('media_type'),
+                    media.get('file_key'),
+                    media.get('sha256'),
+                    media['status'],
+                    media.get('error'),
+                    datetime.now().isoformat()
+                ))
+        except Exception as e:
+            print(f"Ошибка при сохранении медиа: {e}")
+
+    async def get_media_stats(self) -> Dict:
+        """Сколько сообщений со ссылками на файлы и сколько места занимают файлы"""
+        async with self.reader() as connection:
+            cursor = await connection.execute('''
+                SELECT (SELECT COUNT(*) FROM media WHERE status = 'stored'),
+                       (SELECT COUNT(*) FROM media WHERE status = 'failed'),
+                       COUNT(*), COALESCE(SUM(size), 0)
+                FROM media_blobs
+            ''')
+            stored, failed, blobs, size = await cursor.fetchone()
+        return {'messages': stored, 'failed': failed, 'files': blobs, 'bytes': size}
 
     async def get_messages_count(self, chat_id: Optional[int] = None) -> int:
-        """Получение количества сохраненных сообщений"""
-        cursor = await self.connection.cursor()
+        """Получение количества сохраненных сообщений (по счетчикам chat_stats всех сегментов)"""
+        total = 0
+        async with self.reader() as connection:
+            async for schemas in self._segment_groups(connection):
+                for schema in schemas:
+                    if chat_id:
+                        cursor = await connection.execute(
+                            f'SELECT message_count FROM {schema}.chat_stats WHERE chat_id = ?', (chat_id,)
+                        )
+                    else:
+                        cursor = await connection.execute(f'SELECT SUM(message_count) FROM {schema}.chat_stats')
+                    result = await cursor.fetchone()
+                    total += (result[0] or 0) if result else 0
+        return total
+
+    async def get_stats(self, top: int = 10) -> Dict:
+        """
+        Сводная статистика по счетчикам
         
-        if chat_id:
-            await cursor.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,))
-        else:
-            await cursor.execute('SELECT COUNT(*) FROM messages')
+        Возвращает общее число сообщений, чатов и авторов и топ чатов
+        по числу сообщений. Время не зависит от числа сообщений в базе.
+        Счетчики каждого сегмента (main и разделов) складываются здесь,
+        поэтому учитываются и разделы сверх MAX_ATTACHED.
+        """
+        # chat_id -> [message_count, first_date, last_date]
+        chats: Dict[int, list] = {}
+        async with self.reader() as connection:
+            async for schemas in self._segment_groups(connection):
+                for schema in schemas:
+                    cursor = await connection.execute(
+                        f'SELECT chat_id, message_count, first_date, last_date FROM {schema}.chat_stats'
+                    )
+                    for chat_id, count, first_date, last_date in await cursor.fetchall():
+                        current = chats.setdefault(chat_id, [0, first_date, last_date])
+                        current[0] += count or 0
+                        if first_date and (current[1] is None or first_date < current[1]):
+                            current[1] = first_date
+                        if last_date and (current[2] is None or last_date > current[2]):
+                            current[2] = last_date
+            
+            top_chats = sorted(chats.items(), key=lambda item: item[1][0], reverse=True)[:top]
+            top_ids = json.dumps([chat_id for chat_id, _ in top_chats])
+            # Автор может писать в чат в разные месяцы: уникальные авторы по всем сегментам
+            authors: Dict[int, set] = {chat_id: set() for chat_id, _ in top_chats}
+            async for schemas in self._segment_groups(connection):
+                users = ' UNION '.join(
+                    f'SELECT chat_id, user_id FROM {schema}.chat_users '
+                    'WHERE chat_id IN (SELECT value FROM json_each(?1))'
+                    for schema in schemas
+                )
+                cursor = await connection.execute(users, (top_ids,))
+                for chat_id, user_id in await cursor.fetchall():
+                    authors[chat_id].add(user_id)
+            
+            cursor = await connection.execute(
+                'SELECT chat_id, chat_title FROM main.chats WHERE chat_id IN (SELECT value FROM json_each(?))',
+                (top_ids,)
+            )
+            titles = dict(await cursor.fetchall())
+            cursor = await connection.execute("SELECT value FROM main.db_counters WHERE name = 'users'")
+            total_users = await cursor.fetchone()
+        
+        return {
+            'total_messages': sum(count for count, _, _ in chats.values()),
+            'total_chats': len(chats),
+            'total_users': (total_users[0] or 0) if total_users else 0,
+            'top_chats': [
+                {
+                    'chat_id': chat_id,
+                    'chat_title': titles.get(chat_id) or f'chat_{chat_id}',
+                    'message_count': count,
+                    'user_count': len(authors[chat_id]),
+                    'first_date': first_date,
+                    'last_date': last_date,
+                }
+                for chat_id, (count, first_date, last_date) in top_chats
+            ],
+        }
+
+    async def search_messages(self, query: str, chat: Optional[str] = None,
+                              since: Optional[str] = None, limit: int = 20,
+                              offset: int = 0) -> List[Dict]:
+        """
+        Полнотекстовый поиск по сообщениям, лучшие совпадения первыми (bm25)
+        
+        Args:
+            query: слова для поиска (все должны встретиться; 'слово*' - поиск по префиксу)
+            chat: ID чата, @username или часть его названия
+            since: дата, начиная с которой искать (ГГГГ-ММ-ДД)
+            limit, offset: страница результатов
+        """
+        match = fts_query(query)
+        if not match:
+            return []
+        
+        conditions = ['messages_fts MATCH ?']
+        params: list = [match]
+        if chat:
+            try:
+                params.append(int(chat))
+                conditions.append('m.chat_id = ?')
+            except ValueError:
+                if chat.startswith('@'):
+                    # Username чата хранится в metadata; в Telegram он без учета регистра
+                    conditions.append(
+                        "m.chat_id IN (SELECT chat_id FROM main.chats "
+                        "WHERE lower(json_extract(metadata, '$.username')) = ?)"
+                    )
+                    params.append(chat[1:].lower())
+                else:
+                    conditions.append('m.chat_id IN (SELECT chat_id FROM main.chats WHERE chat_title LIKE ?)')
+                    params.append(f"%{chat}%")
+        if since:
+            conditions.append('m.date >= ?')
+            params.append(since)
         
-        result = await cursor.fetchone()
-        return result[0] if result else 0
+        rows = []
+        async with self.reader() as connection:
+            # У каждого раздела свой индекс: совпадения ищутся в каждом и
+            # сливаются по bm25 (в базе без разделов схема одна - main).
+            # Из каждой группы разделов берется первая страница до offset + limit
+            async for segments in self._segment_groups(connection):
+                rows += await self._search_segments(connection, segments, conditions, params, limit + offset)
+        
+        rows.sort(key=lambda row: row[-1])
+        columns = ('id', 'chat_id', 'message_id', 'date', 'chat_title', 'username', 'first_name', 'last_name', 'snippet')
+        return [dict(zip(columns, row)) for row in rows[offset:offset + limit]]
+
+    @staticmethod
+    async def _search_segments(connection: aiosqlite.Connection, segments: List[str],
+                               conditions: List[str], params: list, limit: int) -> List[tuple]:
+        """Лучшие совпадения в подключенных сегментах; последний столбец - rank (bm25)"""
+        parts = [f'''
+            SELECT m.id, m.chat_id, m.message_id, m.date,
+                   c.chat_title, u.username, u.first_name, u.last_name,
+                   snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet,
+                   bm25(messages_fts) AS rank
+            FROM {schema}.messages_fts
+            JOIN {schema}.message_records m ON m.id = messages_fts.rowid
+            LEFT JOIN main.chats c ON c.chat_id = m.chat_id
+            LEFT JOIN main.users u ON u.user_id = m.user_id
+            WHERE {' AND '.join(conditions)}
+        ''' for schema in segments]
+        cursor = await connection.execute(f'''
+            SELECT id, chat_id, message_id, date, chat_title, username, first_name, last_name, snippet, rank
+            FROM ({' UNION ALL '.join(parts)})
+            ORDER BY rank
+            LIMIT ?
+        ''', params * len(segments) + [limit])
+        return await cursor.fetchall()
 
     async def get_chats(self) -> List[Dict]:
         """Получение списка всех чатов"""
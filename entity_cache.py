@@ -0,0 +1,174 @@
+"""
+LRU-кэш отправителей (пользователей и каналов) по их ID
+
+Telegram присылает отправителей вместе со страницей истории или событием,
+поэтому чаще всего запрос get_sender не нужен. Кэш запоминает всех
+увиденных отправителей и отдает их по sender_id, а в Telegram обращается
+только при промахе. Кэш можно сохранять в базу, чтобы он переживал
+перезапуск.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from database import MessageDatabase
+
+logger = logging.getLogger(__name__)
+
+# Поля сущности, которые сохраняются в базе
+ENTITY_FIELDS = ('username', 'first_name', 'last_name', 'title', 'access_hash')
+
+
+class CachedEntity:
+    """Сущность, восстановленная из базы (атрибуты как у объектов Telethon)"""
+    __slots__ = ('id', 'kind') + ENTITY_FIELDS
+
+    def __init__(self, id: int, kind: str = 'user', **fields):
+        self.id = id
+        self.kind = kind
+        for name in ENTITY_FIELDS:
+            setattr(self, name, fields.get(name))
+
+
+def entity_kind(entity) -> str:
+    return 'user' if hasattr(entity, 'first_name') else 'channel'
+
+
+def entity_fields(entity) -> tuple:
+    return tuple(getattr(entity, name, None) for name in ENTITY_FIELDS)
+
+
+class EntityCache:
+    def __init__(self, db: Optional[MessageDatabase] = None, capacity: int = 10000,
+                 flush_interval: float = 60.0):
+        """
+        Args:
+            db: база для сохранения кэша (None - только в памяти)
+            capacity: максимальное число сущностей в памяти
+            flush_interval: как часто сохранять новые сущности в базу, секунд
+        """
+        self.db = db
+        self.capacity = max(1, capacity)
+        self.flush_interval = flush_interval
+        self._entities: OrderedDict = OrderedDict()
+        self._dirty: Dict[int, object] = {}
+        self._task = None
+        self.stats = {
+            'attached': 0,  # отправитель пришел вместе с сообщением
+            'hits': 0,      # найден в кэше
+            'misses': 0,    # потребовался запрос к Telegram
+        }
+
+    def get(self, entity_id: int):
+        entity = self._entities.get(entity_id)
+        if entity is not None:
+            self._entities.move_to_end(entity_id)
+        return entity
+
+    def put(self, entity):
+        """Добавление или обновление сущности"""
+        if entity is None or getattr(entity, 'id', None) is None:
+            return
+        # Неполные (min) сущности не заменяют полные
+        previous = self._entities.get(entity.id)
+        if getattr(entity, 'min', False) and previous is not None:
+            self._entities.move_to_end(entity.id)
+            return
+
+        if previous is None or entity_fields(previous) != entity_fields(entity):
+            self._dirty[entity.id] = entity
+        self._entities[entity.id] = entity
+        self._entities.move_to_end(entity.id)
+        while len(self._entities) > self.capacity:
+            self._entities.popitem(last=False)
+
+    def add_from_messages(self, messages: Iterable):
+        """Заполнение кэша отправителями, пришедшими вместе со страницей сообщений"""
+        for message in messages:
+            sender = getattr(message, 'sender', None)
+            if sender is not None:
+                self.put(sender)
+
+    async def resolve_sender(self, message, fetch: Callable[[], Awaitable]):
+        """
+        Отправитель сообщения: из самого сообщения, из кэша или запросом fetch()
+
+        Запрос к Telegram выполняется только при промахе.
+        """
+        sender = getattr(message, 'sender', None)
+        if sender is not None:
+            self.stats['attached'] += 1
+            self.put(sender)
+            return sender
+
+        sender_id = getattr(message, 'sender_id', None)
+        if not sender_id:
+            return None
+
+        sender = self.get(sender_id)
+        if sender is not None:
+            self.stats['hits'] += 1
+            return sender
+
+        self.stats['misses'] += 1
+        sender = await fetch()
+        self.put(sender)
+        return sender
+
+    def describe(self) -> str:
+        """Одна строка для команд статуса"""
+        return (
+            f"{len(self._entities)}/{self.capacity}, "
+            f"из сообщений: {self.stats['attached']}, из кэша: {self.stats['hits']}, "
+            f"запросов: {self.stats['misses']}"
+        )
+
+    async def load(self):
+        """Загрузка последних сохраненных сущностей из базы"""
+        if self.db is None:
+            return
+        for row in await self.db.load_entities(self.capacity):
+            entity = CachedEntity(**row)
+            self._entities[entity.id] = entity
+        logger.debug(f"Загружено сущностей в кэш: {len(self._entities)}")
+
+    async def flush(self):
+        """Сохранение новых и изменившихся сущностей в базу"""
+        if self.db is None or not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        try:
+            await self.db.save_entities([
+                {
+                    'id': entity.id,
+                    'kind': getattr(entity, 'kind', None) or entity_kind(entity),
+                    **dict(zip(ENTITY_FIELDS, entity_fields(entity))),
+                }
+                for entity in pending.values()
+            ])
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша сущностей: {e}")
+            for entity_id, entity in pending.items():
+                self._dirty.setdefault(entity_id, entity)
+
+    async def start(self):
+        """Запуск периодического сохранения в базу"""
+        if self.db is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка периодического сохранения и финальный сброс"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -4,46 +4,125 @@
 import asyncio
 import json
 import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from typing import Optional
 from database import MessageDatabase
 from config import DATABASE_PATH
 
 
-async def export_to_json(db_path: str = DATABASE_PATH, output_file: str = 'messages_export.json'):
-    """Экспорт всех сообщений в JSON"""
+# Сколько строк читать из базы за раз: память не зависит от размера базы
+EXPORT_PAGE_SIZE = 1000
+
+MESSAGE_COLUMNS = '''
+    message_id, chat_id, chat_title, chat_type,
+    user_id, username, first_name, last_name,
+    message_text, date, is_reply, reply_to_message_id,
+    has_media, media_type, raw_data
+'''
+
+
+async def iter_rows(cursor, page_size: int = EXPORT_PAGE_SIZE):
+    """Построчное чтение результата запроса страницами fetchmany"""
+    while True:
+        rows = await cursor.fetchmany(page_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def decode_message(columns, row) -> dict:
+    """Строка запроса -> словарь сообщения с разобранным raw_data"""
+    message = dict(zip(columns, row))
+    # Парсим JSON поля
+    if message.get('raw_data'):
+        try:
+            message['raw_data'] = json.loads(message['raw_data'])
+        except ValueError:
+            pass
+    return message
+
+
+class ExportProgress:
+    """Вывод прогресса экспорта в stderr (не мешает выводу в файл или pipe)"""
+    
+    def __init__(self, total: int, every: int = EXPORT_PAGE_SIZE * 10, enabled: bool = True):
+        self.total = total
+        self.every = every
+        self.enabled = enabled
+        self.done = 0
+    
+    def step(self):
+        self.done += 1
+        if self.done % self.every == 0:
+            self.show()
+    
+    def show(self):
+        if not self.enabled:
+            return
+        percent = self.done * 100 // self.total if self.total else 100
+        print(f"\r⏳ {self.done}/{self.total} ({percent}%)", end='', file=sys.stderr, flush=True)
+    
+    def finish(self):
+        if self.enabled:
+            self.show()
+            print(file=sys.stderr)
+
+
+async def write_messages(cursor, f, progress: ExportProgress, json_lines: bool) -> int:
+    """Потоковая запись сообщений: JSON-массив (по объекту в строке) или JSON Lines"""
+    columns = [description[0] for description in cursor.description]
+    count = 0
+    
+    if not json_lines:
+        f.write('[')
+    async for row in iter_rows(cursor):
+        line = json.dumps(decode_message(columns, row), ensure_ascii=False)
+        if json_lines:
+            f.write(line + '\n')
+        else:
+            f.write((',\n' if count else '\n') + line)
+        count += 1
+        progress.step()
+    if not json_lines:
+        f.write('\n]' if count else ']')
+    
+    return count
+
+
+async def export_to_json(db_path: str = DATABASE_PATH, output_file: str = 'messages_export.json',
+                         json_lines: Optional[bool] = None):
+    """
+    Экспорт всех сообщений в JSON
+    
+    json_lines: писать JSON Lines (по сообщению в строке) вместо массива;
+    по умолчанию - если имя файла оканчивается на .jsonl
+    """
+    if json_lines is None:
+        json_lines = output_file.endswith('.jsonl')
+    
     db = MessageDatabase(db_path)
     await db.connect()
     
     try:
+        db.require_all_partitions()
+        progress = ExportProgress(await db.get_messages_count())
+        
         cursor = await db.connection.cursor()
-        await cursor.execute('''
-            SELECT 
-                message_id, chat_id, chat_title, chat_type,
-                user_id, username, first_name, last_name,
-                message_text, date, is_reply, reply_to_message_id,
-                has_media, media_type, raw_data
+        await cursor.execute(f'''
+            SELECT {MESSAGE_COLUMNS}
             FROM messages
             ORDER BY date DESC
         ''')
         
-        rows = await cursor.fetchall()
-        columns = [description[0] for description in cursor.description]
-        
-        messages = []
-        for row in rows:
-            message = dict(zip(columns, row))
-            # Парсим JSON поля
-            if message.get('raw_data'):
-                try:
-                    message['raw_data'] = json.loads(message['raw_data'])
-                except:
-                    pass
-            messages.append(message)
-        
         with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+            count = await write_messages(cursor, f, progress, json_lines)
+        progress.finish()
         
-        print(f"✅ Экспортировано {len(messages)} сообщений в {output_file}")
+        print(f"✅ Экспортировано {count} сообщений в {output_file}")
         return output_file
         
     finally:
@@ -56,6 +135,9 @@ async def export_to_csv(db_path: str = DATABASE_PATH, output_file: str = 'messag
     await db.connect()
     
     try:
+        db.require_all_partitions()
+        progress = ExportProgress(await db.get_messages_count())
+        
         cursor = await db.connection.cursor()
         await cursor.execute('''
             SELECT 
@@ -67,31 +149,42 @@ async def export_to_csv(db_path: str = DATABASE_PATH, output_file: str = 'messag
             ORDER BY date DESC
         ''')
         
-        rows = await cursor.fetchall()
         columns = [description[0] for description in cursor.description]
+        count = 0
         
         with open(output_file, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(columns)
             
-            for row in rows:
+            async for row in iter_rows(cursor):
                 # Заменяем None на пустую строку для CSV
                 row = [str(cell) if cell is not None else '' for cell in row]
                 writer.writerow(row)
+                count += 1
+                progress.step()
+        progress.finish()
         
-        print(f"✅ Экспортировано {len(rows)} сообщений в {output_file}")
+        print(f"✅ Экспортировано {count} сообщений в {output_file}")
         return output_file
         
     finally:
         await db.close()
 
 
-async def export_chat_messages(chat_id: int, output_file: str = None):
-    """Экспорт сообщений из конкретного чата"""
-    db = MessageDatabase()
+async def export_chat_messages(chat_id: int, output_file: str = None, json_lines: Optional[bool] = None,
+                               db_path: str = DATABASE_PATH, read_only: bool = False,
+                               verbose: bool = True):
+    """
+    Экспорт сообщений из конкретного чата
+    
+    В формате JSON пишется объект с информацией о чате и массивом messages,
+    в формате JSON Lines (файл .jsonl) - только сообщения, по одному в строке.
+    """
+    db = MessageDatabase(db_path, read_only=read_only)
     await db.connect()
     
     try:
+        db.require_all_partitions()
         cursor = await db.connection.cursor()
         await cursor.execute('''
             SELECT chat_title FROM chats WHERE chat_id = ?
@@ -100,83 +193,372 @@ async def export_chat_messages(chat_id: int, output_file: str = None):
         chat_title = chat_info[0] if chat_info else f"chat_{chat_id}"
         
         if not output_file:
-            output_file = f"messages_{chat_id}_{datetime.now().strftime('%Y%m%d')}.json"
+            extension = 'jsonl' if json_lines else 'json'
+            output_file = f"messages_{chat_id}_{datetime.now().strftime('%Y%m%d')}.{extension}"
+        if json_lines is None:
+            json_lines = output_file.endswith('.jsonl')
         
-        await cursor.execute('''
-            SELECT 
-                message_id, chat_id, chat_title, chat_type,
-                user_id, username, first_name, last_name,
-                message_text, date, is_reply, reply_to_message_id,
-                has_media, media_type, raw_data
+        total = await db.get_messages_count(chat_id)
+        progress = ExportProgress(total, enabled=verbose)
+        
+        await cursor.execute(f'''
+            SELECT {MESSAGE_COLUMNS}
             FROM messages
             WHERE chat_id = ?
             ORDER BY date ASC
         ''', (chat_id,))
         
-        rows = await cursor.fetchall()
+        with open(output_file, 'w', encoding='utf-8') as f:
+            if json_lines:
+                count = await write_messages(cursor, f, progress, json_lines=True)
+            else:
+                # Заголовок пишется сразу, массив сообщений - потоком
+                header = json.dumps({
+                    'chat_id': chat_id,
+                    'chat_title': chat_title,
+                    'total_messages': total,
+                    'export_date': datetime.now().isoformat(),
+                }, ensure_ascii=False, indent=2)
+                f.write(header[:-2] + ',\n  "messages": ')
+                count = await write_messages(cursor, f, progress, json_lines=False)
+                f.write('\n}\n')
+        progress.finish()
+        
+        if verbose:
+            print(f"✅ Экспортировано {count} сообщений из '{chat_title}' в {output_file}")
+        return output_file
+        
+    finally:
+        await db.close()
+
+
+async def export_threads(chat_id: int, output_file: str = None, min_messages: int = 1,
+                         db_path: str = DATABASE_PATH, verbose: bool = True):
+    """
+    Экспорт чата по веткам ответов: по ветке в строке JSON Lines
+    
+    Ветки берутся из индекса message_threads (рекурсивные запросы не нужны)
+    и идут по id корня, сообщения внутри ветки - по порядку, с глубиной и
+    родителем. Если корень ветки не сохранен (вне загруженной истории),
+    has_root = false, а root_id - id недостающего сообщения.
+    min_messages: пропускать ветки короче (2 - без одиночных сообщений)
+    """
+    db = MessageDatabase(db_path)
+    await db.connect()
+    
+    try:
+        db.require_all_partitions()
+        if not output_file:
+            output_file = f"threads_{chat_id}_{datetime.now().strftime('%Y%m%d')}.jsonl"
+        
+        progress = ExportProgress(await db.get_messages_count(chat_id), enabled=verbose)
+        
+        cursor = await db.connection.cursor()
+        await cursor.execute(f'''
+            SELECT thread_root_id, depth, parent_id, {MESSAGE_COLUMNS}
+            FROM (
+                SELECT message_id AS thread_message_id, root_id AS thread_root_id, depth, parent_id
+                FROM main.message_threads WHERE chat_id = ?
+            ) t
+            JOIN messages m ON m.chat_id = ? AND m.message_id = t.thread_message_id
+            ORDER BY thread_root_id, thread_message_id
+        ''', (chat_id, chat_id))
         columns = [description[0] for description in cursor.description]
         
-        messages = []
-        for row in rows:
-            message = dict(zip(columns, row))
-            if message.get('raw_data'):
-                try:
-                    message['raw_data'] = json.loads(message['raw_data'])
-                except:
-                    pass
-            messages.append(message)
+        threads = written = 0
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump({
+        def write_thread(f, root_id, messages):
+            nonlocal threads, written
+            if root_id is None or len(messages) < min_messages:
+                return
+            f.write(json.dumps({
                 'chat_id': chat_id,
-                'chat_title': chat_title,
-                'total_messages': len(messages),
-                'export_date': datetime.now().isoformat(),
-                'messages': messages
-            }, f, ensure_ascii=False, indent=2)
+                'root_id': root_id,
+                'has_root': messages[0]['message_id'] == root_id,
+                'message_count': len(messages),
+                'messages': messages,
+            }, ensure_ascii=False) + '\n')
+            threads += 1
+            written += len(messages)
         
-        print(f"✅ Экспортировано {len(messages)} сообщений из '{chat_title}' в {output_file}")
+        with open(output_file, 'w', encoding='utf-8') as f:
+            root_id, messages = None, []
+            async for row in iter_rows(cursor):
+                message = decode_message(columns, row)
+                thread_root_id = message.pop('thread_root_id')
+                if thread_root_id != root_id:
+                    write_thread(f, root_id, messages)
+                    root_id, messages = thread_root_id, []
+                messages.append(message)
+                progress.step()
+            write_thread(f, root_id, messages)
+        progress.finish()
+        
+        if verbose:
+            print(f"✅ Экспортировано {threads} веток ({written} сообщений) чата {chat_id} в {output_file}")
         return output_file
         
     finally:
         await db.close()
 
 
-async def get_statistics():
-    """Получение статистики по базе данных"""
-    db = MessageDatabase()
+DELTA_MANIFEST = '_manifest.json'
+
+
+async def segment_ranges(db: MessageDatabase, since: dict) -> tuple:
+    """
+    Новые строки каждого сегмента с водяного знака since
+    
+    since и результат: {'message_row_id', 'edit_id', 'partitions': {схема: {...}}} -
+    максимальные id в message_records и message_edits основной базы и разделов.
+    Возвращает ([(схема, от, до), ...], новый водяной знак); вызывать внутри
+    читающей транзакции, чтобы водяной знак совпадал со снимком базы.
+    """
+    ranges = []
+    until = {}
+    for schema in db.segments():
+        if schema == 'main':
+            segment_since = {'message_row_id': since['message_row_id'], 'edit_id': since['edit_id']}
+        else:
+            # Новый раздел начинается с водяного знака основной базы: сообщения,
+            # перенесенные split, сохраняют свои id и уже могли быть выгружены
+            segment_since = since.get('partitions', {}).get(
+                schema, {'message_row_id': since['message_row_id'], 'edit_id': since['edit_id']}
+            )
+        cursor = await db.connection.execute(f'''
+            SELECT (SELECT COALESCE(MAX(id), 0) FROM {schema}.message_records),
+                   (SELECT COALESCE(MAX(id), 0) FROM {schema}.message_edits)
+        ''')
+        max_row_id, max_edit_id = await cursor.fetchone()
+        # После переноса сообщений в разделы MAX(id) основной базы уменьшается
+        segment_until = {
+            'message_row_id': max(max_row_id, segment_since['message_row_id']),
+            'edit_id': max(max_edit_id, segment_since['edit_id']),
+        }
+        if schema == 'main':
+            until.update(segment_until)
+        else:
+            until.setdefault('partitions', {})[schema] = segment_until
+        ranges.append((schema, segment_since, segment_until))
+    # Водяные знаки разделов, которые больше не подключены (архив), сохраняются
+    for schema, mark in since.get('partitions', {}).items():
+        until.setdefault('partitions', {}).setdefault(schema, mark)
+    return ranges, until
+
+
+def load_delta_manifest(output_dir: str) -> dict:
+    path = os.path.join(output_dir, DELTA_MANIFEST)
+    if not os.path.exists(path):
+        return {'watermark': {'message_row_id': 0, 'edit_id': 0}, 'deltas': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_delta_manifest(output_dir: str, manifest: dict):
+    path = os.path.join(output_dir, DELTA_MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+async def export_delta(output_dir: str = 'delta_export', db_path: str = DATABASE_PATH):
+    """
+    Экспорт только новых и отредактированных сообщений с прошлого запуска
+    
+    Водяной знак - максимальный id в message_records (новые сообщения) и в
+    message_edits (правки текста) на момент прошлого экспорта; у помесячных
+    разделов водяной знак свой (поле partitions). Каждый запуск
+    пишет файл delta_<seq>_<время>.jsonl (поле op: insert или update) и добавляет
+    запись в _manifest.json; дельты применяются по возрастанию seq.
+    Время экспорта зависит от числа изменений, а не от размера базы.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_delta_manifest(output_dir)
+    since = manifest['watermark']
+    
+    db = MessageDatabase(db_path)
     await db.connect()
     
     try:
-        cursor = await db.connection.cursor()
+        db.require_all_partitions()
+        # Одна читающая транзакция: все запросы видят один снимок базы
+        await db.connection.execute('BEGIN')
+        ranges, until = await segment_ranges(db, since)
         
-        # Общая статистика
-        await cursor.execute('SELECT COUNT(*) FROM messages')
-        total_messages = (await cursor.fetchone())[0]
+        if until == since:
+            print("✅ Новых сообщений и правок нет")
+            return None
         
-        await cursor.execute('SELECT COUNT(DISTINCT chat_id) FROM messages')
-        total_chats = (await cursor.fetchone())[0]
+        created_at = datetime.now()
+        seq = len(manifest['deltas']) + 1
+        file_name = f"delta_{seq:06d}_{created_at.strftime('%Y%m%dT%H%M%S')}.jsonl"
+        path = os.path.join(output_dir, file_name)
+        counts = {'insert': 0, 'update': 0}
         
-        await cursor.execute('SELECT COUNT(DISTINCT user_id) FROM messages WHERE user_id IS NOT NULL')
-        total_users = (await cursor.fetchone())[0]
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for schema, segment_since, segment_until in ranges:
+                # Новые строки этого файла: диапазоны id разделов могут пересекаться
+                cursor = await db.connection.execute(f'''
+                    SELECT {MESSAGE_COLUMNS}, edit_date
+                    FROM messages
+                    WHERE id IN (SELECT id FROM {schema}.message_records WHERE id > ? AND id <= ?)
+                    ORDER BY id
+                ''', (segment_since['message_row_id'], segment_until['message_row_id']))
+                columns = [description[0] for description in cursor.description]
+                async for row in iter_rows(cursor):
+                    f.write(json.dumps({'op': 'insert', **decode_message(columns, row)}, ensure_ascii=False) + '\n')
+                    counts['insert'] += 1
+                
+                # Правки сообщений, выгруженных раньше (новые уже попали выше)
+                cursor = await db.connection.execute(f'''
+                    SELECT {MESSAGE_COLUMNS}, edit_date
+                    FROM messages
+                    WHERE id <= ? AND id IN (
+                        SELECT r.id
+                        FROM {schema}.message_edits e
+                        JOIN {schema}.message_records r ON r.chat_id = e.chat_id AND r.message_id = e.message_id
+                        WHERE e.id > ? AND e.id <= ?
+                    )
+                    ORDER BY id
+                ''', (segment_since['message_row_id'], segment_since['edit_id'], segment_until['edit_id']))
+                async for row in iter_rows(cursor):
+                    f.write(json.dumps({'op': 'update', **decode_message(columns, row)}, ensure_ascii=False) + '\n')
+                    counts['update'] += 1
         
-        # Топ чатов
-        await cursor.execute('''
-            SELECT chat_id, chat_title, COUNT(*) as count
-            FROM messages
-            GROUP BY chat_id, chat_title
-            ORDER BY count DESC
-            LIMIT 10
-        ''')
-        top_chats = await cursor.fetchall()
+        await db.connection.execute('COMMIT')
+        os.replace(path + '.tmp', path)
+        
+        manifest['deltas'].append({
+            'seq': seq,
+            'file': file_name,
+            'created_at': created_at.isoformat(),
+            'from': since,
+            'to': until,
+            'inserted': counts['insert'],
+            'updated': counts['update'],
+        })
+        manifest['watermark'] = until
+        save_delta_manifest(output_dir, manifest)
+        
+        print(
+            f"✅ Дельта #{seq}: новых {counts['insert']}, "
+            f"изменено {counts['update']} -> {path}"
+        )
+        return path
+        
+    finally:
+        if db.connection.in_transaction:
+            await db.connection.execute('ROLLBACK')
+        await db.close()
+
+
+def export_chat_in_process(db_path: str, chat_id: int, output_file: str, json_lines: bool) -> str:
+    """Экспорт одного чата в процессе пула: свое соединение только для чтения"""
+    return asyncio.run(export_chat_messages(
+        chat_id, output_file, json_lines=json_lines, db_path=db_path,
+        read_only=True, verbose=False
+    ))
+
+
+async def export_all_chats(output_dir: str = 'chats_export', json_lines: bool = False,
+                           workers: Optional[int] = None, db_path: str = DATABASE_PATH):
+    """
+    Экспорт каждого чата в отдельный файл пулом процессов
+    
+    Каждый процесс открывает базу только для чтения и пишет свои файлы
+    независимо. Большие чаты запускаются первыми, чтобы процессы
+    заканчивали примерно одновременно.
+    """
+    # Обычное подключение один раз: создание таблиц и миграции до запуска пула
+    db = MessageDatabase(db_path)
+    await db.connect()
+    try:
+        db.require_all_partitions()
+        cursor = await db.connection.execute(
+            'SELECT chat_id, message_count FROM chat_stats ORDER BY message_count DESC'
+        )
+        chats = await cursor.fetchall()
+    finally:
+        await db.close()
+    
+    if not chats:
+        print("Нет чатов для экспорта")
+        return output_dir
+    
+    os.makedirs(output_dir, exist_ok=True)
+    extension = 'jsonl' if json_lines else 'json'
+    workers = workers or os.cpu_count() or 1
+    started = datetime.now()
+    loop = asyncio.get_running_loop()
+    
+    with ProcessPoolExecutor(max_workers=min(workers, len(chats))) as pool:
+        futures = [
+            loop.run_in_executor(
+                pool, export_chat_in_process, db_path, chat_id,
+                os.path.join(output_dir, f"chat_{chat_id}.{extension}"), json_lines
+            )
+            for chat_id, _ in chats
+        ]
+        failed = 0
+        for done, future in enumerate(asyncio.as_completed(futures), 1):
+            try:
+                await future
+            except Exception as e:
+                failed += 1
+                print(f"❌ Ошибка экспорта чата: {e}", file=sys.stderr)
+            print(f"\r⏳ Чатов: {done}/{len(chats)}", end='', file=sys.stderr, flush=True)
+        print(file=sys.stderr)
+    
+    elapsed = (datetime.now() - started).total_seconds()
+    total = sum(count for _, count in chats)
+    print(
+        f"✅ Экспортировано чатов: {len(chats) - failed} ({total} сообщений) в {output_dir} "
+        f"за {elapsed:.1f}с, процессов: {min(workers, len(chats))}"
+    )
+    return output_dir
+
+
+async def search_messages(query: str, chat: Optional[str] = None, since: Optional[str] = None,
+                          limit: int = 20, page: int = 1, db_path: str = DATABASE_PATH):
+    """Полнотекстовый поиск по сохраненным сообщениям"""
+    db = MessageDatabase(db_path)
+    await db.connect()
+    
+    try:
+        started = datetime.now()
+        results = await db.search_messages(query, chat=chat, since=since,
+                                           limit=limit, offset=(page - 1) * limit)
+        elapsed_ms = (datetime.now() - started).total_seconds() * 1000
+        
+        print(f"🔍 «{query}»: страница {page}, найдено {len(results)} ({elapsed_ms:.0f} мс)")
+        for row in results:
+            author = row['username'] or f"{row['first_name'] or ''} {row['last_name'] or ''}".strip()
+            print(f"\n[{row['chat_title'] or row['chat_id']}] #{row['message_id']} {row['date']} {author}")
+            print(f"  {row['snippet']}")
+        return results
+        
+    finally:
+        await db.close()
+
+
+async def get_statistics():
+    """Получение статистики по базе данных"""
+    db = MessageDatabase()
+    await db.connect()
+    
+    try:
+        # Счетчики chat_stats: время не зависит от размера базы
+        stats = await db.get_stats(top=10)
         
         print("\n📊 Статистика базы данных:")
-        print(f"Всего сообщений: {total_messages}")
-        print(f"Всего чатов: {total_chats}")
-        print(f"Всего пользователей: {total_users}")
+        print(f"Всего сообщений: {stats['total_messages']}")
+        print(f"Всего чатов: {stats['total_chats']}")
+        print(f"Всего пользователей: {stats['total_users']}")
         print("\nТоп-10 чатов по количеству сообщений:")
-        for chat_id, chat_title, count in top_chats:
-            print(f"  • {chat_title}: {count} сообщений")
+        for chat in stats['top_chats']:
+            period = f"{(chat['first_date'] or '')[:10]} - {(chat['last_date'] or '')[:10]}"
+            print(f"  • {chat['chat_title']}: {chat['message_count']} сообщений, "
+                  f"{chat['user_count']} авторов ({period})")
         
     finally:
         await db.close()
@@ -184,14 +566,15 @@ async def get_statistics():
 
 async def main():
     """Главная функция"""
-    import sys
-    
     if len(sys.argv) > 1:
         command = sys.argv[1]
         
         if command == 'json':
             output = sys.argv[2] if len(sys.argv) > 2 else 'messages_export.json'
             await export_to_json(output_file=output)
+        elif command == 'jsonl':
+            output = sys.argv[2] if len(sys.argv) > 2 else 'messages_export.jsonl'
+            await export_to_json(output_file=output, json_lines=True)
         elif command == 'csv':
             output = sys.argv[2] if len(sys.argv) > 2 else 'messages_export.csv'
             await export_to_csv(output_file=output)
@@ -202,14 +585,76 @@ async def main():
             chat_id = int(sys.argv[2])
             output = sys.argv[3] if len(sys.argv) > 3 else None
             await export_chat_messages(chat_id, output)
+        elif command == 'threads':
+            args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+            if not args:
+                print("Использование: python export_data.py threads <chat_id> [output.jsonl] [--min-messages=N]")
+                return
+            min_messages = next((int(arg.split('=', 1)[1]) for arg in sys.argv[2:]
+                                 if arg.startswith('--min-messages=')), 1)
+            await export_threads(int(args[0]), args[1] if len(args) > 1 else None, min_messages=min_messages)
+        elif command == 'delta':
+            await export_delta(output_dir=sys.argv[2] if len(sys.argv) > 2 else 'delta_export')
+        elif command == 'chats-all':
+            args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+            workers = next((int(arg.split('=', 1)[1]) for arg in sys.argv[2:]
+                            if arg.startswith('--workers=')), None)
+            await export_all_chats(
+                output_dir=args[0] if args else 'chats_export',
+                json_lines='--jsonl' in sys.argv,
+                workers=workers
+            )
+        elif command == 'parquet':
+            from parquet_export import export_to_parquet
+            args = [arg for arg in sys.argv[2:] if arg != '--full']
+            output = args[0] if args else 'parquet_export'
+            try:
+                await export_to_parquet(output_dir=output, full='--full' in sys.argv)
+            except RuntimeError as e:
+                print(f"❌ {e}")
+        elif command == 'chunks':
+            from chunk_export import DEFAULT_GAP_MINUTES, export_chunks
+            args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+            options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--') and '=' in arg)
+            await export_chunks(
+                output_dir=args[0] if args else 'llm_chunks',
+                group_by=options.get('group', 'time'),
+                max_tokens=int(options['max-tokens']) if 'max-tokens' in options else None,
+                max_chars=int(options['max-chars']) if 'max-chars' in options else None,
+                overlap=int(options.get('overlap', 0)),
+                gap_minutes=int(options.get('gap-minutes', DEFAULT_GAP_MINUTES)),
+                chat_id=int(options['chat']) if 'chat' in options else None
+            )
+        elif command == 'search':
+            words = []
+            options = {'chat': None, 'since': None, 'limit': '20', 'page': '1'}
+            for arg in sys.argv[2:]:
+                name, sep, value = arg.partition('=')
+                if sep and name in options:
+                    options[name] = value
+                else:
+                    words.append(arg)
+            if not words:
+                print("Использование: python export_data.py search <слова> [chat=..] [since=ГГГГ-ММ-ДД] [limit=20] [page=1]")
+                return
+            await search_messages(' '.join(words), chat=options['chat'], since=options['since'],
+                                  limit=int(options['limit']), page=max(1, int(options['page'])))
         elif command == 'stats':
             await get_statistics()
         else:
             print("Неизвестная команда")
             print("Использование:")
             print("  python export_data.py json [output_file]  - экспорт в JSON")
+            print("  python export_data.py jsonl [output_file] - экспорт в JSON Lines (по сообщению в строке)")
             print("  python export_data.py csv [output_file]   - экспорт в CSV")
-            print("  python export_data.py chat <chat_id> [output] - экспорт чата")
+            print("  python export_data.py chat <chat_id> [output] - экспорт чата (output.jsonl - JSON Lines)")
+            print("  python export_data.py threads <chat_id> [output] [--min-messages=N] - чат по веткам ответов")
+            print("  python export_data.py delta [dir]         - только новое и измененное с прошлого запуска")
+            print("  python export_data.py chats-all [dir] [--jsonl] [--workers=N] - все чаты, по файлу на чат")
+            print("  python export_data.py parquet [dir] [--full] - экспорт в Parquet по чатам и месяцам")
+            print("  python export_data.py chunks [dir] [--group=time|thread] [--max-tokens=N|--max-chars=N]")
+            print("                        [--overlap=N] [--gap-minutes=N] [--chat=ID] - фрагменты для LLM")
+            print("  python export_data.py search <слова> [chat=..] [since=..] [page=N] - поиск")
             print("  python export_data.py stats               - статистика")
     else:
         # По умолчанию экспорт в JSON
@@ -217,5 +662,10 @@ async def main():
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except RuntimeError as e:
+        # Например, разделов больше, чем можно подключить для полного экспорта
+        print(f"❌ {e}")
+        sys.exit(1)
 
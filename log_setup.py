@@ -0,0 +1,124 @@
+"""
+Неблокирующее логирование
+
+Обработчики userbot только кладут запись в очередь (QueueHandler), а в
+файл и консоль ее пишет фоновый поток (QueueListener), поэтому запись на
+диск не останавливает цикл событий. Файл лога ротируется по размеру.
+
+Частые события (каждое входящее сообщение) пишутся в логгер EVENTS_LOGGER
+с ограничением частоты: не больше LOG_EVENTS_PER_SECOND записей в секунду,
+о пропущенных сообщает следующая записанная. Предупреждения и ошибки
+пропускаются всегда.
+
+LOG_FORMAT=json пишет в файл по JSON-объекту на строку для сборщиков логов.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from datetime import datetime
+
+# Логгер частых событий, к которому применяется ограничение частоты
+EVENTS_LOGGER = 'userbot.events'
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord; остальные (из extra=...) попадают в JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога -> одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Не больше rate записей в секунду для уровней ниже WARNING
+
+    Пропущенные записи не форматируются вовсе. Число пропущенных
+    добавляется к следующей записанной (поле sampled_out).
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        super().__init__()
+        self.rate = rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        if self.suppressed:
+            record.sampled_out = self.suppressed
+            record.msg = f"{record.msg} (пропущено похожих: {self.suppressed})"
+            self.suppressed = 0
+        return True
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Очередь внутри процесса: запись не сериализуется, поэтому здесь
+        только подставляются аргументы, а время и traceback форматирует
+        поток записи
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: str = 'INFO', log_file: str = 'userbot.log', max_bytes: int = 10 * 1024 * 1024,
+                  backup_count: int = 5, log_format: str = 'text',
+                  events_per_second: float = 10.0) -> logging.handlers.QueueListener:
+    """
+    Настройка корневого логгера: очередь + фоновый поток записи
+
+    Возвращает запущенный QueueListener; он останавливается при выходе
+    из процесса, дописывая оставшиеся в очереди записи.
+    """
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(LocalQueueHandler(records))
+    root.setLevel(getattr(logging, level.upper(), logging.INFO))
+
+    logging.getLogger(EVENTS_LOGGER).addFilter(RateLimitFilter(events_per_second))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
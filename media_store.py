@@ -0,0 +1,260 @@
+"""
+Фоновая загрузка медиа с хранением по содержимому
+
+process_message только ставит сообщение с медиа в ограниченную очередь
+(без ожидания), а несколько фоновых задач скачивают файлы. Очередь не
+тормозит прием сообщений: если она заполнена, медиа пропускается и
+учитывается в статистике.
+
+Файлы хранятся по SHA-256 содержимого (media/ab/abcdef....jpg), поэтому
+одна и та же картинка, пересланная в десять чатов, лежит на диске один
+раз. Таблица media связывает сообщение с файлом в media_blobs. Повторные
+пересылки узнаются еще до загрузки - по ID файла в Telegram (у пересланного
+сообщения он тот же), а перезалитые копии - по хешу после загрузки.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from database import MessageDatabase
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def parse_size_limits(value: str) -> Dict[str, int]:
+    """'photo:10,video:50' -> {'photo': 10 МБ, 'video': 50 МБ} в байтах"""
+    limits = {}
+    for item in value.split(','):
+        if ':' in item:
+            media_type, size_mb = item.split(':', 1)
+            limits[media_type.strip()] = int(float(size_mb) * MB)
+    return limits
+
+
+def media_kind(message) -> Optional[str]:
+    """Вид медиа для лимитов: photo, video, voice, audio, sticker, gif, document"""
+    if getattr(message, 'photo', None):
+        return 'photo'
+    if not getattr(message, 'document', None):
+        return None
+    for kind in ('sticker', 'gif', 'voice', 'video', 'audio'):
+        if getattr(message, kind, None):
+            return kind
+    return 'document'
+
+
+def file_key(message) -> Optional[str]:
+    """ID файла в Telegram: одинаков у всех пересылок одного файла"""
+    if getattr(message, 'photo', None):
+        return f"photo:{message.photo.id}"
+    if getattr(message, 'document', None):
+        return f"document:{message.document.id}"
+    return None
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaDownloader:
+    def __init__(self, db: MessageDatabase,
+                 download: Callable[[object, str], Awaitable[Optional[str]]],
+                 media_dir: str = 'media', workers: int = 2, queue_size: int = 1000,
+                 types: Iterable[str] = ('photo', 'document', 'video', 'audio', 'voice'),
+                 max_size: int = 20 * MB, type_max_size: Optional[Dict[str, int]] = None,
+                 large_size: int = 10 * MB, large_concurrency: int = 1):
+        """
+        Args:
+            db: база для таблиц media и media_blobs
+            download: загрузка медиа сообщения в файл (message, path) -> path
+            media_dir: каталог хранилища
+            workers: число параллельных загрузок
+            queue_size: сколько сообщений может ждать загрузки
+            types: какие виды медиа загружать (см. media_kind)
+            max_size: файлы больше (в байтах) не загружаются
+            type_max_size: свой лимит размера для отдельных видов
+            large_size: файлы от этого размера считаются большими
+            large_concurrency: сколько больших файлов загружать одновременно,
+                чтобы видео не занимали все задачи загрузки
+        """
+        self.db = db
+        self.download = download
+        self.media_dir = media_dir
+        self.workers = max(1, workers)
+        self.types = set(types)
+        self.max_size = max_size
+        self.type_max_size = type_max_size or {}
+        self.large_size = large_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._large = asyncio.Semaphore(max(1, large_concurrency))
+        # ID файла -> загрузка, которая уже выполняется (пересылки ждут ее)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._tasks = []
+        self.stats = {
+            'queued': 0,
+            'downloaded': 0,     # новый файл сохранен
+            'deduplicated': 0,   # файл уже был в хранилище
+            'skipped': 0,        # вид или размер вне лимитов
+            'dropped': 0,        # очередь была заполнена
+            'failed': 0,
+            'bytes_downloaded': 0,
+        }
+
+    async def start(self):
+        """Запуск фоновых задач загрузки"""
+        if self._tasks:
+            return
+        os.makedirs(os.path.join(self.media_dir, 'tmp'), exist_ok=True)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        logger.info(
+            f"Загрузка медиа включена: {self.media_dir}, задач {self.workers}, "
+            f"виды {', '.join(sorted(self.types))}, до {self.max_size / MB:.0f} МБ"
+        )
+
+    async def stop(self):
+        """Остановка задач; незагруженные медиа из очереди пропускаются"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        logger.info(f"Загрузка медиа остановлена. {self.describe()}")
+
+    def size_limit(self, kind: str) -> int:
+        return self.type_max_size.get(kind, self.max_size)
+
+    def submit(self, message, chat_id: int) -> bool:
+        """
+        Постановка медиа сообщения в очередь загрузки
+
+        Не ждет: вызывается из process_message. Вид и размер проверяются
+        сразу, по данным, которые уже есть в сообщении.
+        """
+        kind = media_kind(message)
+        key = file_key(message)
+        if kind is None or key is None:
+            return False
+        file = getattr(message, 'file', None)
+        size = getattr(file, 'size', None) or 0
+        if kind not in self.types or size > self.size_limit(kind):
+            self.stats['skipped'] += 1
+            return False
+        try:
+            self.queue.put_nowait((message, chat_id, kind, key, size))
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+            return False
+        self.stats['queued'] += 1
+        return True
+
+    async def _run(self):
+        """Основной цикл задачи загрузки"""
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(*job)
+            except Exception as e:
+                self.stats['failed'] += 1
+                message, chat_id = job[0], job[1]
+                logger.warning(f"Не удалось загрузить медиа сообщения {message.id} из чата {chat_id}: {e}")
+                await self.db.save_media({
+                    'chat_id': chat_id, 'message_id': message.id, 'media_type': job[2],
+                    'file_key': job[3], 'status': 'failed', 'error': str(e)[:500],
+                })
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, message, chat_id: int, kind: str, key: str, size: int):
+        # Правка сообщения без замены файла приходит с тем же ID файла
+        existing = await self.db.get_media(chat_id, message.id)
+        if existing and existing['file_key'] == key and existing['status'] == 'stored':
+            return
+
+        blob = await self._blob_for_key(key)
+        if blob is None and key in self._inflight:
+            # Этот же файл уже загружается для другой пересылки
+            blob = await asyncio.shield(self._inflight[key])
+        if blob is not None:
+            self.stats['deduplicated'] += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            try:
+                blob = await self._download(message, size)
+                future.set_result(blob)
+            except Exception:
+                future.set_result(None)
+                raise
+            finally:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+        await self.db.save_media({
+            'chat_id': chat_id, 'message_id': message.id, 'media_type': kind,
+            'file_key': key, 'sha256': blob['sha256'], 'status': 'stored',
+        })
+
+    async def _blob_for_key(self, key: str) -> Optional[Dict]:
+        """Файл, уже сохраненный для этого ID файла (если он еще на диске)"""
+        blob = await self.db.find_media_blob(key)
+        if blob and os.path.exists(os.path.join(self.media_dir, blob['path'])):
+            return blob
+        return None
+
+    async def _download(self, message, size: int) -> Dict:
+        """Загрузка во временный файл и перенос в хранилище по хешу"""
+        file = getattr(message, 'file', None)
+        ext = getattr(file, 'ext', None) or ''
+        tmp_path = os.path.join(self.media_dir, 'tmp', uuid.uuid4().hex + ext)
+        try:
+            if size >= self.large_size:
+                async with self._large:
+                    tmp_path = await self.download(message, tmp_path) or tmp_path
+            else:
+                tmp_path = await self.download(message, tmp_path) or tmp_path
+
+            loop = asyncio.get_running_loop()
+            sha256 = await loop.run_in_executor(None, file_sha256, tmp_path)
+            path = os.path.join(sha256[:2], sha256 + ext)
+            target = os.path.join(self.media_dir, path)
+            actual_size = os.path.getsize(tmp_path)
+            if os.path.exists(target):
+                # Тот же файл, загруженный заново (не пересылка, а повторная загрузка)
+                self.stats['deduplicated'] += 1
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmp_path, target)
+                self.stats['downloaded'] += 1
+                self.stats['bytes_downloaded'] += actual_size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        blob = {
+            'sha256': sha256,
+            'size': actual_size,
+            'mime_type': getattr(file, 'mime_type', None),
+            'path': path,
+        }
+        await self.db.save_media_blob(blob)
+        return blob
+
+    def describe(self) -> str:
+        """Одна строка для команд статуса"""
+        return (
+            f"в очереди {self.queue.qsize()}, загружено {self.stats['downloaded']} "
+            f"({self.stats['bytes_downloaded'] / MB:.1f} МБ), повторов {self.stats['deduplicated']}, "
+            f"пропущено {self.stats['skipped'] + self.stats['dropped']}, ошибок {self.stats['failed']}"
+        )
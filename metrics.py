@@ -0,0 +1,253 @@
+"""
+Метрики работы userbot в формате Prometheus
+
+Счетчики и гистограммы обновляются на горячем пути (обработчики, запись в
+базу), поэтому обновление - это несколько сложений без блокировок: все
+происходит в одном цикле asyncio. Значения, которые и так считают другие
+компоненты (очереди, лимитер запросов, кэш), не дублируются, а читаются
+функциями-сборщиками в момент запроса метрик.
+
+Метрики доступны по HTTP (GET /metrics, формат Prometheus text 0.0.4)
+и командой /metrics в userbot.
+"""
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунд
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def format_number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Монотонно растущее значение"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        yield self.name, self.value
+
+
+class Gauge(Counter):
+    """Значение, которое может расти и уменьшаться"""
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class Histogram:
+    """Распределение значений по корзинам (задержки)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Замер длительности блока: with histogram.time(): ..."""
+        return _Timer(self)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оценка квантиля по корзинам (линейная интерполяция, как histogram_quantile)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and cumulative + count >= rank:
+                if bound == float('inf'):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            if bound != float('inf'):
+                lower = bound
+        return lower
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{format_number(bound)}"}}', cumulative
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', self.count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class _Collected:
+    """Метрика, значение которой читается функцией в момент запроса"""
+
+    def __init__(self, name: str, documentation: str, kind: str, func: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.func = func
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        try:
+            yield self.name, float(self.func() or 0)
+        except Exception as e:
+            logger.debug(f"Не удалось получить значение метрики {self.name}: {e}")
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            return self._metrics[metric.name]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._add(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._add(Gauge(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, buckets))
+
+    def collect(self, name: str, documentation: str, func: Callable[[], float], kind: str = 'gauge'):
+        """Метрика, значение которой берется из func() при каждом запросе"""
+        metric = _Collected(name, documentation, kind, func)
+        self._metrics[name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for sample_name, value in metric.samples():
+                lines.append(f'{sample_name} {format_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Короткая сводка для команды /metrics: значения и p50/p99 гистограмм"""
+        lines = []
+        for metric in self._metrics.values():
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    lines.append(f'{metric.name}: —')
+                    continue
+                lines.append(
+                    f'{metric.name}: n={metric.count}, '
+                    f'avg={metric.sum / metric.count * 1000:.2f}мс, '
+                    f'p50={metric.quantile(0.5) * 1000:.2f}мс, '
+                    f'p99={metric.quantile(0.99) * 1000:.2f}мс'
+                )
+            else:
+                for sample_name, value in metric.samples():
+                    lines.append(f'{sample_name}: {format_number(round(value, 3))}')
+        return '\n'.join(lines)
+
+
+# Общий реестр процесса
+registry = Registry()
+
+
+def timed(histogram: Histogram):
+    """Декоратор корутины: длительность каждого вызова попадает в гистограмму"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+
+        if path in ('/metrics', '/'):
+            status, body = '200 OK', registry.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logger.debug(f"Запрос метрик прерван: {e}")
+    finally:
+        writer.close()
+
+
+async def start_server(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """HTTP-сервер метрик; port=0 или занятый порт - сервер не запускается"""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_handle_http, host, port)
+    except OSError as e:
+        # Метрики не обязательны для работы userbot
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,232 @@
+"""
+Колоночный экспорт сообщений в Parquet
+
+Файлы раскладываются по разделам chat_id=<id>/month=<ГГГГ-ММ> (hive-разметка),
+поэтому pandas/pyarrow читают только нужные колонки и разделы:
+
+    pd.read_parquet('parquet_export', columns=['date', 'message_text'],
+                    filters=[('chat_id', '=', -1001234567890)])
+
+Поля raw_data (views, forwards, replies) становятся отдельными колонками.
+Экспорт инкрементальный: в _manifest.json хранится отпечаток каждого раздела
+(число строк, максимальный id, последняя правка), и перезаписываются только
+разделы, отпечаток которых изменился.
+
+Требует pyarrow (pip install pyarrow).
+"""
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from typing import Dict, Optional
+
+from config import DATABASE_PATH
+from database import MessageDatabase
+
+MANIFEST_FILE = '_manifest.json'
+
+# Сколько строк собирать в одну группу строк Parquet
+ROW_GROUP_SIZE = 50000
+
+# Колонки представления messages, которые попадают в экспорт
+SOURCE_COLUMNS = (
+    'message_id', 'chat_id', 'chat_title', 'chat_type',
+    'user_id', 'username', 'first_name', 'last_name',
+    'message_text', 'date', 'is_reply', 'reply_to_message_id',
+    'has_media', 'media_type', 'raw_data', 'edit_date',
+)
+
+# Раздел без даты сообщения
+UNKNOWN_MONTH = 'unknown'
+
+
+def import_pyarrow():
+    """pyarrow - необязательная зависимость, нужна только для этого экспорта"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Для экспорта в Parquet установите pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def build_schema(pa):
+    timestamp = pa.timestamp('us', tz='UTC')
+    return pa.schema([
+        ('message_id', pa.int64()),
+        ('chat_title', pa.string()),
+        ('chat_type', pa.string()),
+        ('user_id', pa.int64()),
+        ('username', pa.string()),
+        ('first_name', pa.string()),
+        ('last_name', pa.string()),
+        ('message_text', pa.string()),
+        ('date', timestamp),
+        ('is_reply', pa.bool_()),
+        ('reply_to_message_id', pa.int64()),
+        ('has_media', pa.bool_()),
+        ('media_type', pa.string()),
+        ('views', pa.int64()),
+        ('forwards', pa.int64()),
+        ('replies', pa.int64()),
+        ('edit_date', timestamp),
+    ])
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def to_columns(rows) -> Dict[str, list]:
+    """Строки представления messages -> типизированные колонки"""
+    columns = {name: [] for name in SOURCE_COLUMNS if name not in ('chat_id', 'raw_data')}
+    columns.update({'views': [], 'forwards': [], 'replies': []})
+
+    for row in rows:
+        record = dict(zip(SOURCE_COLUMNS, row))
+        # chat_id задается путем раздела и в файл не пишется
+        record.pop('chat_id')
+        try:
+            raw = json.loads(record.pop('raw_data') or '{}')
+        except ValueError:
+            raw = {}
+        for name in ('views', 'forwards', 'replies'):
+            columns[name].append(raw.get(name))
+
+        record['date'] = parse_timestamp(record['date'])
+        record['edit_date'] = parse_timestamp(record['edit_date'])
+        record['is_reply'] = bool(record['is_reply'])
+        record['has_media'] = bool(record['has_media'])
+        for name, value in record.items():
+            columns[name].append(value)
+
+    return columns
+
+
+def partition_key(chat_id: int, month: Optional[str]) -> str:
+    return f"chat_id={chat_id}/month={month or UNKNOWN_MONTH}"
+
+
+def load_manifest(output_dir: str) -> Dict:
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir: str, manifest: Dict):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+async def get_partition_fingerprints(db: MessageDatabase) -> Dict[str, Dict]:
+    """Отпечаток каждого раздела: меняется при новых сообщениях и правках"""
+    # Через представление messages: в базе с помесячными файлами оно
+    # объединяет все подключенные разделы
+    cursor = await db.connection.execute('''
+        SELECT chat_id, substr(date, 1, 7) AS month,
+               COUNT(*), MAX(id), MAX(edit_date)
+        FROM messages
+        GROUP BY chat_id, month
+    ''')
+    fingerprints = {}
+    for chat_id, month, count, max_id, last_edit in await cursor.fetchall():
+        fingerprints[partition_key(chat_id, month)] = {
+            'chat_id': chat_id,
+            'month': month,
+            'count': count,
+            'max_id': max_id,
+            'last_edit': last_edit,
+        }
+    return fingerprints
+
+
+async def write_partition(db: MessageDatabase, pa, schema, output_dir: str, partition: Dict) -> int:
+    """Запись одного раздела (во временный файл, затем атомарная замена)"""
+    import pyarrow.parquet as pq
+
+    directory = os.path.join(output_dir, partition_key(partition['chat_id'], partition['month']))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'part-0.parquet')
+
+    if partition['month'] is None:
+        condition, params = 'date IS NULL', (partition['chat_id'],)
+    else:
+        condition, params = 'substr(date, 1, 7) = ?', (partition['chat_id'], partition['month'])
+
+    cursor = await db.connection.execute(f'''
+        SELECT {", ".join(SOURCE_COLUMNS)}
+        FROM messages
+        WHERE chat_id = ? AND {condition}
+        ORDER BY date
+    ''', params)
+
+    written = 0
+    with pq.ParquetWriter(path + '.tmp', schema, compression='zstd') as writer:
+        while True:
+            rows = await cursor.fetchmany(ROW_GROUP_SIZE)
+            if not rows:
+                break
+            writer.write_table(pa.table(to_columns(rows), schema=schema))
+            written += len(rows)
+    os.replace(path + '.tmp', path)
+    return written
+
+
+async def export_to_parquet(db_path: str = DATABASE_PATH, output_dir: str = 'parquet_export',
+                            full: bool = False):
+    """
+    Инкрементальный экспорт в Parquet с разделением по чатам и месяцам
+
+    full: перезаписать все разделы, игнорируя манифест
+    """
+    pa = import_pyarrow()
+    schema = build_schema(pa)
+    os.makedirs(output_dir, exist_ok=True)
+
+    db = MessageDatabase(db_path)
+    await db.connect()
+
+    try:
+        db.require_all_partitions()
+        manifest = {} if full else load_manifest(output_dir)
+        fingerprints = await get_partition_fingerprints(db)
+
+        changed = [key for key, fp in fingerprints.items() if manifest.get(key) != fp]
+        removed = [key for key in manifest if key not in fingerprints]
+
+        total_rows = 0
+        for index, key in enumerate(changed, 1):
+            total_rows += await write_partition(db, pa, schema, output_dir, fingerprints[key])
+            manifest[key] = fingerprints[key]
+            print(f"\r⏳ Разделов: {index}/{len(changed)}, строк: {total_rows}",
+                  end='', file=sys.stderr, flush=True)
+            # Манифест сохраняется по ходу: прерванный экспорт продолжится с места остановки
+            if index % 50 == 0:
+                save_manifest(output_dir, manifest)
+        if changed:
+            print(file=sys.stderr)
+
+        for key in removed:
+            shutil.rmtree(os.path.join(output_dir, key), ignore_errors=True)
+            manifest.pop(key, None)
+
+        save_manifest(output_dir, manifest)
+
+        print(
+            f"✅ Parquet: обновлено разделов {len(changed)} ({total_rows} сообщений), "
+            f"без изменений {len(fingerprints) - len(changed)}, удалено {len(removed)} -> {output_dir}"
+        )
+        return output_dir
+
+    finally:
+        await db.close()
@@ -0,0 +1,294 @@
+"""
+Планировщик парсинга нескольких чатов
+
+Задачи парсинга ставятся в очередь и выполняются N воркерами параллельно
+через один TelegramClient. Все воркеры расходуют общий бюджет запросов
+(AdaptiveRateLimiter в rate_limiter.py), поэтому суммарная нагрузка на
+Telegram не растет с числом чатов.
+
+Задачи хранятся в таблице parse_jobs: после перезапуска незавершенные
+задачи ставятся в очередь снова и продолжают с контрольной точки
+parse_state, а limit уменьшается на уже загруженное. Любую задачу можно
+отменить (cancel).
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def format_duration(seconds: float) -> str:
+    """Длительность для статуса: 45с, 3м 10с, 1ч 05м"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}с"
+    if seconds < 3600:
+        return f"{seconds // 60}м {seconds % 60:02d}с"
+    return f"{seconds // 3600}ч {seconds % 3600 // 60:02d}м"
+
+
+class ParseJob:
+    """Задача парсинга одного чата"""
+
+    def __init__(self, job_id: int, chat_identifier: str, limit: Optional[int] = None,
+                 reply_to: Optional[Tuple[int, int]] = None, parsed_before: int = 0):
+        self.job_id = job_id
+        self.chat_identifier = chat_identifier
+        self.limit = limit
+        # Сообщений, загруженных до перезапуска: засчитываются в limit
+        self.parsed_before = parsed_before
+        # (chat_id, message_id) сообщения, в котором показывается ход задачи
+        self.reply_to = reply_to
+        self.status = 'queued'  # queued / running / done / failed / cancelled
+        self.success: Optional[bool] = None
+        self.error: Optional[Exception] = None
+        self.progress: Dict = {}
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_requested = False
+
+    def parsed(self) -> int:
+        """Сохранено сообщений с учетом запусков до перезапуска"""
+        return self.parsed_before + self.progress.get('parsed', 0)
+
+    def remaining_limit(self) -> Optional[int]:
+        """limit для parse_func: остаток после запусков до перезапуска"""
+        if self.limit is None:
+            return None
+        return max(0, self.limit - self.parsed_before)
+
+    def rate(self) -> Optional[float]:
+        """Сообщений в секунду с начала выполнения"""
+        if self.started_at is None:
+            return None
+        elapsed = ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+        return self.progress.get('fetched', 0) / elapsed if elapsed > 0 else None
+
+    def eta(self) -> Optional[float]:
+        """
+        Оценка оставшегося времени, секунд
+
+        message_id в чате идут подряд, поэтому при загрузке истории от новых
+        к старым осталось примерно столько сообщений, каков id самого старого
+        загруженного сообщения.
+        """
+        rate = self.rate()
+        oldest = self.progress.get('oldest_message_id')
+        if not rate or oldest is None:
+            return None
+        remaining = 0 if self.progress.get('backfill_complete') else oldest
+        if self.limit:
+            remaining = min(remaining, max(0, self.remaining_limit() - self.progress.get('fetched', 0)))
+        return remaining / rate
+
+    def describe(self) -> str:
+        """Одна строка для команд статуса"""
+        text = f"#{self.job_id} {self.chat_identifier}"
+        if self.limit:
+            text += f" (limit={self.limit})"
+        parsed = self.parsed()
+        if self.status == 'queued':
+            text += " - в очереди"
+        elif self.status == 'running':
+            elapsed = (datetime.now() - self.started_at).total_seconds()
+            text += f" - {parsed} сообщений за {format_duration(elapsed)}"
+            rate = self.rate()
+            if rate:
+                text += f", {rate:.0f} сообщ/с"
+            eta = self.eta()
+            if eta is not None:
+                text += f", осталось ~{format_duration(eta)}"
+        else:
+            result = {'done': 'готово', 'failed': 'ошибка', 'cancelled': 'отменено'}[self.status]
+            text += f" - {result}, {parsed} сообщений"
+            if self.started_at and self.finished_at:
+                text += f" за {format_duration((self.finished_at - self.started_at).total_seconds())}"
+            if self.error is not None:
+                text += f": {self.error}"
+        return text
+
+
+class ParseScheduler:
+    def __init__(self, parse_func: Callable[..., Awaitable[bool]],
+                 concurrency: int = 3, history_size: int = 50, db=None,
+                 on_update: Optional[Callable[[ParseJob], Awaitable[None]]] = None):
+        """
+        Args:
+            parse_func: корутина парсинга (chat_identifier, limit=..., progress=...) -> bool
+            concurrency: сколько чатов парсится одновременно
+            history_size: сколько завершенных задач хранить для статуса
+            db: MessageDatabase для таблицы parse_jobs (None - задачи только в памяти)
+            on_update: вызывается при запуске и завершении задачи
+        """
+        self.parse_func = parse_func
+        self.concurrency = max(1, concurrency)
+        self.db = db
+        self.on_update = on_update
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.jobs: Dict[int, ParseJob] = {}
+        self.finished: deque = deque(maxlen=history_size)
+        self._next_id = 1
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self):
+        """Запуск воркеров"""
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker())
+                for _ in range(self.concurrency)
+            ]
+
+    async def stop(self):
+        """
+        Остановка воркеров
+
+        Выполняющиеся задачи прерываются, но остаются незавершенными в
+        parse_jobs и продолжаются после перезапуска (restore).
+        """
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def restore(self) -> List[ParseJob]:
+        """Постановка в очередь задач, не завершенных до перезапуска"""
+        if self.db is None:
+            return []
+        restored = []
+        for row in await self.db.get_unfinished_parse_jobs():
+            if row['id'] in self.jobs:
+                continue
+            job = ParseJob(row['id'], row['chat_identifier'], row['limit_count'], row['reply_to'],
+                           parsed_before=row['parsed'])
+            self.jobs[job.job_id] = job
+            self.queue.put_nowait(job)
+            restored.append(job)
+        if restored:
+            logger.info(f"Продолжаются задачи парсинга после перезапуска: {', '.join(j.chat_identifier for j in restored)}")
+        return restored
+
+    async def submit(self, chat_identifier: str, limit: Optional[int] = None,
+                     reply_to: Optional[Tuple[int, int]] = None) -> ParseJob:
+        """Постановка чата в очередь; повторная постановка активного чата возвращает его задачу"""
+        for job in self.jobs.values():
+            if job.chat_identifier == chat_identifier:
+                return job
+
+        if self.db is not None:
+            job_id = await self.db.create_parse_job(chat_identifier, limit, reply_to)
+        else:
+            job_id = self._next_id
+            self._next_id += 1
+        job = ParseJob(job_id, chat_identifier, limit, reply_to)
+        self.jobs[job.job_id] = job
+        self.queue.put_nowait(job)
+        return job
+
+    async def cancel(self, job_id: int) -> Optional[ParseJob]:
+        """Отмена задачи из очереди или выполняющейся; None - активной задачи с таким номером нет"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job.cancel_requested = True
+        if job.status == 'queued':
+            # Воркер пропустит задачу, когда дойдет до нее в очереди
+            await self._finish(job, 'cancelled')
+        elif job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def save_progress(self):
+        """Запись счетчиков выполняющихся задач: после сбоя limit продолжится с них"""
+        for job in self.running():
+            await self._save(job)
+
+    def queued(self) -> List[ParseJob]:
+        return [job for job in self.jobs.values() if job.status == 'queued']
+
+    def running(self) -> List[ParseJob]:
+        return [job for job in self.jobs.values() if job.status == 'running']
+
+    def jobs_for(self, reply_to: Tuple[int, int]) -> List[ParseJob]:
+        """Активные и недавно завершенные задачи, которые показываются в одном сообщении"""
+        jobs = {job.job_id: job for job in self.finished if job.reply_to == reply_to}
+        jobs.update((job.job_id, job) for job in self.jobs.values() if job.reply_to == reply_to)
+        return [jobs[job_id] for job_id in sorted(jobs)]
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job.status == 'queued':
+                    await self._run_job(job)
+            finally:
+                self.queue.task_done()
+
+    async def _save(self, job: ParseJob):
+        if self.db is None:
+            return
+        try:
+            await self.db.update_parse_job(
+                job.job_id,
+                status=job.status,
+                parsed=job.parsed(),
+                errors=job.progress.get('errors', 0),
+                error=str(job.error) if job.error is not None else None,
+                started_at=job.started_at.isoformat() if job.started_at else None,
+                finished_at=job.finished_at.isoformat() if job.finished_at else None,
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние задачи парсинга #{job.job_id}: {e}")
+
+    async def _notify(self, job: ParseJob):
+        if self.on_update:
+            try:
+                await self.on_update(job)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике обновления задачи #{job.job_id}: {e}", exc_info=True)
+
+    async def _finish(self, job: ParseJob, status: str):
+        job.status = status
+        job.finished_at = datetime.now()
+        self.jobs.pop(job.job_id, None)
+        self.finished.append(job)
+        await self._save(job)
+        logger.info(f"Задача парсинга #{job.job_id} завершена: {job.describe()}")
+        await self._notify(job)
+
+    async def _run_job(self, job: ParseJob):
+        job.status = 'running'
+        job.started_at = datetime.now()
+        await self._save(job)
+        logger.info(f"Задача парсинга #{job.job_id} запущена: {job.chat_identifier}")
+        await self._notify(job)
+
+        # Отдельная задача, чтобы cancel() прерывал парсинг, а не воркер
+        job.task = asyncio.create_task(self.parse_func(
+            job.chat_identifier,
+            limit=job.remaining_limit(),
+            progress=job.progress
+        ))
+        if job.cancel_requested:
+            job.task.cancel()
+        try:
+            job.success = await job.task
+            status = 'done' if job.success else 'failed'
+        except asyncio.CancelledError:
+            if not job.cancel_requested:
+                # Остановка userbot: задача продолжится после перезапуска с этими счетчиками
+                await self._save(job)
+                raise
+            status = 'cancelled'
+        except Exception as e:
+            job.success = False
+            job.error = e
+            status = 'failed'
+            logger.error(f"Задача парсинга #{job.job_id} ({job.chat_identifier}) завершилась с ошибкой: {e}")
+        finally:
+            job.task = None
+
+        await self._finish(job, status)
@@ -0,0 +1,154 @@
+"""
+Помесячные файлы сообщений (разделы)
+
+При DATABASE_PARTITIONED=true сообщения за месяц хранятся в отдельном файле
+рядом с основной базой: messages.2024-05.db, messages.2024-06.db и т.д.
+Раздел выбирается по дате сообщения, поэтому новые сообщения пишутся в файл
+текущего месяца, а загрузка старой истории - в файлы своих месяцев. Основная
+база хранит чаты, авторов, состояние парсинга и сообщения, записанные до
+включения разделов.
+
+Каждый раздел - полноценная база со схемой MessageDatabase (свои FTS-индекс,
+история правок и счетчики chat_stats), поэтому VACUUM, резервная копия и
+перестроение индексов делаются по одному небольшому файлу. Разделы
+подключаются к соединению через ATTACH, а временные представления
+messages и chat_stats объединяют их для экспорта, поиска и статистики.
+
+    python partitions.py status            - разделы и их размер
+    python partitions.py split [--vacuum]  - перенести сообщения основной базы в разделы
+    python partitions.py retention         - применить DATABASE_RETENTION_MONTHS сейчас
+
+Политика хранения применяется и сама: при подключении к базе и в начале
+каждого месяца. Старые разделы переносятся в DATABASE_ARCHIVE_DIR или
+удаляются (DATABASE_RETENTION_ACTION=drop); текущий месяц не затрагивается.
+"""
+import asyncio
+import os
+import re
+import shutil
+import sys
+from datetime import datetime
+from typing import Dict, Optional
+
+# SQLite подключает к одному соединению не больше 10 баз (SQLITE_MAX_ATTACHED)
+MAX_ATTACHED = 10
+
+# Шаг id между разделами: id сообщений и правок уникальны во всех файлах,
+# и строки разных разделов можно объединять без пересечений
+ID_STEP = 10 ** 10
+
+PARTITION_RE = re.compile(r'\.(\d{4}-\d{2})\.db$')
+
+
+def current_month() -> str:
+    return datetime.now().strftime('%Y-%m')
+
+
+def month_of(date: Optional[str]) -> str:
+    """Месяц раздела по дате сообщения (ISO); без даты - текущий месяц"""
+    if date and len(date) >= 7 and date[4] == '-':
+        return date[:7]
+    return current_month()
+
+
+def shift_month(month: str, months: int) -> str:
+    year, number = map(int, month.split('-'))
+    index = year * 12 + number - 1 + months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def partition_path(db_path: str, month: str) -> str:
+    root, _ = os.path.splitext(db_path)
+    return f"{root}.{month}.db"
+
+
+def schema_name(month: str) -> str:
+    """Имя подключенной базы раздела в SQL: p_2024_05"""
+    return 'p_' + month.replace('-', '_')
+
+
+def schema_month(schema: str) -> str:
+    """p_2024_05 -> 2024-05"""
+    return schema[2:].replace('_', '-')
+
+
+def id_base(month: str) -> int:
+    """Начальное значение AUTOINCREMENT в разделе"""
+    year, number = map(int, month.split('-'))
+    return (year * 12 + number - 1) * ID_STEP
+
+
+def list_partitions(db_path: str) -> Dict[str, str]:
+    """Файлы разделов основной базы: {месяц: путь}, по возрастанию месяца"""
+    root, _ = os.path.splitext(os.path.abspath(db_path))
+    directory, prefix = os.path.split(root)
+    partitions = {}
+    for name in os.listdir(directory or '.'):
+        match = PARTITION_RE.search(name)
+        if match and name == f"{prefix}.{match.group(1)}.db":
+            partitions[match.group(1)] = os.path.join(directory, name)
+    return dict(sorted(partitions.items()))
+
+
+def remove_database_file(path: str):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def archive_database_file(path: str, archive_dir: str) -> str:
+    os.makedirs(archive_dir, exist_ok=True)
+    target = os.path.join(archive_dir, os.path.basename(path))
+    for suffix in ('', '-wal'):
+        if os.path.exists(path + suffix):
+            shutil.move(path + suffix, target + suffix)
+    remove_database_file(path)
+    return target
+
+
+async def print_status(db):
+    partitions = list_partitions(db.db_path)
+    cursor = await db.connection.execute('SELECT COUNT(*) FROM main.message_records')
+    legacy = (await cursor.fetchone())[0]
+    print(f"📦 Основная база: {db.db_path} ({os.path.getsize(db.db_path) / 1024 / 1024:.1f} МБ), "
+          f"сообщений вне разделов: {legacy}")
+    if not partitions:
+        print("   Разделов нет")
+    hot = current_month()
+    for month, path in partitions.items():
+        size = os.path.getsize(path) / 1024 / 1024
+        mark = ' (текущий)' if month == hot else ''
+        print(f"   {month}{mark}: {size:.1f} МБ")
+    if len(partitions) > MAX_ATTACHED:
+        print(f"⚠️ Разделов больше {MAX_ATTACHED}: статистика и поиск подключают их по очереди, "
+              f"а экспорт отказывается работать - настройте DATABASE_RETENTION_MONTHS")
+
+
+async def main():
+    from config import DATABASE_PATH, DATABASE_RETENTION_MONTHS
+    from database import MessageDatabase
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    if command not in ('status', 'split', 'retention'):
+        print(__doc__)
+        return
+
+    db = MessageDatabase(DATABASE_PATH, partitioned=True)
+    await db.connect()
+    try:
+        if command == 'split':
+            moved = await db.split_into_partitions()
+            print(f"✅ Перенесено в разделы сообщений: {moved}")
+            if '--vacuum' in sys.argv:
+                print("🧹 VACUUM основной базы...")
+                await db.connection.execute('VACUUM')
+        elif command == 'retention' and not DATABASE_RETENTION_MONTHS:
+            # При заданном сроке политика уже применена при подключении
+            print("DATABASE_RETENTION_MONTHS не задан: старые разделы хранятся без ограничения")
+        await print_status(db)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
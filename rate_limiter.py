@@ -0,0 +1,145 @@
+"""
+Адаптивный ограничитель запросов к Telegram
+
+Token bucket, скорость которого подстраивается под ответы Telegram:
+после каждого успешного запроса скорость немного растет, а FloodWaitError
+ставит все запросы на паузу на указанное Telegram время и уменьшает
+скорость вдвое. Скорость, при которой пришел FloodWait, запоминается
+как потолок, и дальше рост к нему идет осторожно - лимитер сам находит
+максимальный темп, который Telegram терпит для этого аккаунта.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict
+
+from telethon.errors import FloodWaitError
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate: float = 1.0, min_rate: float = 0.05, max_rate: float = 10.0,
+                 burst: int = 5, increase: float = 0.05, decrease_factor: float = 0.5,
+                 probe_interval: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable[None]] = asyncio.sleep):
+        """
+        Args:
+            rate: начальная скорость, запросов в секунду
+            min_rate, max_rate: границы скорости
+            burst: сколько запросов можно выполнить подряд без ожидания
+            increase: прирост скорости после успешного запроса
+            decrease_factor: множитель скорости при FloodWait
+            probe_interval: через сколько секунд без FloodWait потолок снимается
+            clock, sleep: источники времени (подменяются в тестах)
+        """
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.burst = max(1, burst)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.probe_interval = probe_interval
+        self._clock = clock
+        self._sleep = sleep
+
+        self.ceiling = max_rate
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.last_flood_at = None
+
+        self.requests = 0
+        self.flood_waits = 0
+        self.total_wait = 0.0
+        self.total_flood_seconds = 0
+
+        # asyncio.Lock будит ожидающих в порядке очереди - каждый чат получает свою долю
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def _wait(self, seconds: float):
+        self.total_wait += seconds
+        await self._sleep(seconds)
+
+    async def acquire(self):
+        """Ожидание разрешения на один запрос"""
+        async with self._lock:
+            pause = self.paused_until - self._clock()
+            if pause > 0:
+                await self._wait(pause)
+                # За время паузы токены не копятся
+                self.updated = self._clock()
+                self.tokens = min(self.tokens, 1.0)
+
+            self._refill()
+            if self.tokens < 1:
+                await self._wait((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+            self.requests += 1
+
+    def on_success(self):
+        """Запрос прошел: плавно наращиваем скорость"""
+        now = self._clock()
+        if (self.ceiling < self.max_rate and self.last_flood_at is not None
+                and now - self.last_flood_at > self.probe_interval):
+            # Давно не было FloodWait - пробуем подняться выше прежнего потолка
+            self.ceiling = min(self.max_rate, self.ceiling + self.increase * 10)
+            self.last_flood_at = now
+
+        if self.rate < self.ceiling:
+            self.rate = min(self.ceiling, self.rate + self.increase)
+
+    def on_flood_wait(self, seconds: int):
+        """Telegram попросил подождать: пауза для всех и снижение скорости"""
+        now = self._clock()
+        self.flood_waits += 1
+        self.total_flood_seconds += seconds
+        self.last_flood_at = now
+        self.paused_until = max(self.paused_until, now + seconds)
+
+        self.ceiling = max(self.min_rate, self.rate * 0.9)
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.tokens = 0.0
+
+        logger.warning(
+            f"FloodWait {seconds}с: скорость снижена до {self.rate:.2f} запр/с "
+            f"(потолок {self.ceiling:.2f})"
+        )
+
+    async def call(self, func: Callable[..., Awaitable], *args, **kwargs):
+        """Выполнение запроса через лимитер с повтором после FloodWait"""
+        while True:
+            await self.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                continue
+            self.on_success()
+            return result
+
+    def stats(self) -> Dict:
+        """Текущее состояние лимитера"""
+        return {
+            'rate': self.rate,
+            'ceiling': self.ceiling,
+            'requests': self.requests,
+            'flood_waits': self.flood_waits,
+            'flood_seconds': self.total_flood_seconds,
+            'total_wait': self.total_wait,
+        }
+
+    def describe(self) -> str:
+        """Одна строка для команд статуса"""
+        return (
+            f"{self.rate:.2f} запр/с (потолок {self.ceiling:.2f}), "
+            f"запросов: {self.requests}, FloodWait: {self.flood_waits} "
+            f"({self.total_flood_seconds}с), ожидание: {self.total_wait:.0f}с"
+        )
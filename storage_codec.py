@@ -0,0 +1,131 @@
+"""
+Сжатие message_text и raw_data общим словарем zlib
+
+Короткие сообщения по отдельности почти не сжимаются, но у сообщений одного
+архива много общих слов, а у raw_data - одни и те же ключи. Словарь (zdict),
+обученный на выборке из базы, дает zlib эти повторы заранее, поэтому сжатие
+работает даже для строк в несколько десятков байт.
+
+Формат сжатого значения (BLOB):
+    1 байт  - MAGIC
+    2 байта - ID словаря в таблице compression_dicts
+    далее   - поток deflate без заголовка zlib
+
+Несжатые значения остаются строками (TEXT), поэтому в одной базе могут
+лежать и те, и другие; decode() возвращает текст в любом случае.
+"""
+import json
+import re
+import zlib
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+MAGIC = 0x01
+HEADER_SIZE = 3
+
+# zlib использует не больше 32 КБ словаря (размер окна)
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+# Виды словарей: текст сообщений и raw_data
+TEXT = 'text'
+RAW = 'raw'
+
+WORD_RE = re.compile(r'\w{3,}|[^\w\s]{2,}', re.UNICODE)
+
+
+def train_text_dictionary(samples: Iterable[str], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """
+    Словарь для текстов: самые выгодные слова и пары слов выборки
+
+    Выгода фрагмента - частота * длина. zlib дешевле ссылается на конец
+    словаря, поэтому самые выгодные фрагменты идут последними.
+    """
+    fragments = Counter()
+    for text in samples:
+        words = WORD_RE.findall(text or '')
+        fragments.update(word + ' ' for word in words)
+        fragments.update(f"{a} {b} " for a, b in zip(words, words[1:]))
+
+    chosen: List[bytes] = []
+    total = 0
+    ranked = sorted(fragments.items(), key=lambda item: item[1] * len(item[0]), reverse=True)
+    for fragment, count in ranked:
+        if count < 2:
+            break
+        encoded = fragment.encode('utf-8')
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(chosen))
+
+
+def train_raw_dictionary(samples: Iterable[str], size: int = MAX_DICTIONARY_SIZE) -> bytes:
+    """Словарь для raw_data: сами примеры подряд (ключи и типичные значения)"""
+    dictionary = b''
+    for sample in samples:
+        dictionary += (sample or '').encode('utf-8')
+        if len(dictionary) >= size:
+            break
+    return dictionary[-size:]
+
+
+def compact_json(raw_data: Optional[Dict]) -> str:
+    """raw_data без пробелов между полями"""
+    return json.dumps(raw_data or {}, ensure_ascii=False, separators=(',', ':'))
+
+
+class StorageCodec:
+    def __init__(self, min_length: int = 16,
+                 reload: Optional[Callable[[], Iterable[Tuple[int, str, bytes]]]] = None):
+        """
+        Args:
+            min_length: строки короче (в байтах) не сжимаются
+            reload: чтение словарей из базы, если встретился неизвестный ID
+                (словарь обучен другим процессом после подключения)
+        """
+        self.min_length = min_length
+        self.reload = reload
+        # ID словаря -> (вид, словарь)
+        self.dictionaries: Dict[int, Tuple[str, bytes]] = {}
+        # Вид -> ID словаря, которым сжимаются новые значения
+        self.current: Dict[str, int] = {}
+
+    @property
+    def active(self) -> bool:
+        """В базе есть словари: значения могут быть сжаты и требуют декодирования"""
+        return bool(self.dictionaries)
+
+    def load(self, rows: Iterable[Tuple[int, str, bytes]]):
+        """Загрузка словарей из строк (id, kind, dictionary)"""
+        self.dictionaries = {}
+        self.current = {}
+        for dictionary_id, kind, dictionary in rows:
+            self.dictionaries[dictionary_id] = (kind, bytes(dictionary))
+            if dictionary_id > self.current.get(kind, 0):
+                self.current[kind] = dictionary_id
+
+    def encode(self, kind: str, text: Optional[str]) -> Union[str, bytes, None]:
+        """Сжатие строки; если выигрыша нет или словаря нет - строка без изменений"""
+        dictionary_id = self.current.get(kind)
+        if text is None or dictionary_id is None:
+            return text
+        data = text.encode('utf-8')
+        if len(data) < self.min_length:
+            return text
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=self.dictionaries[dictionary_id][1])
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) + HEADER_SIZE >= len(data):
+            return text
+        return bytes((MAGIC,)) + dictionary_id.to_bytes(2, 'big') + packed
+
+    def decode(self, value):
+        """Значение из базы -> текст (функция msg_decode в SQL)"""
+        if not isinstance(value, bytes) or not value or value[0] != MAGIC:
+            return value
+        dictionary_id = int.from_bytes(value[1:HEADER_SIZE], 'big')
+        if dictionary_id not in self.dictionaries and self.reload:
+            self.load(self.reload())
+        decompressor = zlib.decompressobj(-15, zdict=self.dictionaries[dictionary_id][1])
+        return (decompressor.decompress(value[HEADER_SIZE:]) + decompressor.flush()).decode('utf-8')
@@ -1,10 +1,13 @@
 import asyncio
 import logging
+import os
+import re
+import time
 from datetime import datetime, timedelta
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession
 from telethon.tl.types import User, Chat, Channel
-from telethon.errors import FloodWaitError, ChatAdminRequiredError
+from telethon.errors import ChatAdminRequiredError
 from config import (
     API_ID,
     API_HASH,
@@ -12,30 +15,129 @@ from config import (
     STRING_SESSION,
     LOG_LEVEL,
     LOG_FILE,
+    LOG_MAX_SIZE_MB,
+    LOG_BACKUP_COUNT,
+    LOG_FORMAT,
+    LOG_EVENTS_PER_SECOND,
+    WRITE_BEHIND_ENABLED,
+    WRITE_BEHIND_QUEUE_SIZE,
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    PARSE_CONCURRENCY,
+    PARSE_REQUESTS_PER_SECOND,
+    PARSE_REQUESTS_MIN_PER_SECOND,
+    PARSE_REQUESTS_MAX_PER_SECOND,
+    PARSE_REQUESTS_BURST,
+    PARSE_PROGRESS_INTERVAL,
+    PARSE_LIST_DIR,
+    CHAT_ACTIVITY_FLUSH_INTERVAL,
+    ENTITY_CACHE_SIZE,
+    ENTITY_CACHE_PERSIST,
+    METRICS_HOST,
+    METRICS_PORT,
+    MEDIA_DOWNLOAD_ENABLED,
+    MEDIA_DIR,
+    MEDIA_WORKERS,
+    MEDIA_QUEUE_SIZE,
+    MEDIA_TYPES,
+    MEDIA_MAX_SIZE_MB,
+    MEDIA_TYPE_MAX_SIZE_MB,
+    MEDIA_LARGE_SIZE_MB,
+    MEDIA_LARGE_CONCURRENCY,
 )
+import metrics
+from log_setup import EVENTS_LOGGER, setup_logging
 from database import MessageDatabase
+from write_queue import WriteBehindQueue
+from chat_registry import ChatRegistry
+from entity_cache import EntityCache
+from media_store import MB, MediaDownloader, parse_size_limits
+from parse_scheduler import ParseScheduler
+from rate_limiter import AdaptiveRateLimiter
 
-# Настройка логирования
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+# Настройка логирования: запись в файл и консоль идет из фонового потока
+setup_logging(
+    level=LOG_LEVEL,
+    log_file=LOG_FILE,
+    max_bytes=int(LOG_MAX_SIZE_MB * 1024 * 1024),
+    backup_count=LOG_BACKUP_COUNT,
+    log_format=LOG_FORMAT,
+    events_per_second=LOG_EVENTS_PER_SECOND,
 )
 logger = logging.getLogger(__name__)
+# Записи о каждом входящем сообщении (с ограничением частоты)
+events_logger = logging.getLogger(EVENTS_LOGGER)
 
 # Инициализация базы данных
 db = MessageDatabase()
 
+# Очередь пакетной записи (None - запись напрямую, по одному сообщению)
+writer = WriteBehindQueue(
+    db,
+    max_size=WRITE_BEHIND_QUEUE_SIZE,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+) if WRITE_BEHIND_ENABLED else None
+
+# Реестр чатов: метаданные пишутся только при изменении
+chat_registry = ChatRegistry(db, flush_interval=CHAT_ACTIVITY_FLUSH_INTERVAL)
+
+# Кэш отправителей: избавляет от get_sender для уже известных пользователей
+entity_cache = EntityCache(db if ENTITY_CACHE_PERSIST else None, capacity=ENTITY_CACHE_SIZE)
+
 # Инициализация клиента Telegram
 session_arg = StringSession(STRING_SESSION) if STRING_SESSION else SESSION_NAME
-client = TelegramClient(session_arg, API_ID, API_HASH)
+# flood_sleep_threshold=0: Telethon не ждет FloodWait внутри запроса сам (по умолчанию -
+# до 60 с), а пробрасывает FloodWaitError, чтобы его видел AdaptiveRateLimiter
+client = TelegramClient(session_arg, API_ID, API_HASH, flood_sleep_threshold=0)
 
 # Флаг для отслеживания активного парсинга
 parsing_active = {}
 
+# Собственный аккаунт (запрашивается один раз)
+me = None
+
+# Общий адаптивный лимит запросов к Telegram для всех задач парсинга
+rate_limiter = AdaptiveRateLimiter(
+    rate=PARSE_REQUESTS_PER_SECOND,
+    min_rate=PARSE_REQUESTS_MIN_PER_SECOND,
+    max_rate=PARSE_REQUESTS_MAX_PER_SECOND,
+    burst=PARSE_REQUESTS_BURST,
+)
+
+# Фоновая загрузка медиа (None - сохраняется только вид медиа)
+media_downloader = MediaDownloader(
+    db,
+    lambda message, path: rate_limiter.call(client.download_media, message, file=path),
+    media_dir=MEDIA_DIR,
+    workers=MEDIA_WORKERS,
+    queue_size=MEDIA_QUEUE_SIZE,
+    types=MEDIA_TYPES,
+    max_size=int(MEDIA_MAX_SIZE_MB * MB),
+    type_max_size=parse_size_limits(MEDIA_TYPE_MAX_SIZE_MB),
+    large_size=int(MEDIA_LARGE_SIZE_MB * MB),
+    large_concurrency=MEDIA_LARGE_CONCURRENCY,
+) if MEDIA_DOWNLOAD_ENABLED else None
+
+# Метрики горячего пути
+HANDLER_SECONDS = metrics.registry.histogram(
+    'userbot_handler_seconds', 'Длительность обработчиков новых и отредактированных сообщений'
+)
+PROCESS_MESSAGE_SECONDS = metrics.registry.histogram(
+    'userbot_process_message_seconds', 'Длительность process_message'
+)
+MESSAGES_PROCESSED = metrics.registry.counter(
+    'userbot_messages_processed_total', 'Сообщений обработано'
+)
+MESSAGE_ERRORS = metrics.registry.counter(
+    'userbot_message_errors_total', 'Ошибок при обработке сообщений'
+)
+
+# Размер страницы истории (максимум для одного запроса messages.getHistory)
+HISTORY_PAGE_SIZE = 100
+# Как часто (в сообщениях) сохранять контрольную точку парсинга
+CHECKPOINT_EVERY = 1000
+
 
 def get_chat_info(chat):
     """Получение информации о чате"""
@@ -79,6 +181,14 @@ def get_user_info(sender):
     }
 
 
+async def get_me():
+    """Собственный аккаунт; запрос к Telegram выполняется только при первом вызове"""
+    global me
+    if me is None:
+        me = await client.get_me()
+    return me
+
+
 def get_media_info(message):
     """Получение информации о медиа в сообщении"""
     if not message.media:
@@ -94,6 +204,7 @@ def get_media_info(message):
     }
 
 
+@metrics.timed(PROCESS_MESSAGE_SECONDS)
 async def process_message(message, chat, sender=None):
     """Обработка и сохранение сообщения"""
     try:
@@ -103,9 +214,9 @@ async def process_message(message, chat, sender=None):
         # Получение информации о пользователе
         if sender is None:
             try:
-                sender = await message.get_sender()
+                sender = await entity_cache.resolve_sender(message, message.get_sender)
             except Exception as e:
-                logger.debug(f"Не удалось получить информацию об отправителе: {e}")
+                logger.debug("Не удалось получить информацию об отправителе: %s", e)
                 sender = None
         user_info = get_user_info(sender)
         
@@ -134,6 +245,7 @@ async def process_message(message, chat, sender=None):
             'reply_to_message_id': reply_to_message_id,
             'has_media': 1 if media_info['has_media'] else 0,
             'media_type': media_info['media_type'],
+            'edit_date': message.edit_date.isoformat() if getattr(message, 'edit_date', None) else None,
             'raw_data': {
                 'message_id': message.id,
                 'date': message.date.isoformat() if message.date else None,
@@ -144,7 +256,14 @@ async def process_message(message, chat, sender=None):
         }
         
         # Сохранение сообщения
-        await db.save_message(message_data)
+        if writer:
+            await writer.put(message_data)
+        else:
+            await db.save_message(message_data)
+        
+        # Медиа загружается в фоне, здесь только постановка в очередь
+        if media_downloader and media_info['has_media']:
+            media_downloader.submit(message, chat_info['chat_id'])
         
         # Сохранение информации о чате
         chat_data = {
@@ -154,22 +273,73 @@ async def process_message(message, chat, sender=None):
                 'username': getattr(chat, 'username', None)
             }
         }
-        await db.save_chat(chat_data)
+        await chat_registry.update(chat_data)
         
+        MESSAGES_PROCESSED.inc()
         return True
     except Exception as e:
+        MESSAGE_ERRORS.inc()
         logger.error(f"Ошибка при обработке сообщения: {e}", exc_info=True)
         return False
 
 
-async def parse_chat_history(chat_entity, limit=None, offset_date=None):
+async def fetch_history_page(chat, **kwargs):
+    """Загрузка одной страницы истории через общий лимитер запросов"""
+    return await rate_limiter.call(client.get_messages, chat, **kwargs)
+
+
+async def process_history_page(page, chat, chat_title, progress):
+    """Сохранение страницы истории, счетчики накапливаются в progress"""
+    entity_cache.add_from_messages(page)
+    
+    for message in page:
+        progress['fetched'] += 1
+        progress['since_checkpoint'] += 1
+        try:
+            # Пропускаем служебные сообщения
+            if message.action:
+                continue
+            
+            # Отправитель обычно приходит вместе со страницей истории или уже
+            # есть в кэше; отдельный запрос (через лимитер) нужен только при промахе
+            try:
+                sender = await entity_cache.resolve_sender(
+                    message,
+                    lambda: rate_limiter.call(message.get_sender)
+                )
+            except Exception as e:
+                logger.debug("Не удалось получить отправителя для сообщения %s: %s", message.id, e)
+                sender = None
+            
+            success = await process_message(message, chat, sender)
+            
+            if success:
+                progress['parsed'] += 1
+                if progress['parsed'] % 100 == 0:
+                    logger.info("Обработано сообщений из %s: %s", chat_title, progress['parsed'])
+            else:
+                progress['errors'] += 1
+                progress['failed_ids'].append(message.id)
+                
+        except Exception as e:
+            progress['errors'] += 1
+            progress['failed_ids'].append(message.id)
+            logger.error(f"Ошибка при обработке сообщения {message.id}: {e}")
+
+
+async def parse_chat_history(chat_entity, limit=None, offset_date=None, progress=None):
     """
     Парсинг истории сообщений из чата
     
+    Прогресс хранится в таблице parse_state: повторный запуск сначала
+    загружает новые сообщения выше верхней границы, а затем продолжает
+    догрузку истории ниже нижней границы, не запрашивая уже загруженное.
+    
     Args:
         chat_entity: Объект чата (может быть username, ID или entity)
         limit: Максимальное количество сообщений для парсинга (None = все)
         offset_date: Дата, с которой начинать парсинг (None = с начала)
+        progress: Словарь, в котором по ходу парсинга обновляются счетчики
     """
     chat_id = None
     chat_title = "Unknown"
@@ -178,7 +348,7 @@ async def parse_chat_history(chat_entity, limit=None, offset_date=None):
         # Получение информации о чате
         try:
             if isinstance(chat_entity, (int, str)):
-                chat = await client.get_entity(chat_entity)
+                chat = await rate_limiter.call(client.get_entity, chat_entity)
             else:
                 chat = chat_entity
         except ValueError as e:
@@ -200,47 +370,103 @@ async def parse_chat_history(chat_entity, limit=None, offset_date=None):
         parsing_active[chat_id] = True
         logger.info(f"Начало парсинга истории чата: {chat_title} (ID: {chat_id})")
         
-        total_parsed = 0
-        errors_count = 0
+        # Контрольная точка: диапазон уже загруженных message_id
+        state = await db.get_parse_state(chat_id) or {
+            'min_message_id': None,
+            'max_message_id': None,
+            'backfill_complete': 0,
+        }
+        if state['max_message_id'] is not None:
+            logger.info(
+                f"Продолжение парсинга {chat_title}: уже загружены сообщения "
+                f"{state['min_message_id']}..{state['max_message_id']}"
+                f"{', история загружена полностью' if state['backfill_complete'] else ''}"
+            )
+            if offset_date:
+                logger.info("Есть контрольная точка, параметр offset_date игнорируется")
+                offset_date = None
+        
+        if progress is None:
+            progress = {}
+        progress.update({
+            'fetched': 0, 'parsed': 0, 'errors': 0, 'since_checkpoint': 0,
+            # Несохраненные сообщения: попадают в parse_failures при сохранении контрольной точки
+            'failed_ids': [],
+            # Для оценки оставшегося времени (/jobs)
+            'oldest_message_id': state['min_message_id'],
+            'backfill_complete': state['backfill_complete'],
+        })
+        
+        def page_limit():
+            if limit is None:
+                return HISTORY_PAGE_SIZE
+            return min(HISTORY_PAGE_SIZE, limit - progress['fetched'])
+        
+        async def checkpoint(force=False):
+            """Контрольная точка; возвращает message_id, записанные в parse_failures"""
+            if not force and progress['since_checkpoint'] < CHECKPOINT_EVERY:
+                return []
+            # Граница сдвигается только после того, как сообщения записаны
+            if writer:
+                await writer.flush()
+                progress['failed_ids'] += writer.take_failed(chat_id)
+            # Граница проходит и мимо несохраненных сообщений, поэтому они
+            # запоминаются раньше нее и загружаются заново следующим запуском
+            failed_ids = progress['failed_ids']
+            if failed_ids:
+                await db.add_parse_failures(chat_id, failed_ids)
+                progress['failed_ids'] = []
+            await db.save_parse_state(chat_id, **state)
+            progress['since_checkpoint'] = 0
+            return failed_ids
         
         try:
-            async for message in client.iter_messages(
-                chat,
-                limit=limit,
-                offset_date=offset_date,
-                reverse=False  # Сначала старые сообщения
-            ):
-                try:
-                    # Пропускаем служебные сообщения
-                    if message.action:
-                        continue
-                    
-                    try:
-                        sender = await message.get_sender()
-                    except Exception as e:
-                        logger.debug(f"Не удалось получить отправителя для сообщения {message.id}: {e}")
-                        sender = None
-                    
-                    success = await process_message(message, chat, sender)
-                    
-                    if success:
-                        total_parsed += 1
-                        if total_parsed % 100 == 0:
-                            logger.info(f"Обработано сообщений из {chat_title}: {total_parsed}")
-                    else:
-                        errors_count += 1
-                    
-                    # Небольшая задержка, чтобы не получить FloodWait
-                    if total_parsed % 50 == 0:
-                        await asyncio.sleep(1)
-                        
-                except FloodWaitError as e:
-                    logger.warning(f"FloodWait: ожидание {e.seconds} секунд...")
-                    await asyncio.sleep(e.seconds)
-                except Exception as e:
-                    errors_count += 1
-                    logger.error(f"Ошибка при обработке сообщения {message.id}: {e}")
-                    continue
+            # 0. Повтор сообщений, которые не удалось сохранить прошлыми запусками
+            retry_ids = await db.get_parse_failures(chat_id)
+            if retry_ids:
+                logger.info(f"Повторная загрузка несохраненных сообщений {chat_title}: {len(retry_ids)}")
+            for start in range(0, len(retry_ids), HISTORY_PAGE_SIZE):
+                ids = retry_ids[start:start + HISTORY_PAGE_SIZE]
+                page = await fetch_history_page(chat, ids=ids)
+                # Удаленные сообщения приходят как None: повторять нечего
+                await process_history_page([m for m in page if m is not None], chat, chat_title, progress)
+                # Не сохранились снова (в том числе при отложенной записи) - остаются в parse_failures
+                still_failed = set(await checkpoint(force=True))
+                await db.remove_parse_failures(chat_id, [i for i in ids if i not in still_failed])
+            
+            # 1. Новые сообщения выше верхней границы (от старых к новым)
+            if state['max_message_id'] is not None:
+                while page_limit() > 0:
+                    page = await fetch_history_page(
+                        chat,
+                        limit=page_limit(),
+                        offset_id=state['max_message_id'],
+                        reverse=True
+                    )
+                    if not page:
+                        break
+                    await process_history_page(page, chat, chat_title, progress)
+                    state['max_message_id'] = max(state['max_message_id'], max(m.id for m in page))
+                    await checkpoint()
+            
+            # 2. Догрузка истории ниже нижней границы (от новых к старым)
+            while not state['backfill_complete'] and page_limit() > 0:
+                page = await fetch_history_page(
+                    chat,
+                    limit=page_limit(),
+                    offset_id=state['min_message_id'] or 0,
+                    offset_date=offset_date if state['min_message_id'] is None else None
+                )
+                if not page:
+                    state['backfill_complete'] = progress['backfill_complete'] = 1
+                    break
+                await process_history_page(page, chat, chat_title, progress)
+                page_min = min(m.id for m in page)
+                page_max = max(m.id for m in page)
+                state['min_message_id'] = min(state['min_message_id'] or page_min, page_min)
+                progress['oldest_message_id'] = state['min_message_id']
+                state['max_message_id'] = max(state['max_message_id'] or page_max, page_max)
+                await checkpoint()
                     
         except ChatAdminRequiredError:
             logger.error(f"Нет доступа к истории чата {chat_title}. Убедитесь, что бот добавлен в группу и имеет права.")
@@ -250,7 +476,15 @@ async def parse_chat_history(chat_entity, limit=None, offset_date=None):
             return False
         finally:
             parsing_active[chat_id] = False
+            # Сохраняем прогресс даже при ошибке, чтобы следующий запуск продолжил с этого места
+            if state['max_message_id'] is not None:
+                try:
+                    await checkpoint(force=True)
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить контрольную точку парсинга {chat_title}: {e}")
         
+        total_parsed = progress['parsed']
+        errors_count = progress['errors']
         logger.info(f"Парсинг завершен: {chat_title}. Обработано: {total_parsed}, Ошибок: {errors_count}")
         return True
         
@@ -261,168 +495,391 @@ async def parse_chat_history(chat_entity, limit=None, offset_date=None):
         return False
 
 
-@client.on(events.NewMessage(incoming=True))
+# Последний текст сообщений с ходом парсинга: (chat_id, message_id) -> текст
+progress_messages = {}
+
+
+def format_parse_progress(jobs):
+    """Текст сообщения с ходом задач парсинга одной команды"""
+    text = f"📥 **Парсинг** (обновлено {datetime.now().strftime('%H:%M:%S')})\n\n"
+    icons = {'queued': '⏳', 'running': '🔄', 'done': '✅', 'failed': '❌', 'cancelled': '⛔'}
+    text += "".join(f"{icons[job.status]} {job.describe()}\n" for job in jobs)
+    if any(job.status == 'failed' for job in jobs):
+        text += (
+            "\nПри ошибке проверьте username или ID группы и доступ к ней "
+            "(в приватных группах нужно быть участником), подробности - в логах."
+        )
+    elif jobs and all(job.status in ('done', 'cancelled') for job in jobs):
+        text += "\n💾 Используйте /stats для детальной статистики"
+    else:
+        text += "\nОтмена: `/cancel <номер>`, все задачи: /jobs"
+    return text
+
+
+async def update_parse_progress(reply_to):
+    """Редактирование сообщения с ходом парсинга (если текст изменился)"""
+    if reply_to is None:
+        return
+    jobs = scheduler.jobs_for(reply_to)
+    if not jobs:
+        return
+    text = format_parse_progress(jobs)
+    # Время обновления не считается изменением
+    body = text.split('\n', 1)[1]
+    if progress_messages.get(reply_to) == body:
+        return
+    progress_messages[reply_to] = body
+    try:
+        await client.edit_message(reply_to[0], reply_to[1], text)
+    except Exception as e:
+        logger.debug("Не удалось обновить сообщение с ходом парсинга: %s", e)
+
+
+async def on_parse_job_update(job):
+    """Запуск и завершение задачи сразу показываются в ее сообщении"""
+    await update_parse_progress(job.reply_to)
+    # Все задачи сообщения завершены: его текст больше не меняется
+    if job.reply_to is not None and not any(j.reply_to == job.reply_to for j in scheduler.jobs.values()):
+        progress_messages.pop(job.reply_to, None)
+
+
+async def parse_progress_loop():
+    """Периодическое обновление сообщений выполняющихся задач"""
+    while True:
+        await asyncio.sleep(PARSE_PROGRESS_INTERVAL)
+        await scheduler.save_progress()
+        for reply_to in {job.reply_to for job in scheduler.running()}:
+            await update_parse_progress(reply_to)
+
+
+# Планировщик задач парсинга: несколько чатов параллельно с общим бюджетом запросов.
+# Задачи хранятся в parse_jobs и продолжаются после перезапуска
+scheduler = ParseScheduler(
+    parse_chat_history,
+    concurrency=PARSE_CONCURRENCY,
+    db=db,
+    on_update=on_parse_job_update,
+)
+
+
+def register_runtime_metrics():
+    """Метрики, которые читаются из состояния компонентов в момент запроса"""
+    collect = metrics.registry.collect
+    collect('userbot_flood_waits_total', 'Получено FloodWait от Telegram',
+            lambda: rate_limiter.flood_waits, kind='counter')
+    collect('userbot_flood_wait_seconds_total', 'Суммарная длительность FloodWait, секунд',
+            lambda: rate_limiter.total_flood_seconds, kind='counter')
+    collect('userbot_telegram_requests_total', 'Запросов к Telegram через лимитер',
+            lambda: rate_limiter.requests, kind='counter')
+    collect('userbot_rate_limit_per_second', 'Текущий лимит запросов в секунду',
+            lambda: rate_limiter.rate)
+    collect('userbot_parse_jobs_running', 'Выполняющихся задач парсинга',
+            lambda: len(scheduler.running()))
+    collect('userbot_parse_jobs_queued', 'Задач парсинга в очереди',
+            lambda: len(scheduler.queued()))
+    collect('userbot_entity_cache_hits_total', 'Отправителей найдено в кэше',
+            lambda: entity_cache.stats['hits'], kind='counter')
+    collect('userbot_entity_cache_misses_total', 'Запросов отправителя к Telegram',
+            lambda: entity_cache.stats['misses'], kind='counter')
+    if writer:
+        collect('userbot_write_queue_depth', 'Сообщений в очереди пакетной записи',
+                lambda: writer.queue.qsize())
+        collect('userbot_write_queue_failed_total', 'Сообщений, которые не удалось записать',
+                lambda: writer.stats['messages_failed'], kind='counter')
+    if media_downloader:
+        collect('userbot_media_queue_depth', 'Медиа в очереди загрузки',
+                lambda: media_downloader.queue.qsize())
+        collect('userbot_media_downloaded_total', 'Новых файлов загружено',
+                lambda: media_downloader.stats['downloaded'], kind='counter')
+        collect('userbot_media_deduplicated_total', 'Медиа, уже бывших в хранилище',
+                lambda: media_downloader.stats['deduplicated'], kind='counter')
+        collect('userbot_media_downloaded_bytes_total', 'Загружено байт медиа',
+                lambda: media_downloader.stats['bytes_downloaded'], kind='counter')
+        collect('userbot_media_dropped_total', 'Медиа пропущено из-за заполненной очереди',
+                lambda: media_downloader.stats['dropped'], kind='counter')
+        collect('userbot_media_failed_total', 'Ошибок загрузки медиа',
+                lambda: media_downloader.stats['failed'], kind='counter')
+
+
+register_runtime_metrics()
+
+
+@client.on(events.NewMessage())
+@metrics.timed(HANDLER_SECONDS)
 async def handler(event):
-    """Обработчик новых сообщений"""
+    """
+    Единый обработчик новых сообщений
+    
+    Команда определяется одной проверкой префикса и поиском в COMMANDS,
+    остальные входящие сообщения сразу сохраняются. Новые команды не
+    добавляют работы на каждое сообщение.
+    """
     try:
         message = event.message
         message_text = message.text or ""
-        chat_id = event.chat_id
         
-        # Логируем ВСЕ входящие сообщения для отладки
-        logger.info(f"📨 ВХОДЯЩЕЕ сообщение: '{message_text[:100]}' | chat_id: {chat_id} | is_private: {event.is_private}")
+        # Логируем входящие сообщения для отладки (не чаще LOG_EVENTS_PER_SECOND в секунду)
+        events_logger.info("📨 ВХОДЯЩЕЕ сообщение: '%.100s' | chat_id: %s | is_private: %s",
+                           message_text, event.chat_id, event.is_private)
         
         # Пропускаем служебные сообщения
         if message.action:
             return
         
-        # Пропускаем команды (они обрабатываются отдельными обработчиками)
-        # НО НЕ БЛОКИРУЕМ их - пусть специальные обработчики сработают
-        if message_text.startswith('/'):
-            logger.info(f"⚡ Обнаружена команда в общем обработчике: '{message_text}' - пропускаем для специальных обработчиков")
+        if message_text.startswith('/') and is_command_chat(event):
+            command = COMMANDS.get(message_text.split(None, 1)[0])
+            if command is not None:
+                logger.info("⚡ Команда: '%s' | chat_id: %s", message_text, event.chat_id)
+                await command(event)
+                return
+        
+        # Собственные исходящие сообщения не сохраняются
+        if message.out:
             return
         
         chat = await event.get_chat()
-        sender = await event.get_sender()
+        sender = await entity_cache.resolve_sender(message, event.get_sender)
         await process_message(message, chat, sender)
         
-        chat_info = get_chat_info(chat)
-        user_info = get_user_info(sender)
-        logger.debug(f"Сохранено сообщение: {chat_info['chat_title']} - {user_info['username'] or user_info['first_name'] or 'Unknown'}")
+        if logger.isEnabledFor(logging.DEBUG):
+            chat_info = get_chat_info(chat)
+            user_info = get_user_info(sender)
+            logger.debug("Сохранено сообщение: %s - %s", chat_info['chat_title'],
+                         user_info['username'] or user_info['first_name'] or 'Unknown')
         
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}", exc_info=True)
 
 
 @client.on(events.MessageEdited)
+@metrics.timed(HANDLER_SECONDS)
 async def handler_edited(event):
     """Обработчик отредактированных сообщений"""
     try:
         message = event.message
         chat = await event.get_chat()
-        sender = await event.get_sender()
+        sender = await entity_cache.resolve_sender(message, event.get_sender)
         
         await process_message(message, chat, sender)
-        logger.debug(f"Отредактировано сообщение в чате {event.chat_id}")
+        logger.debug("Отредактировано сообщение в чате %s", event.chat_id)
     except Exception as e:
         logger.error(f"Ошибка при обработке отредактированного сообщения: {e}", exc_info=True)
 
 
-# Обработчик команды /parse - используем более гибкий паттерн
-@client.on(events.NewMessage(pattern=r'^/parse'))
+def is_command_chat(event):
+    """
+    Команды принимаются только от владельца аккаунта и только в личных
+    сообщениях (включая Saved Messages)
+    """
+    # Аккаунт запрашивается при запуске; до этого команды не выполняются
+    if me is None:
+        return False
+    from_owner = event.message.out or event.sender_id == me.id
+    # Saved Messages имеет chat_id равный вашему user_id
+    return from_owner and (event.is_private or event.chat_id == me.id)
+
+
+def parse_command_args(args_parts):
+    """Разбор аргументов /parse: чаты и параметр limit=N"""
+    chat_identifiers = []
+    limit = None
+    
+    for part in args_parts:
+        if part.startswith('limit='):
+            try:
+                limit = int(part.split('=')[1])
+                logger.info(f"📊 Установлен лимит: {limit}")
+            except ValueError:
+                logger.warning(f"⚠️ Неверный формат limit: {part}")
+        elif part not in chat_identifiers:
+            chat_identifiers.append(part)
+    
+    return chat_identifiers, limit
+
+
+async def submit_parse_jobs(event, chat_identifiers, limit=None):
+    """
+    Постановка чатов в очередь планировщика
+
+    Ответ - одно сообщение, которое дальше редактируется по ходу задач
+    (в том числе после перезапуска userbot).
+    """
+    reply = await event.respond(f"🔄 Добавляю в очередь парсинга: {len(chat_identifiers)}")
+    reply_to = (event.chat_id, reply.id)
+    
+    already = []
+    for chat_identifier in chat_identifiers:
+        job = await scheduler.submit(chat_identifier, limit=limit, reply_to=reply_to)
+        if job.reply_to != reply_to:
+            already.append(job)
+    
+    if already:
+        await event.respond(
+            "ℹ️ Уже в очереди или выполняются:\n"
+            + "\n".join(f"• {job.describe()}" for job in already)
+        )
+    await update_parse_progress(reply_to)
+
+
 async def parse_command_handler(event):
-    """Обработчик команды /parse для парсинга истории чата"""
+    """Обработчик команды /parse для парсинга истории одного или нескольких чатов"""
     try:
-        # Логируем СРАЗУ при срабатывании обработчика
         message_text = event.message.text or ""
-        chat_id = event.chat_id
-        
-        logger.info(f"🎯 ОБРАБОТЧИК /parse СРАБОТАЛ! Сообщение: '{message_text}' | chat_id: {chat_id}")
         
-        # Получаем информацию о себе для проверки Saved Messages
-        me = await client.get_me()
-        is_saved_messages = (chat_id == me.id)
+        # Получаем аргументы команды - парсим вручную из текста сообщения
+        # Формат: /parse @username [@username2 ...] [limit=1000]
+        chat_identifiers, limit = parse_command_args(message_text.split()[1:])
+        if not chat_identifiers:
+            await event.respond(
+                "❌ Неверный формат команды. Используйте: `/parse @username`, "
+                "`/parse @a @b @c` или `/parse @username limit=1000`"
+            )
+            return
         
-        logger.info(f"🔍 Детали: is_private: {event.is_private} | is_saved: {is_saved_messages} | my_id: {me.id}")
+        logger.info(f"📋 Парсинг аргументов: чаты={chat_identifiers}, limit={limit}")
         
-        # Команда работает в личных сообщениях (включая Saved Messages)
-        # Saved Messages имеет chat_id равный вашему user_id
-        if not event.is_private and not is_saved_messages:
-            logger.warning(f"⚠️ Сообщение не из личного чата. Chat ID: {chat_id}, My ID: {me.id}")
+        await submit_parse_jobs(event, chat_identifiers, limit)
+            
+    except Exception as e:
+        logger.error(f"Ошибка в команде /parse: {e}", exc_info=True)
+        await event.respond(f"❌ Критическая ошибка: {str(e)}")
+
+
+# Строка файла /parse_list: @username, ID чата или ссылка t.me
+CHAT_IDENTIFIER_RE = re.compile(
+    r'^(?:@?[A-Za-z][A-Za-z0-9_]{3,31}|-?\d{1,20}|(?:https?://)?t\.me/(?:\+|joinchat/)?[A-Za-z0-9_-]{4,64})$'
+)
+
+
+def resolve_list_file(name):
+    """Путь к файлу списка внутри PARSE_LIST_DIR; None - имя ведет за пределы каталога"""
+    if os.path.isabs(name) or '..' in re.split(r'[\\/]', name):
+        return None
+    base = os.path.realpath(PARSE_LIST_DIR)
+    path = os.path.realpath(os.path.join(base, name))
+    # realpath раскрывает и символические ссылки, ведущие из каталога
+    if os.path.commonpath([base, path]) != base:
+        return None
+    return path
+
+
+async def parse_list_command_handler(event):
+    """Обработчик команды /parse_list: парсинг чатов из файла (по одному на строку)"""
+    try:
+        args_parts = (event.message.text or "").split()[1:]
+        if not args_parts:
+            await event.respond(f"❌ Неверный формат команды. Используйте: `/parse_list файл.txt [limit=1000]` (файл в каталоге {PARSE_LIST_DIR})")
             return
         
-        # Получаем аргументы команды - парсим вручную из текста сообщения
-        # Формат: /parse @username или /parse @username limit=1000
-        parts = message_text.split(None, 1)  # Разделяем по пробелам, максимум 2 части
-        if len(parts) < 2:
-            await event.respond("❌ Неверный формат команды. Используйте: `/parse @username` или `/parse @username limit=1000`")
+        list_name = args_parts[0]
+        _, limit = parse_command_args(args_parts[1:])
+        
+        list_file = resolve_list_file(list_name)
+        if list_file is None:
+            await event.respond(f"❌ Файл списка должен лежать в каталоге {PARSE_LIST_DIR} (без `..` и абсолютных путей)")
+            return
+        try:
+            with open(list_file, 'r', encoding='utf-8') as f:
+                lines = [line.split('#', 1)[0].strip() for line in f]
+        except (OSError, UnicodeDecodeError):
+            await event.respond(f"❌ Не удалось прочитать файл списка {list_name} из {PARSE_LIST_DIR}")
             return
         
-        args = parts[1].strip()  # Все что после /parse
+        # В ответ попадают только строки, похожие на чаты; остальное не показывается
+        lines = [line for line in lines if line]
+        valid = [line for line in lines if CHAT_IDENTIFIER_RE.match(line)]
+        chat_identifiers, _ = parse_command_args(valid)
+        if len(valid) < len(lines):
+            logger.warning(f"/parse_list {list_name}: пропущено строк, не похожих на чат: {len(lines) - len(valid)}")
+            await event.respond(f"⚠️ Пропущено строк, не похожих на чат: {len(lines) - len(valid)}")
+        if not chat_identifiers:
+            await event.respond(f"❌ В файле {list_name} нет чатов")
+            return
         
-        # Парсим аргументы: /parse @username или /parse @username limit=1000
-        args_parts = args.split()
-        chat_identifier = args_parts[0]
-        limit = None
+        await submit_parse_jobs(event, chat_identifiers, limit)
         
-        logger.info(f"📋 Парсинг аргументов: chat_identifier='{chat_identifier}', остальное='{args_parts[1:] if len(args_parts) > 1 else []}'")
+    except Exception as e:
+        logger.error(f"Ошибка в команде /parse_list: {e}", exc_info=True)
+        await event.respond(f"❌ Критическая ошибка: {str(e)}")
+
+
+async def jobs_command_handler(event):
+    """Обработчик команды /jobs: очередь, выполняющиеся и завершенные задачи парсинга"""
+    try:
+        running = scheduler.running()
+        queued = scheduler.queued()
+        finished = list(scheduler.finished)[-10:]
         
-        # Поиск параметра limit
-        for part in args_parts[1:]:
-            if part.startswith('limit='):
-                try:
-                    limit = int(part.split('=')[1])
-                    logger.info(f"📊 Установлен лимит: {limit}")
-                except ValueError:
-                    logger.warning(f"⚠️ Неверный формат limit: {part}")
-                    pass
+        status_text = "📋 **Задачи парсинга**\n\n"
+        status_text += f"**Выполняются ({len(running)}):**\n"
+        status_text += "".join(f"• {job.describe()}\n" for job in running) or "—\n"
+        status_text += f"\n**В очереди ({len(queued)}):**\n"
+        status_text += "".join(f"• {job.describe()}\n" for job in queued) or "—\n"
+        status_text += f"\n**Завершены (последние {len(finished)}):**\n"
+        status_text += "".join(f"• {job.describe()}\n" for job in reversed(finished)) or "—\n"
+        status_text += f"\n⚡ Лимит запросов: {rate_limiter.describe()}\n"
+        if running or queued:
+            status_text += "Отмена задачи: `/cancel <номер>`\n"
         
-        await event.respond(f"🔄 Начинаю парсинг чата: {chat_identifier}\n⏳ Это может занять некоторое время...")
+        await event.respond(status_text)
         
-        # Запускаем парсинг в фоне
+    except Exception as e:
+        logger.error(f"Ошибка в команде /jobs: {e}", exc_info=True)
+        await event.respond(f"❌ Ошибка: {str(e)}")
+
+
+async def cancel_command_handler(event):
+    """Обработчик команды /cancel <номер>: отмена задачи парсинга"""
+    try:
+        args_parts = (event.message.text or "").split()[1:]
         try:
-            success = await parse_chat_history(chat_identifier, limit=limit)
-            
-            if success:
-                count = await db.get_messages_count()  # Получаем общее количество
-                await event.respond(
-                    f"✅ Парсинг завершен!\n"
-                    f"📊 Всего сообщений в базе: {count}\n"
-                    f"💾 Используйте /stats для детальной статистики"
-                )
-            else:
-                await event.respond(
-                    "❌ Ошибка при парсинге.\n"
-                    "Возможные причины:\n"
-                    "• Группа приватная и вы не участник\n"
-                    "• Неправильный username или ID\n"
-                    "• Нет доступа к истории сообщений\n\n"
-                    "Проверьте логи для подробностей."
-                )
-        except ValueError as e:
-            # Ошибка при получении entity (группа не найдена)
-            await event.respond(
-                f"❌ Группа не найдена: {chat_identifier}\n\n"
-                "Проверьте:\n"
-                "• Правильность username (например: @groupname)\n"
-                "• Правильность ID группы\n"
-                "• Доступ к группе (для приватных групп нужно быть участником)"
-            )
-        except Exception as e:
-            error_msg = str(e)
-            if "username" in error_msg.lower() or "not found" in error_msg.lower():
-                await event.respond(
-                    f"❌ Группа не найдена или нет доступа.\n"
-                    f"Ошибка: {error_msg}\n\n"
-                    "Для приватных групп нужно быть участником."
-                )
-            else:
-                await event.respond(f"❌ Ошибка: {error_msg}\nПроверьте логи для подробностей.")
-            
+            job_id = int(args_parts[0].lstrip('#'))
+        except (IndexError, ValueError):
+            await event.respond("❌ Неверный формат команды. Используйте: `/cancel <номер>` (номер - в /jobs)")
+            return
+        
+        job = await scheduler.cancel(job_id)
+        if job is None:
+            await event.respond(f"❌ Нет активной задачи #{job_id}. Список задач: /jobs")
+            return
+        # Загруженное сохранено в parse_state: повторный /parse продолжит с этого места
+        await event.respond(f"⛔ Задача #{job_id} ({job.chat_identifier}) отменяется")
+        
     except Exception as e:
-        logger.error(f"Ошибка в команде /parse: {e}", exc_info=True)
-        await event.respond(f"❌ Критическая ошибка: {str(e)}")
+        logger.error(f"Ошибка в команде /cancel: {e}", exc_info=True)
+        await event.respond(f"❌ Ошибка: {str(e)}")
 
 
-@client.on(events.NewMessage(pattern=r'^/stats$', incoming=True, from_users=None))
 async def stats_command_handler(event):
     """Обработчик команды /stats для получения статистики"""
     try:
-        if not event.is_private:
-            return
-        
-        total_messages = await db.get_messages_count()
-        chats = await db.get_chats()
+        stats = await db.get_stats(top=10)
         
         stats_text = f"📊 **Статистика парсера**\n\n"
-        stats_text += f"Всего сообщений: {total_messages}\n"
-        stats_text += f"Всего чатов: {len(chats)}\n\n"
+        stats_text += f"Всего сообщений: {stats['total_messages']}\n"
+        stats_text += f"Всего чатов: {stats['total_chats']}\n"
+        stats_text += f"Всего авторов: {stats['total_users']}\n"
+        if writer:
+            stats_text += (
+                f"Очередь записи: {writer.queue.qsize()}, "
+                f"последний пакет: {writer.stats['last_flush_size']} "
+                f"за {writer.stats['last_flush_ms']:.0f} мс\n"
+            )
+        stats_text += f"Кэш отправителей: {entity_cache.describe()}\n"
+        if media_downloader:
+            media = await db.get_media_stats()
+            stats_text += (
+                f"Медиа: {media['messages']} сообщений, {media['files']} файлов "
+                f"({media['bytes'] / MB:.1f} МБ); {media_downloader.describe()}\n"
+            )
+        stats_text += "\n"
         stats_text += "**Топ чатов:**\n"
         
-        # Получаем статистику по чатам
-        for chat in chats[:10]:
-            chat_messages = await db.get_messages_count(chat['chat_id'])
-            stats_text += f"• {chat['chat_title']}: {chat_messages} сообщений\n"
+        for chat in stats['top_chats']:
+            stats_text += (
+                f"• {chat['chat_title']}: {chat['message_count']} сообщений, "
+                f"{chat['user_count']} авторов\n"
+            )
         
         await event.respond(stats_text)
         
@@ -431,25 +888,104 @@ async def stats_command_handler(event):
         await event.respond(f"❌ Ошибка: {str(e)}")
 
 
-@client.on(events.NewMessage(pattern=r'^/help$'))
-async def help_command_handler(event):
-    """Обработчик команды /help"""
+# Сколько результатов /search показывать на одной странице
+SEARCH_PAGE_SIZE = 10
+
+
+def format_search_result(row):
+    """Одна строка результата поиска"""
+    if row['username']:
+        author = f"@{row['username']}"
+    else:
+        author = f"{row['first_name'] or ''} {row['last_name'] or ''}".strip() or "—"
+    date = (row['date'] or '')[:16].replace('T', ' ')
+    snippet = (row['snippet'] or '').replace('\n', ' ')
+    return f"• {row['chat_title'] or row['chat_id']} | {date} | {author}\n  {snippet}"
+
+
+async def search_command_handler(event):
+    """Обработчик команды /search: полнотекстовый поиск по сохраненным сообщениям"""
     try:
-        chat_id = event.chat_id
-        me = await client.get_me()
-        is_saved_messages = (chat_id == me.id)
+        # Формат: /search слова [chat=..] [since=ГГГГ-ММ-ДД] [page=N]
+        words = []
+        options = {}
+        for part in (event.message.text or "").split()[1:]:
+            name, sep, value = part.partition('=')
+            if sep and name in ('chat', 'since', 'page'):
+                options[name] = value
+            else:
+                words.append(part)
+        
+        if not words:
+            await event.respond(
+                "❌ Неверный формат команды. Используйте: `/search слова [chat=@group] "
+                "[since=2024-01-01] [page=2]`"
+            )
+            return
+        
+        try:
+            page = max(1, int(options.get('page', 1)))
+        except ValueError:
+            page = 1
         
-        logger.info(f"🔍 ОБРАБОТЧИК /help: chat_id: {chat_id} | is_private: {event.is_private} | is_saved: {is_saved_messages}")
+        query = ' '.join(words)
+        started = time.monotonic()
+        results = await db.search_messages(
+            query,
+            chat=options.get('chat'),
+            since=options.get('since'),
+            limit=SEARCH_PAGE_SIZE + 1,
+            offset=(page - 1) * SEARCH_PAGE_SIZE
+        )
+        elapsed_ms = (time.monotonic() - started) * 1000
         
-        if not event.is_private and not is_saved_messages:
+        if not results:
+            await event.respond(f"🔍 По запросу «{query}» ничего не найдено")
             return
         
+        has_more = len(results) > SEARCH_PAGE_SIZE
+        text = f"🔍 **{query}** - страница {page} ({elapsed_ms:.0f} мс)\n\n"
+        text += "\n".join(format_search_result(row) for row in results[:SEARCH_PAGE_SIZE])
+        if has_more:
+            text += f"\n\nСледующая страница: `page={page + 1}`"
+        
+        await event.respond(text)
+        
+    except Exception as e:
+        logger.error(f"Ошибка в команде /search: {e}", exc_info=True)
+        await event.respond(f"❌ Ошибка: {str(e)}")
+
+
+async def metrics_command_handler(event):
+    """Обработчик команды /metrics: сводка метрик работы userbot"""
+    try:
+        summary = metrics.registry.summary()
+        # Ограничение Telegram на длину сообщения
+        if len(summary) > 3900:
+            summary = summary[:3900] + "\n…"
+        await event.respond(f"📈 **Метрики**\n\n```\n{summary}\n```")
+        
+    except Exception as e:
+        logger.error(f"Ошибка в команде /metrics: {e}", exc_info=True)
+        await event.respond(f"❌ Ошибка: {str(e)}")
+
+
+async def help_command_handler(event):
+    """Обработчик команды /help"""
+    try:
         help_text = """
 🤖 **Команды userbot:**
 
 `/parse @username` - Начать парсинг истории чата
 `/parse @username limit=1000` - Парсинг с ограничением количества
+`/parse @a @b @c` - Парсинг нескольких чатов параллельно
+`/parse_list chats.txt` - Парсинг чатов из файла в каталоге PARSE_LIST_DIR (по одному на строку)
+`/jobs` - Задачи парсинга: ход, скорость, оставшееся время
+`/cancel 3` - Отменить задачу парсинга #3
+`/search слова` - Поиск по сохраненным сообщениям
+`/search слова chat=@group since=2024-01-01 page=2` - Поиск с фильтрами
 `/stats` - Показать статистику
+`/metrics` - Метрики работы (задержки, FloodWait, очереди)
 `/help` - Показать эту справку
 
 **Примеры:**
@@ -465,6 +1001,20 @@ async def help_command_handler(event):
         logger.error(f"Ошибка в команде /help: {e}", exc_info=True)
 
 
+# Команды в личных сообщениях: первое слово сообщения -> обработчик
+COMMANDS = {
+    '/parse': parse_command_handler,
+    '/parse_list': parse_list_command_handler,
+    '/jobs': jobs_command_handler,
+    '/parse_status': jobs_command_handler,
+    '/cancel': cancel_command_handler,
+    '/stats': stats_command_handler,
+    '/search': search_command_handler,
+    '/metrics': metrics_command_handler,
+    '/help': help_command_handler,
+}
+
+
 async def main():
     """Основная функция запуска userbot"""
     logger.info("Запуск userbot...")
@@ -473,6 +1023,37 @@ async def main():
     await db.connect()
     logger.info("Подключено к базе данных")
     
+    await chat_registry.load()
+    await chat_registry.start()
+    await entity_cache.load()
+    await entity_cache.start()
+    if writer:
+        await writer.start()
+    if media_downloader:
+        await media_downloader.start()
+    await scheduler.start()
+    progress_task = asyncio.create_task(parse_progress_loop())
+    metrics_server = None
+    
+    try:
+        metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        await run_client()
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        progress_task.cancel()
+        await scheduler.stop()
+        await chat_registry.stop()
+        await entity_cache.stop()
+        if media_downloader:
+            await media_downloader.stop()
+        # Сбрасываем накопленные сообщения до закрытия базы
+        if writer:
+            await writer.stop()
+
+
+async def run_client():
+    """Подключение к Telegram и работа до отключения"""
     # Подключение к Telegram
     import os
     if STRING_SESSION:
@@ -508,18 +1089,23 @@ async def main():
     
     logger.info("Userbot запущен и готов к работе!")
     
-    # Получение информации о себе
-    me = await client.get_me()
+    # Получение информации о себе (дальше используется сохраненное значение)
+    me = await get_me()
     logger.info(f"Вошли как: {me.first_name} {me.last_name or ''} (@{me.username or 'без username'})")
     logger.info(f"ID аккаунта: {me.id}")
     
+    # Незавершенные задачи парсинга продолжаются с контрольных точек
+    await scheduler.restore()
+    
     # Статистика
     messages_count = await db.get_messages_count()
     logger.info(f"Всего сообщений в базе: {messages_count}")
     
     # Информация о командах
     logger.info("Доступные команды (в личных сообщениях):")
-    logger.info("  /parse @username - парсинг истории чата")
+    logger.info("  /parse @username [@username2 ...] - парсинг истории чатов")
+    logger.info("  /parse_list <файл> - парсинг чатов из файла")
+    logger.info("  /jobs - задачи парсинга, /cancel <номер> - отмена")
     logger.info("  /stats - статистика")
     logger.info("  /help - справка")
     
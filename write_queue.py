@@ -0,0 +1,143 @@
+"""
+Отложенная пакетная запись сообщений (write-behind)
+
+Производители кладут подготовленные словари сообщений в ограниченную
+очередь, а единственная фоновая задача сбрасывает их в базу пакетами
+через executemany одной транзакцией - по достижении размера пакета
+или по истечении интервала.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List
+
+from database import MessageDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    # Сколько несохраненных message_id помнить на чат
+    FAILED_LIMIT = 10000
+
+    def __init__(self, db: MessageDatabase, max_size: int = 10000,
+                 batch_size: int = 500, flush_interval: float = 1.0):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task = None
+        # chat_id -> message_id сообщений, которые не удалось записать (для парсинга)
+        self.failed: Dict[int, List[int]] = {}
+        self.stats = {
+            'flushes': 0,
+            'messages_written': 0,
+            'messages_failed': 0,
+            'last_flush_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    async def start(self):
+        """Запуск фоновой задачи записи"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(
+                f"Пакетная запись включена: пакет {self.batch_size}, "
+                f"интервал {self.flush_interval}с, очередь {self.queue.maxsize}"
+            )
+
+    async def put(self, message_data: Dict):
+        """
+        Постановка сообщения в очередь
+
+        Если очередь заполнена, вызывающий ждет, пока писатель не
+        освободит место (backpressure), поэтому парсинг сам замедляется
+        до скорости записи на диск.
+        """
+        await self.queue.put(message_data)
+
+    async def flush(self):
+        """Ожидание записи всех сообщений, поставленных в очередь"""
+        if self._task is not None:
+            await self.queue.join()
+
+    def take_failed(self, chat_id: int) -> List[int]:
+        """message_id сообщений чата, которые не удалось записать (после flush)"""
+        return self.failed.pop(chat_id, [])
+
+    async def stop(self):
+        """Сброс остатка очереди и остановка фоновой задачи"""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info(
+            f"Пакетная запись остановлена. Записано: {self.stats['messages_written']}, "
+            f"пакетов: {self.stats['flushes']}, ошибок: {self.stats['messages_failed']}"
+        )
+
+    async def _collect_batch(self) -> List[Dict]:
+        """Сбор пакета: ждем первое сообщение, затем добираем до лимита или таймаута"""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _write_batch(self, batch: List[Dict]):
+        """Запись пакета; при ошибке - построчно, чтобы не терять весь пакет"""
+        started = time.perf_counter()
+        try:
+            await self.db.save_messages(batch)
+            written = len(batch)
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи ({len(batch)} сообщений), пробуем построчно: {e}")
+            written = 0
+            for message_data in batch:
+                if await self.db.save_message(message_data) is not None:
+                    written += 1
+                else:
+                    failed = self.failed.setdefault(message_data.get('chat_id'), [])
+                    if len(failed) < self.FAILED_LIMIT:
+                        failed.append(message_data.get('message_id'))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.stats['flushes'] += 1
+        self.stats['messages_written'] += written
+        self.stats['messages_failed'] += len(batch) - written
+        self.stats['last_flush_size'] = len(batch)
+        self.stats['last_flush_ms'] = elapsed_ms
+        self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed_ms)
+        self.stats['total_flush_ms'] += elapsed_ms
+
+        logger.debug(
+            f"Сброс пакета: {len(batch)} сообщений за {elapsed_ms:.1f} мс "
+            f"(в очереди осталось {self.queue.qsize()})"
+        )
+
+    async def _run(self):
+        """Основной цикл писателя"""
+        while True:
+            batch = await self._collect_batch()
+            try:
+                await self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка в задаче пакетной записи: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()